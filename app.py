@@ -1,20 +1,45 @@
 # -*- coding: utf-8 -*-
 import os
+import sys
 import time
 import hmac
 import hashlib
+import math
 import requests
 import json
 import threading
+import logging
+import argparse
+import contextlib
 from flask import Flask, request, redirect, url_for, render_template, session, flash, make_response
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
 from datetime import datetime, timedelta
-import pandas as pd
 import io
 import concurrent.futures
+import collections
+import itertools
+import queue
+import copy
+import array
+import sqlite3
+import secrets
+import gc
+import subprocess
+import random
+from email.utils import parsedate_to_datetime
+
+try:
+    import fcntl # Lock antar proses untuk refresh token (tidak tersedia di Windows)
+except ImportError:
+    fcntl = None
 
 # Global variable to store export progress (thread-safe alternative to session)
 export_progress_store = {}
 
+# shop_id khusus untuk export gabungan semua toko yang terhubung
+ALL_SHOPS_ID = 'all'
+
 # ==============================================================================
 # KONFIGURASI WAJIB
 # Ganti nilai-nilai di bawah ini dengan data Anda.
@@ -32,6 +57,68 @@ REDIRECT_URL_DOMAIN = "https://alvinnovendra2.pythonanywhere.com"
 # Untuk Sandbox, ganti menjadi: "https://partner.test-stable.shopeemobile.com"
 BASE_URL = "https://partner.shopeemobile.com"
 
+# Folder untuk file data lokal aplikasi (profil endpoint, cache, dll).
+# Bisa diganti lewat environment variable SHOPEE_APP_DATA_DIR.
+DATA_DIR = os.environ.get('SHOPEE_APP_DATA_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance'))
+
+# Batas global request per detik ke Shopee, dibagi oleh semua export yang berjalan.
+SHOPEE_MAX_REQUESTS_PER_SECOND = float(os.environ.get('SHOPEE_MAX_REQUESTS_PER_SECOND', 10))
+
+# Jumlah sub-job export (mis. satu per toko) yang boleh berjalan paralel.
+EXPORT_WORKER_COUNT = int(os.environ.get('EXPORT_WORKER_COUNT', 4))
+
+# Backoff retry: jeda dasar dan jeda maksimal (detik), dengan jitter penuh.
+RETRY_BASE_DELAY = float(os.environ.get('RETRY_BASE_DELAY', 0.5))
+RETRY_MAX_DELAY = float(os.environ.get('RETRY_MAX_DELAY', 30))
+
+# Jatah retry per toko per menit; satu endpoint hanya boleh memakai separuhnya.
+RETRY_BUDGET_PER_MINUTE = float(os.environ.get('RETRY_BUDGET_PER_MINUTE', 60))
+
+# Circuit breaker per (toko, endpoint): terbuka setelah sekian kegagalan identik berturut-turut,
+# lalu dicoba lagi (satu probe) setelah cooldown (detik).
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_BREAKER_FAILURE_THRESHOLD', 5))
+CIRCUIT_BREAKER_COOLDOWN = float(os.environ.get('CIRCUIT_BREAKER_COOLDOWN', 60))
+
+# Hedging get_order_detail: kirim request duplikat jika batch melewati latensi p95 (1 = aktif, default mati).
+HEDGE_ORDER_DETAIL_REQUESTS = os.environ.get('HEDGE_ORDER_DETAIL_REQUESTS', '0') == '1'
+# Porsi jatah request per detik yang boleh dipakai untuk request hedge.
+HEDGE_BUDGET_FRACTION = float(os.environ.get('HEDGE_BUDGET_FRACTION', 0.1))
+
+# Lama (detik) metadata toko (nama, region, status) di cache sebelum diambil ulang.
+SHOP_METADATA_TTL = int(os.environ.get('SHOP_METADATA_TTL', 7 * 24 * 3600))
+
+# Cara menjalankan export: 'thread' (default, di dalam proses web) atau 'worker' (web hanya
+# memasukkan job ke antrean, dikerjakan oleh proses terpisah `python app.py worker`).
+EXPORT_EXECUTION_MODE = os.environ.get('EXPORT_EXECUTION_MODE', 'thread')
+# Jumlah job export yang dikerjakan bersamaan oleh satu proses worker.
+EXPORT_WORKER_JOBS = int(os.environ.get('EXPORT_WORKER_JOBS', 2))
+# Job yang tidak memberi kabar (heartbeat) selama sekian detik dianggap worker-nya mati dan diambil ulang.
+EXPORT_JOB_STALE_SECONDS = int(os.environ.get('EXPORT_JOB_STALE_SECONDS', 300))
+
+# Interval (detik) sinkronisasi otomatis data toko ke penyimpanan lokal; 0 = tidak otomatis
+# (sinkronisasi tetap bisa dijalankan dengan `python app.py sync`).
+SYNC_INTERVAL = int(os.environ.get('SYNC_INTERVAL', 0))
+# Sinkronisasi pertama suatu toko mengambil data yang berubah dalam sekian hari terakhir.
+SYNC_INITIAL_DAYS = int(os.environ.get('SYNC_INITIAL_DAYS', 90))
+
+# Simpan setiap push notification Shopee yang diterima ke DATA_DIR/push_events.jsonl (1 = aktif),
+# supaya bisa diputar ulang dengan `python app.py replay-push`.
+PUSH_LOG_EVENTS = os.environ.get('PUSH_LOG_EVENTS', '0') == '1'
+
+# Modul berat (pandas, numpy, openpyxl) baru diimpor saat workbook dibuat. Set 1 untuk mengimpornya
+# saat app dimuat, mis. dengan `gunicorn --preload app:app`, supaya worker hasil fork berbagi
+# modul yang sudah dimuat (copy-on-write) dan request export pertama tidak menunggu import.
+PRELOAD_HEAVY_MODULES = os.environ.get('PRELOAD_HEAVY_MODULES', '0') == '1'
+
+# Penyimpanan session di server: 'sqlite' (default), 'file', atau 'cookie' (session Flask bawaan).
+SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'sqlite')
+
+# Token di-refresh di background jika akan kedaluwarsa dalam sekian detik.
+TOKEN_REFRESH_AHEAD_SECONDS = int(os.environ.get('TOKEN_REFRESH_AHEAD_SECONDS', 900))
+
+# Interval (detik) pengecekan token oleh thread refresh background.
+TOKEN_REFRESH_CHECK_INTERVAL = int(os.environ.get('TOKEN_REFRESH_CHECK_INTERVAL', 60))
+
 # ==============================================================================
 # INISIALISASI APLIKASI FLASK
 # ==============================================================================
@@ -40,6 +127,219 @@ app = Flask(__name__)
 # Kunci rahasia yang kuat untuk mengamankan session. Tidak perlu diubah.
 app.config['SECRET_KEY'] = 'pbkdf2:sha256:600000$V8iLpGcE9aQzRkYw$9a8f3b1e2c7d6e5f4a3b2c1d0e9f8a7b6c5d4e3f2a1b0c9d8e7f6a5b4c3d2e1f'
 
+# ==============================================================================
+# SESSION DI SISI SERVER (COOKIE HANYA BERISI ID SESSION)
+# ==============================================================================
+class ServerSideSession(CallbackDict, SessionMixin):
+    """Session yang isinya disimpan di server; cookie hanya membawa session ID acak."""
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+@contextlib.contextmanager
+def sqlite_connection(path, timeout, **kwargs):
+    """Koneksi SQLite untuk satu blok `with`: commit jika berhasil, rollback jika error, lalu ditutup."""
+    conn = sqlite3.connect(path, timeout=timeout, **kwargs)
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+class SqliteSessionStore:
+    """Penyimpanan session di satu file SQLite (aman dipakai beberapa thread/proses)."""
+
+    def __init__(self, path):
+        self.path = path
+        self.saves = 0
+        self.initialized = False
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        # File dan tabel baru dibuat saat session pertama dibaca/disimpan, bukan saat modul diimpor
+        with self.lock:
+            if not self.initialized:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with sqlite_connection(self.path, 10) as conn:
+                    conn.execute("CREATE TABLE IF NOT EXISTS sessions (sid TEXT PRIMARY KEY, data TEXT NOT NULL, expires INTEGER NOT NULL)")
+                self.initialized = True
+        return sqlite_connection(self.path, 10)
+
+    def load(self, sid):
+        with self._connect() as conn:
+            row = conn.execute("SELECT data FROM sessions WHERE sid = ? AND expires > ?", (sid, int(time.time()))).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, sid, data, expires):
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO sessions (sid, data, expires) VALUES (?, ?, ?)",
+                         (sid, json.dumps(data, default=str), int(expires)))
+            self.saves += 1
+            if self.saves % 100 == 0:
+                conn.execute("DELETE FROM sessions WHERE expires <= ?", (int(time.time()),))
+
+    def delete(self, sid):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+
+class FileSessionStore:
+    """Penyimpanan session sebagai satu file JSON per session ID."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, sid):
+        return os.path.join(self.directory, f"{sid}.json")
+
+    def load(self, sid):
+        try:
+            with open(self._path(sid), 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        return stored['data'] if stored.get('expires', 0) > time.time() else None
+
+    def save(self, sid, data, expires):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f"{self._path(sid)}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'data': data, 'expires': int(expires)}, f, default=str)
+        os.replace(tmp_path, self._path(sid))
+
+    def delete(self, sid):
+        try:
+            os.remove(self._path(sid))
+        except FileNotFoundError:
+            pass
+
+class ServerSideSessionInterface(SessionInterface):
+    """SessionInterface Flask yang menyimpan isi session di store (SQLite/file)."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        # Hanya terima ID yang formatnya sesuai (juga mencegah path traversal di FileSessionStore)
+        if sid and len(sid) == 43 and sid.replace('-', '').replace('_', '').isalnum():
+            data = self.store.load(sid)
+            if data is not None:
+                return ServerSideSession(data, sid=sid)
+        return ServerSideSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        cookie_name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(cookie_name, domain=domain, path=path)
+            return
+        if not session.modified and not self.should_set_cookie(app, session):
+            return
+        expires = self.get_expiration_time(app, session)
+        store_expires = expires.timestamp() if expires else time.time() + app.permanent_session_lifetime.total_seconds()
+        self.store.save(session.sid, dict(session), store_expires)
+        response.set_cookie(
+            cookie_name, session.sid, expires=expires, httponly=self.get_cookie_httponly(app),
+            domain=domain, path=path, secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app)
+        )
+
+if SESSION_BACKEND == 'sqlite':
+    app.session_interface = ServerSideSessionInterface(SqliteSessionStore(os.path.join(DATA_DIR, 'sessions.sqlite3')))
+elif SESSION_BACKEND == 'file':
+    app.session_interface = ServerSideSessionInterface(FileSessionStore(os.path.join(DATA_DIR, 'sessions')))
+
+# ==============================================================================
+# RATE LIMITER GLOBAL & WORKER POOL EXPORT
+# ==============================================================================
+class RateLimiter:
+    """Token bucket thread-safe untuk membatasi jumlah request per detik."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Tunggu sampai ada jatah request, lalu ambil satu."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+    def try_acquire(self):
+        """Ambil satu jatah jika tersedia tanpa menunggu. True jika berhasil."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    def refund(self):
+        """Kembalikan satu jatah yang sudah diambil tapi tidak jadi dipakai."""
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + 1)
+
+shopee_rate_limiter = RateLimiter(SHOPEE_MAX_REQUESTS_PER_SECOND)
+
+class RequestCoalescer:
+    """
+    Single-flight: panggilan identik yang sedang berjalan bersamaan hanya dikirim sekali,
+    pemanggil lain menunggu dan menerima salinan hasilnya.
+    """
+
+    def __init__(self):
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.shared_calls = 0
+
+    def run(self, key, fn):
+        with self.lock:
+            future = self.in_flight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = concurrent.futures.Future()
+                self.in_flight[key] = future
+            else:
+                self.shared_calls += 1
+        if not is_leader:
+            # Salin supaya pemanggil tidak saling mengubah dict hasil yang sama
+            return copy.deepcopy(future.result())
+        try:
+            result = fn()
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+
+shopee_request_coalescer = RequestCoalescer()
+
+# Pool bersama untuk sub-job export (dipakai export multi-toko)
+export_worker_pool = concurrent.futures.ThreadPoolExecutor(max_workers=EXPORT_WORKER_COUNT, thread_name_prefix='export')
+
 # ==============================================================================
 # FUNGSI HELPER UNTUK API SHOPEE
 # ==============================================================================
@@ -55,6 +355,10 @@ def generate_signature(path, timestamp, access_token=None, shop_id=None):
     base_string = "".join(base_string_parts)
     return hmac.new(PARTNER_KEY.encode('utf-8'), base_string.encode('utf-8'), hashlib.sha256).hexdigest()
 
+def generate_push_signature(url, body):
+    """Signature push notification Shopee: HMAC-SHA256 PARTNER_KEY atas "url|body"."""
+    return hmac.new(PARTNER_KEY.encode('utf-8'), f"{url}|{body}".encode('utf-8'), hashlib.sha256).hexdigest()
+
 def refresh_shopee_token(shop_id, refresh_token):
     app.logger.info(f"Attempting to refresh token for shop_id: {shop_id}")
     path_refresh = "/api/v2/auth/access_token/get"
@@ -68,13 +372,14 @@ def refresh_shopee_token(shop_id, refresh_token):
     headers = {'Content-Type': 'application/json'}
 
     try:
+        shopee_rate_limiter.acquire()
         response = requests.post(full_url, params=params, json=body_refresh, headers=headers, timeout=30)
         response.raise_for_status()
         response_data = response.json()
         
         if response_data.get("error"):
             app.logger.error(f"Shopee API Token Refresh Error: {response_data.get('message', 'Unknown error')}")
-            return None, response_data.get('message', 'Unknown error')
+            return None, None, None, response_data.get('message', 'Unknown error')
         
         new_access_token = response_data.get('access_token')
         new_refresh_token = response_data.get('refresh_token')
@@ -89,32 +394,432 @@ def refresh_shopee_token(shop_id, refresh_token):
 
     except requests.exceptions.RequestException as e:
         app.logger.error(f"Network error during token refresh for shop_id {shop_id}: {e}")
-        return None, f"Network error during token refresh: {e}"
+        return None, None, None, f"Network error during token refresh: {e}"
     except Exception as e:
         app.logger.error(f"Unexpected error during token refresh for shop_id {shop_id}: {e}")
-        return None, f"Unexpected error during token refresh: {e}"
+        return None, None, None, f"Unexpected error during token refresh: {e}"
+
+# ==============================================================================
+# TOKEN MANAGER PER TOKO
+# ==============================================================================
+TOKEN_STORE_FILE = os.path.join(DATA_DIR, 'shop_tokens.json')
+
+class ShopTokenManager:
+    """
+    Penyimpan token per toko yang thread-safe. Refresh dilakukan single-flight (satu refresh per
+    toko walau banyak thread meminta bersamaan) dan token disimpan ke disk supaya bisa dipakai
+    proses lain (worker, CLI).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tokens = {}
+        self.lock = threading.Lock()
+        self.refresh_locks = collections.defaultdict(threading.Lock)
+        self.loaded_mtime = None
+        self.background_thread = None
+
+    def _reload(self):
+        """Baca ulang file token jika diubah proses lain. Harus dipanggil dengan lock dipegang."""
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime == self.loaded_mtime:
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+        except (ValueError, OSError) as e:
+            app.logger.warning(f"Could not load token store: {e}")
+            return
+        self.loaded_mtime = mtime
+        for shop_id, token in stored.items():
+            # Ambil token yang paling baru (expire paling lama) antara memori dan disk
+            if token.get('expire_in', 0) >= self.tokens.get(shop_id, {}).get('expire_in', 0):
+                self.tokens[shop_id] = token
+
+    def _save(self):
+        """Simpan semua token ke disk. Harus dipanggil dengan lock dipegang."""
+        try:
+            os.makedirs(DATA_DIR, exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.tokens, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+            self.loaded_mtime = os.path.getmtime(self.path)
+        except OSError as e:
+            app.logger.warning(f"Could not save token store: {e}")
+
+    def register(self, shop_id, access_token, refresh_token, expire_in, shop_name=None):
+        """Simpan token baru untuk satu toko (expire_in = timestamp absolut)."""
+        with self.lock:
+            self._reload()
+            token = self.tokens.get(str(shop_id), {})
+            token.update({'access_token': access_token, 'refresh_token': refresh_token, 'expire_in': int(expire_in)})
+            if shop_name:
+                token['shop_name'] = shop_name
+            self.tokens[str(shop_id)] = token
+            self._save()
+        self.start_background_refresh()
+
+    def set_shop_name(self, shop_id, shop_name):
+        """Perbarui nama toko yang tersimpan bersama token."""
+        with self.lock:
+            self._reload()
+            if str(shop_id) in self.tokens:
+                self.tokens[str(shop_id)]['shop_name'] = shop_name
+                self._save()
+
+    def get_token(self, shop_id):
+        """Salinan data token satu toko (None jika belum terdaftar)."""
+        with self.lock:
+            self._reload()
+            token = self.tokens.get(str(shop_id))
+            return dict(token) if token else None
+
+    def get_all_tokens(self):
+        with self.lock:
+            self._reload()
+            return {shop_id: dict(token) for shop_id, token in self.tokens.items()}
+
+    def get_access_token(self, shop_id, fallback=None):
+        """
+        Kembalikan (access_token, error) terkini untuk toko. Token yang akan kedaluwarsa dalam
+        5 menit di-refresh dulu. Toko yang belum terdaftar memakai token fallback.
+        """
+        token = self.get_token(shop_id)
+        if not token:
+            return fallback, None
+        self.start_background_refresh()
+        if token['expire_in'] <= int(time.time()) + 300:
+            return self.refresh(shop_id, min_valid_seconds=300)
+        return token['access_token'], None
+
+    def refresh(self, shop_id, min_valid_seconds=0, rejected_token=None):
+        """
+        Refresh token satu toko jika masa berlakunya kurang dari min_valid_seconds atau token
+        saat ini sama dengan rejected_token (ditolak Shopee). Hanya satu thread yang benar-benar
+        memanggil API; thread lain menunggu lalu memakai token hasil refresh tersebut.
+        """
+        shop_key = str(shop_id)
+        with self.lock:
+            refresh_lock = self.refresh_locks[shop_key]
+        with refresh_lock:
+            process_lock = self._acquire_process_lock()
+            try:
+                token = self.get_token(shop_key)
+                if not token:
+                    return None, f"Token untuk toko {shop_key} tidak ditemukan."
+                # Bisa saja sudah di-refresh oleh thread/proses lain selagi menunggu lock
+                if token['access_token'] != rejected_token and token['expire_in'] > int(time.time()) + min_valid_seconds:
+                    return token['access_token'], None
+                new_access_token, new_refresh_token, new_expire_in, refresh_error = refresh_shopee_token(shop_key, token['refresh_token'])
+                if refresh_error:
+                    app.logger.error(f"Failed to refresh token for shop {shop_key}: {refresh_error}")
+                    return None, f"Failed to refresh token: {refresh_error}"
+                self.register(shop_key, new_access_token, new_refresh_token, int(time.time()) + new_expire_in)
+                app.logger.info(f"Token refreshed for shop {shop_key}")
+                return new_access_token, None
+            finally:
+                if process_lock:
+                    process_lock.close() # Menutup file juga melepas flock
+
+    def _acquire_process_lock(self):
+        """Lock file supaya proses lain (worker, CLI) tidak me-refresh token yang sama bersamaan."""
+        if fcntl is None:
+            return None
+        try:
+            os.makedirs(DATA_DIR, exist_ok=True)
+            lock_file = open(f"{self.path}.lock", 'w')
+        except OSError as e:
+            app.logger.warning(f"Could not open token lock file: {e}")
+            return None
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def refresh_expiring(self, ahead_seconds=TOKEN_REFRESH_AHEAD_SECONDS):
+        """Refresh semua token yang akan kedaluwarsa dalam ahead_seconds."""
+        deadline = int(time.time()) + ahead_seconds
+        for shop_id, token in self.get_all_tokens().items():
+            if token.get('refresh_token') and token.get('expire_in', 0) <= deadline:
+                self.refresh(shop_id, min_valid_seconds=ahead_seconds)
+
+    def start_background_refresh(self):
+        """Jalankan thread daemon yang me-refresh token sebelum kedaluwarsa (sekali per proses)."""
+        with self.lock:
+            if self.background_thread and self.background_thread.is_alive():
+                return
+            self.background_thread = threading.Thread(target=self._background_loop, name='token-refresh', daemon=True)
+            self.background_thread.start()
+
+    def _background_loop(self):
+        while True:
+            try:
+                self.refresh_expiring()
+            except Exception as e:
+                app.logger.error(f"Background token refresh error: {e}")
+            time.sleep(TOKEN_REFRESH_CHECK_INTERVAL)
+
+shop_token_manager = ShopTokenManager(TOKEN_STORE_FILE)
+
+def sync_session_tokens(shops):
+    """Salin token terbaru dari token manager ke data toko di session. True jika ada yang berubah."""
+    changed = False
+    for shop_id, shop in shops.items():
+        token = shop_token_manager.get_token(shop_id)
+        if not token and shop.get('refresh_token'):
+            # Toko dari session lama yang belum tercatat di token manager
+            shop_token_manager.register(shop_id, shop['access_token'], shop['refresh_token'],
+                                        shop.get('expire_in', 0), shop_name=shop.get('shop_name'))
+        elif token and token['access_token'] != shop.get('access_token'):
+            shop.update({
+                'access_token': token['access_token'],
+                'refresh_token': token['refresh_token'],
+                'expire_in': token['expire_in']
+            })
+            changed = True
+    return changed
+
+# ==============================================================================
+# KEBIJAKAN RETRY (KLASIFIKASI ERROR, BACKOFF, JATAH RETRY)
+# ==============================================================================
+RETRY_RETRYABLE = 'retryable'
+RETRY_THROTTLED = 'throttled'
+RETRY_FATAL = 'fatal'
+
+# Kode error Shopee yang bersifat sementara (server sibuk/gangguan internal)
+SHOPEE_RETRYABLE_ERRORS = {'error_server', 'error_inner', 'error_busy', 'error_system_busy', 'error_network', 'error_timeout'}
+SHOPEE_THROTTLED_ERRORS = {'error_too_many_request', 'error_rate_limit', 'error_frequency_limit'}
+
+def classify_http_status(status_code):
+    """Klasifikasi status HTTP error: 429 throttled, 408/5xx retryable, 4xx lainnya fatal."""
+    if status_code == 429:
+        return RETRY_THROTTLED
+    if status_code == 408 or status_code >= 500:
+        return RETRY_RETRYABLE
+    return RETRY_FATAL
+
+def classify_shopee_error(error_code, message=None):
+    """Klasifikasi payload error Shopee berdasarkan kode error (dan pesannya)."""
+    error_code = (error_code or '').lower()
+    message = (message or '').lower()
+    if error_code in SHOPEE_THROTTLED_ERRORS or 'too many request' in message or 'rate limit' in message:
+        return RETRY_THROTTLED
+    if error_code in SHOPEE_RETRYABLE_ERRORS or 'system busy' in message or 'try again later' in message:
+        return RETRY_RETRYABLE
+    return RETRY_FATAL
+
+def classify_request_exception(exc):
+    """Timeout dan gangguan koneksi bisa diulang; error request lain (URL salah, dsb.) tidak."""
+    if isinstance(exc, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)):
+        return RETRY_RETRYABLE
+    return RETRY_FATAL
+
+def parse_retry_after(value):
+    """Ubah header Retry-After (detik atau tanggal HTTP) jadi detik; None jika tidak valid."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def retry_backoff_delay(attempt, retry_after=None):
+    """Jeda sebelum retry: ikuti Retry-After jika ada, selain itu exponential backoff dengan jitter penuh."""
+    if retry_after is not None:
+        return min(RETRY_MAX_DELAY, retry_after)
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt)))
+
+class RetryBudget:
+    """
+    Jatah retry per toko (token bucket). Setiap endpoint hanya boleh memakai separuh jatah
+    toko, jadi satu endpoint yang terus gagal tidak menghabiskan retry endpoint lain.
+    """
+
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.exhausted = collections.Counter()
+
+    def _bucket(self, key, capacity):
+        """Bucket untuk key (toko atau (toko, endpoint)). Lock harus dipegang."""
+        if key not in self.buckets:
+            self.buckets[key] = RateLimiter(self.per_minute / 60.0, burst=max(1.0, capacity))
+        return self.buckets[key]
+
+    def try_spend(self, shop_id, path):
+        """
+        Ambil satu jatah retry untuk (toko, endpoint): jatah endpoint dan jatah toko diambil
+        bersama atau tidak sama sekali. False jika salah satunya habis.
+        """
+        shop_key = str(shop_id or 'global')
+        with self.lock:
+            endpoint_bucket = self._bucket((shop_key, path), self.per_minute / 2)
+            shop_bucket = self._bucket(shop_key, self.per_minute)
+            if endpoint_bucket.try_acquire():
+                if shop_bucket.try_acquire():
+                    return True
+                endpoint_bucket.refund() # Ditolak jatah toko: jatah endpoint tidak ikut terpakai
+            self.exhausted[(shop_key, path)] += 1
+            return False
+
+shopee_retry_budget = RetryBudget(RETRY_BUDGET_PER_MINUTE)
+
+# ==============================================================================
+# CIRCUIT BREAKER PER (TOKO, ENDPOINT)
+# ==============================================================================
+class CircuitBreakerRegistry:
+    """
+    Circuit breaker per (toko, endpoint). Setelah CIRCUIT_BREAKER_FAILURE_THRESHOLD kegagalan
+    identik berturut-turut breaker terbuka dan panggilan langsung gagal tanpa memakai jatah
+    request. Setelah cooldown satu panggilan probe diizinkan; sukses menutup breaker lagi.
+    """
+
+    def __init__(self, failure_threshold, cooldown):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.circuits = {}
+        self.lock = threading.Lock()
+
+    def _circuit(self, shop_id, path):
+        key = (str(shop_id), path)
+        if key not in self.circuits:
+            self.circuits[key] = {'state': 'closed', 'failures': 0, 'last_error': None, 'opened_at': 0.0, 'probing': False}
+        return self.circuits[key]
+
+    def allow(self, shop_id, path):
+        """(True, None) jika panggilan boleh dikirim, atau (False, pesan error) saat breaker terbuka."""
+        with self.lock:
+            circuit = self._circuit(shop_id, path)
+            if circuit['state'] == 'closed':
+                return True, None
+            if circuit['state'] == 'open' and time.monotonic() - circuit['opened_at'] >= self.cooldown:
+                circuit['state'] = 'half_open'
+            if circuit['state'] == 'half_open' and not circuit['probing']:
+                circuit['probing'] = True
+                return True, None
+            return False, f"Circuit breaker terbuka untuk {path}: {circuit['last_error']}"
+
+    def is_open(self, shop_id, path):
+        """True jika panggilan ke endpoint ini sedang diblok (dipakai untuk melewati tahap opsional)."""
+        with self.lock:
+            circuit = self.circuits.get((str(shop_id), path))
+            return bool(circuit) and circuit['state'] == 'open' and time.monotonic() - circuit['opened_at'] < self.cooldown
 
-def call_shopee_api(path, method='POST', shop_id=None, access_token=None, body=None, max_retries=3, export_id=None):
-    """Fungsi generik untuk memanggil semua endpoint Shopee API v2 dengan rate limiting dan retry."""
+    def record(self, shop_id, path, error=None):
+        """Catat hasil panggilan: error=None berarti endpoint merespons dengan normal."""
+        with self.lock:
+            circuit = self._circuit(shop_id, path)
+            circuit['probing'] = False
+            if error is None:
+                circuit.update({'state': 'closed', 'failures': 0, 'last_error': None})
+                return
+            # Kegagalan dianggap identik jika pesannya sama (tanpa request ID)
+            signature = error.split(' (Req ID')[0]
+            circuit['failures'] = circuit['failures'] + 1 if signature == circuit['last_error'] else 1
+            circuit['last_error'] = signature
+            if circuit['state'] == 'half_open' or circuit['failures'] >= self.failure_threshold:
+                if circuit['state'] != 'open':
+                    app.logger.warning(f"Circuit breaker opened for shop {shop_id} {path}: {signature}")
+                circuit['state'] = 'open'
+                circuit['opened_at'] = time.monotonic()
+
+    def release_probe(self, shop_id, path):
+        """Lepas probe tanpa mengubah status (hasil panggilan tidak menunjukkan sehat/gagal)."""
+        with self.lock:
+            self._circuit(shop_id, path)['probing'] = False
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                f"{shop_id} {path}": {'state': circuit['state'], 'failures': circuit['failures'], 'last_error': circuit['last_error']}
+                for (shop_id, path), circuit in self.circuits.items() if circuit['state'] != 'closed' or circuit['failures']
+            }
+
+shopee_circuit_breakers = CircuitBreakerRegistry(CIRCUIT_BREAKER_FAILURE_THRESHOLD, CIRCUIT_BREAKER_COOLDOWN)
+
+def call_shopee_api(path, method='POST', shop_id=None, access_token=None, body=None, max_retries=3, export_id=None, coalesce=True):
+    """
+    Fungsi generik untuk memanggil semua endpoint Shopee API v2 dengan rate limiting dan retry.
+    Request identik (shop_id, path, parameter) yang sedang berjalan digabung jadi satu panggilan
+    kecuali coalesce=False.
+    """
     
     current_access_token = access_token
     
-    # Check and refresh token if necessary
-    if shop_id and current_access_token and export_id and export_id in export_progress_store:
-        shop_data = export_progress_store[export_id]
-        if shop_data and shop_data.get('expire_in') and shop_data['expire_in'] <= int(time.time()) + 300: # Refresh if expires in next 5 minutes or already expired
-            app.logger.info(f"Access token for shop {shop_id} is expiring soon or expired. Attempting refresh.")
-            new_access_token, new_refresh_token, new_expire_in, refresh_error = refresh_shopee_token(shop_id, shop_data['refresh_token'])
-            if refresh_error:
-                app.logger.error(f"Failed to refresh token for shop {shop_id}: {refresh_error}")
-                return None, f"Failed to refresh token: {refresh_error}"
-            current_access_token = new_access_token
-            # Update global store with new tokens
-            export_progress_store[export_id]['access_token'] = new_access_token
-            export_progress_store[export_id]['refresh_token'] = new_refresh_token
-            export_progress_store[export_id]['expire_in'] = int(time.time()) + new_expire_in
-            app.logger.info(f"Updated token in export_progress_store for shop {shop_id}")
-            
+    # Selalu pakai token terkini dari token manager (refresh otomatis jika hampir kedaluwarsa)
+    if shop_id and current_access_token:
+        current_access_token, token_error = shop_token_manager.get_access_token(shop_id, fallback=access_token)
+        if token_error:
+            return None, token_error
+
+    result = _call_shopee_api_once(path, method, shop_id, current_access_token, body, max_retries, coalesce)
+    if result[1] and shop_id and _is_invalid_token_error(result[1]) and shop_token_manager.get_token(shop_id):
+        # Token ditolak walau belum kedaluwarsa menurut catatan kita: paksa refresh lalu ulangi sekali
+        current_access_token, token_error = shop_token_manager.refresh(shop_id, rejected_token=current_access_token)
+        if token_error:
+            return None, token_error
+        result = _call_shopee_api_once(path, method, shop_id, current_access_token, body, max_retries, coalesce)
+    return result
+
+def _is_invalid_token_error(error_msg):
+    error_msg = error_msg.lower()
+    return 'access_token' in error_msg and ('invalid' in error_msg or 'expired' in error_msg)
+
+# Pesan error Shopee yang menandakan endpoint tidak bisa dipakai toko ini (izin/fitur belum aktif)
+SHOPEE_PERMISSION_ERROR_MARKERS = ('permission', 'not enabled', 'not enable', 'not authorized', 'unauthorized', 'forbidden')
+
+def _is_endpoint_failure(error_msg):
+    """
+    True jika error menunjukkan endpoint bermasalah (gangguan jaringan, HTTP 5xx/408/429/401/403,
+    throttle, server sibuk, atau izin/fitur tidak aktif). Error per data seperti "tracking number
+    not exist" atau "return not found" berarti endpoint sehat dan tidak dihitung circuit breaker.
+    """
+    if not error_msg.startswith("Shopee API Error:"):
+        if error_msg.startswith("Kesalahan Jaringan: HTTP "):
+            status_code = int(error_msg.split("HTTP ")[1].split()[0])
+            return status_code in (401, 403, 408, 429) or status_code >= 500
+        return True # Timeout/koneksi, respons tidak terbaca, atau retry habis
+    message = error_msg[len("Shopee API Error:"):].split(' (Req ID')[0].lower()
+    return (classify_shopee_error(None, message) != RETRY_FATAL
+            or any(marker in message for marker in SHOPEE_PERMISSION_ERROR_MARKERS))
+
+def _call_shopee_api_once(path, method, shop_id, current_access_token, body, max_retries, coalesce):
+    """Kirim request, digabung dengan request identik yang sedang berjalan jika coalesce."""
+    if coalesce and shop_id:
+        request_key = (str(shop_id), path, method.upper(), json.dumps(body or {}, sort_keys=True, default=str))
+        return shopee_request_coalescer.run(
+            request_key,
+            lambda: _send_with_circuit_breaker(path, method, shop_id, current_access_token, body, max_retries)
+        )
+    return _send_with_circuit_breaker(path, method, shop_id, current_access_token, body, max_retries)
+
+def _send_with_circuit_breaker(path, method, shop_id, current_access_token, body, max_retries):
+    """Kirim request lewat circuit breaker (toko, endpoint); gagal cepat jika breaker terbuka."""
+    if not shop_id:
+        return _send_shopee_request(path, method, shop_id, current_access_token, body, max_retries)
+    allowed, breaker_error = shopee_circuit_breakers.allow(shop_id, path)
+    if not allowed:
+        return None, breaker_error
+    result = _send_shopee_request(path, method, shop_id, current_access_token, body, max_retries)
+    error = result[1]
+    if error and _is_invalid_token_error(error):
+        shopee_circuit_breakers.release_probe(shop_id, path) # Masalah token, bukan endpoint
+    elif error and (_is_size_error(path, error) or not _is_endpoint_failure(error)):
+        # Endpoint sehat: hanya ukuran yang ditolak, atau error untuk data tertentu saja
+        shopee_circuit_breakers.record(shop_id, path)
+    else:
+        shopee_circuit_breakers.record(shop_id, path, error)
+    return result
+
+def _send_shopee_request(path, method, shop_id, current_access_token, body, max_retries):
+    """Kirim satu request API (dengan retry) tanpa penggabungan."""
     timestamp = int(time.time())
     
     if not all([PARTNER_ID, PARTNER_KEY not in ["", "GANTI_DENGAN_PARTNER_KEY_ANDA"]]):
@@ -135,205 +840,800 @@ def call_shopee_api(path, method='POST', shop_id=None, access_token=None, body=N
 
     start_time = time.time() # Start timer
 
-    # Retry mechanism with exponential backoff
+    # Retry sesuai kebijakan: hanya error retryable/throttled, dengan backoff dan jatah retry per toko
+    limiter = get_concurrency_limiter(path, shop_id) if path in ENDPOINT_DEFAULTS else None
     for attempt in range(max_retries):
+        retry_after = None
+        outcome = 'error'
         try:
             response = None
-            if method.upper() == 'POST':
-                response = requests.post(full_url, params=params, json=body, headers=headers, timeout=30)
-            else:
-                response = requests.get(full_url, params={**params, **(body or {})}, headers=headers, timeout=30)
+            if limiter:
+                limiter.acquire()
+            shopee_rate_limiter.acquire()
+            attempt_start = time.time()
+            try:
+                if method.upper() == 'POST':
+                    response = requests.post(full_url, params=params, json=body, headers=headers, timeout=30)
+                else:
+                    response = requests.get(full_url, params={**params, **(body or {})}, headers=headers, timeout=30)
+                outcome = 'throttled' if response.status_code == 429 else ('ok' if response.status_code < 400 else 'error')
+                if outcome == 'ok':
+                    # Latensi HTTP saja (tanpa antre di limiter), dipakai sebagai ambang hedging
+                    endpoint_latency_tracker.record(path, time.time() - attempt_start)
+            except requests.exceptions.Timeout:
+                outcome = 'timeout'
+                raise
+            finally:
+                if limiter:
+                    limiter.release(time.time() - attempt_start, outcome)
             
             end_time = time.time() # End timer
             time_taken = round(end_time - start_time, 3)
             
             app.logger.info(f"API Call: {path}, Method: {method}, Params: {body or {}}, Status: {response.status_code}, Time: {time_taken}s")
 
-            # Handle HTTP 429 Too Many Requests
-            if response.status_code == 429:
-                retry_after = int(response.headers.get('Retry-After', 2 ** attempt))
-                app.logger.warning(f"Rate limit exceeded. Retrying after {retry_after} seconds. Attempt {attempt + 1}/{max_retries}")
+            if response.status_code >= 400:
+                error_class = classify_http_status(response.status_code)
+                error_msg = f"Kesalahan Jaringan: HTTP {response.status_code} untuk {path}"
+                if error_class == RETRY_THROTTLED:
+                    record_endpoint_throttle(path)
+                    retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            else:
+                response_data = response.json()
                 
-                continue
-            
-            response.raise_for_status()
-            response_data = response.json()
-            
-            # Log number of items returned
-            item_count = 0
-            if 'response' in response_data and isinstance(response_data['response'], dict):
-                if 'return' in response_data['response'] and isinstance(response_data['response']['return'], list):
-                    item_count = len(response_data['response']['return'])
-                elif 'failed_delivery_list' in response_data['response'] and isinstance(response_data['response']['failed_delivery_list'], list):
-                    item_count = len(response_data['response']['failed_delivery_list'])
-                elif 'order_list' in response_data['response'] and isinstance(response_data['response']['order_list'], list):
-                    item_count = len(response_data['response']['order_list'])
-            app.logger.info(f"API Response: {path}, Items Returned: {item_count}")
-
-            if response_data.get("error"):
+                # Log number of items returned
+                item_count = 0
+                if 'response' in response_data and isinstance(response_data['response'], dict):
+                    if 'return' in response_data['response'] and isinstance(response_data['response']['return'], list):
+                        item_count = len(response_data['response']['return'])
+                    elif 'failed_delivery_list' in response_data['response'] and isinstance(response_data['response']['failed_delivery_list'], list):
+                        item_count = len(response_data['response']['failed_delivery_list'])
+                    elif 'order_list' in response_data['response'] and isinstance(response_data['response']['order_list'], list):
+                        item_count = len(response_data['response']['order_list'])
+                app.logger.info(f"API Response: {path}, Items Returned: {item_count}")
+
+                if not response_data.get("error"):
+                    record_endpoint_response(path, body, response_data)
+                    return response_data, None
+
                 error_msg = f"Shopee API Error: {response_data.get('message', 'Unknown error')} (Req ID: {response_data.get('request_id')})"
-                app.logger.error(error_msg)
-                return None, error_msg
-                
-            return response_data, None
-            
+                error_class = classify_shopee_error(response_data.get('error'), response_data.get('message'))
+                if error_class == RETRY_THROTTLED:
+                    record_endpoint_throttle(path)
+                    if limiter:
+                        limiter.record_throttle()
+                elif error_class == RETRY_FATAL:
+                    app.logger.error(error_msg)
+                    record_endpoint_error(path, body, error_msg)
+                    return None, error_msg
+
         except requests.exceptions.RequestException as e:
-            if attempt == max_retries - 1:  # Last attempt
-                error_msg = f"Kesalahan Jaringan: {e}"
-                app.logger.error(error_msg)
-                return None, error_msg
-            else:
-                # Exponential backoff: 1s, 2s, 4s
-                backoff_time = 2 ** attempt
-                app.logger.warning(f"Request failed, retrying in {backoff_time} seconds. Attempt {attempt + 1}/{max_retries}")
-                
-                continue
+            error_class = classify_request_exception(e)
+            error_msg = f"Kesalahan Jaringan: {e}"
         except Exception as e:
             error_msg = f"Terjadi kesalahan tak terduga: {e}"
             app.logger.error(error_msg)
             return None, error_msg
+
+        if error_class == RETRY_FATAL or attempt == max_retries - 1:
+            app.logger.error(error_msg)
+            return None, error_msg
+        if not shopee_retry_budget.try_spend(shop_id, path):
+            app.logger.error(f"Retry budget exhausted for shop {shop_id} ({path}): {error_msg}")
+            return None, error_msg
+        backoff_time = retry_backoff_delay(attempt, retry_after)
+        app.logger.warning(f"{error_msg} [{error_class}]. Retrying in {backoff_time:.2f} seconds. Attempt {attempt + 1}/{max_retries}")
+        time.sleep(backoff_time)
     
     return None, "Max retries exceeded"
 
 # ==============================================================================
-# RUTE-RUTE (HALAMAN) APLIKASI
+# PROFIL KAPABILITAS ENDPOINT (PAGE SIZE, BATCH SIZE, CONCURRENCY)
 # ==============================================================================
-@app.route('/')
-def dashboard():
-    """Menampilkan halaman utama dengan daftar toko dari session."""
-    shops = session.get('shops', {})
-    
-    today = datetime.now()
-    date_to_default = today.strftime('%Y-%m-%d')
-    date_from_default = (today - timedelta(days=7)).strftime('%Y-%m-%d')
+ENDPOINT_PROFILES_FILE = os.path.join(DATA_DIR, 'endpoint_profiles.json')
 
-    return render_template(
-        'dashboard.html', 
-        shops=shops, 
-        date_from=date_from_default, 
-        date_to=date_to_default
-    )
+# Nilai awal per endpoint sebelum ada hasil pengukuran.
+# size_field: field di body yang menentukan ukuran halaman/batch
+# size: ukuran awal yang aman, paging: cara paginasi, list_key: key list di response
+ENDPOINT_DEFAULTS = {
+    "/api/v2/returns/get_return_list": {
+        "size_field": "page_size", "size": 50, "paging": "page_no", "list_key": "return",
+        "concurrency": 1, "max_concurrency": 4
+    },
+    "/api/v2/order/get_order_list": {
+        "size_field": "page_size", "size": 100, "paging": "cursor", "list_key": "order_list",
+        "concurrency": 1, "max_concurrency": 4
+    },
+    "/api/v2/logistics/get_failed_delivery_list": {
+        "size_field": "page_size", "size": 50, "paging": "cursor", "list_key": "failed_delivery_list",
+        "concurrency": 1, "max_concurrency": 4
+    },
+    "/api/v2/order/get_order_detail": {
+        "size_field": "order_sn_list", "size": 50, "list_key": "order_list",
+        "concurrency": 5, "max_concurrency": 10
+    },
+    "/api/v2/logistics/get_tracking_number": {
+        "concurrency": 5, "max_concurrency": 10
+    },
+    "/api/v2/product/get_item_list": {
+        "size_field": "page_size", "size": 100, "paging": "offset", "list_key": "item",
+        "concurrency": 1, "max_concurrency": 4
+    },
+    "/api/v2/product/get_item_base_info": {
+        "size_field": "item_id_list", "size": 50, "list_key": "item_list",
+        "concurrency": 3, "max_concurrency": 10
+    },
+    "/api/v2/product/get_model_list": {
+        "concurrency": 5, "max_concurrency": 10
+    },
+    "/api/v2/returns/get_return_detail": {
+        "concurrency": 3, "max_concurrency": 10
+    }
+}
 
-@app.route('/authorize')
-def authorize():
-    """Mengarahkan pengguna ke halaman otorisasi Shopee."""
-    path = "/api/v2/shop/auth_partner"
-    sign = generate_signature(path, int(time.time()))
-    redirect_full_url = f"{REDIRECT_URL_DOMAIN}{url_for('callback')}"
-    
-    auth_url = f"{BASE_URL}{path}?partner_id={PARTNER_ID}&redirect={redirect_full_url}&sign={sign}&timestamp={int(time.time())}"
-    return redirect(auth_url)
+endpoint_profile_store = {}
+endpoint_profile_lock = threading.Lock()
+_endpoint_profiles_loaded = False
 
-@app.route('/callback')
-def callback():
-    """Menangani callback dari Shopee setelah otorisasi."""
-    code = request.args.get('code')
-    shop_id_str = request.args.get('shop_id')
+def _load_endpoint_profiles():
+    """Load profil endpoint dari disk (sekali saja). Harus dipanggil dengan lock dipegang."""
+    global _endpoint_profiles_loaded
+    if _endpoint_profiles_loaded:
+        return
+    _endpoint_profiles_loaded = True
+    try:
+        with open(ENDPOINT_PROFILES_FILE, 'r', encoding='utf-8') as f:
+            endpoint_profile_store.update(json.load(f))
+        app.logger.info(f"Loaded endpoint profiles for {len(endpoint_profile_store)} endpoints")
+    except FileNotFoundError:
+        pass
+    except (ValueError, OSError) as e:
+        app.logger.warning(f"Could not load endpoint profiles: {e}")
 
-    if not code or not shop_id_str:
-        flash("Callback dari Shopee tidak valid.", 'danger')
-        return redirect(url_for('dashboard'))
+def _save_endpoint_profiles():
+    """Simpan profil endpoint ke disk. Harus dipanggil dengan lock dipegang."""
+    try:
+        os.makedirs(DATA_DIR, exist_ok=True)
+        tmp_path = f"{ENDPOINT_PROFILES_FILE}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(endpoint_profile_store, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, ENDPOINT_PROFILES_FILE)
+    except OSError as e:
+        app.logger.warning(f"Could not save endpoint profiles: {e}")
 
-    path_token = "/api/v2/auth/token/get"
-    body_token = {"code": code, "shop_id": int(shop_id_str)}
-    token_data, error = call_shopee_api(path_token, body=body_token)
+def _get_endpoint_profile(path):
+    """Ambil (atau buat) profil untuk satu endpoint. Harus dipanggil dengan lock dipegang."""
+    _load_endpoint_profiles()
+    return endpoint_profile_store.setdefault(path, {})
 
-    if error:
-        flash(f"Gagal mendapatkan token: {error}", 'danger')
-        return redirect(url_for('dashboard'))
+def _requested_size(path, body):
+    """Hitung ukuran halaman/batch yang diminta dari body request."""
+    size_field = ENDPOINT_DEFAULTS.get(path, {}).get('size_field')
+    if not size_field or not body or size_field not in body:
+        return None
+    value = body[size_field]
+    if size_field.endswith('_list'):
+        if isinstance(value, str):
+            return len([v for v in value.split(',') if v])
+        return len(value)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
 
-    access_token = token_data.get('access_token')
-    if not access_token:
-        flash("Respons token dari Shopee tidak lengkap.", 'danger')
-        return redirect(url_for('dashboard'))
+def _is_size_error(path, error_msg):
+    """Cek apakah error dari Shopee disebabkan ukuran halaman/batch yang terlalu besar."""
+    size_field = ENDPOINT_DEFAULTS.get(path, {}).get('size_field')
+    message = str(error_msg or '').lower()
+    if not size_field or 'rate' in message or 'frequen' in message:
+        return False
+    keywords = [size_field.lower(), 'page_size', 'exceed', 'too many', 'too large', 'maximum']
+    return any(keyword in message for keyword in keywords)
 
-    # Get shop name using various methods
-    shop_name = f"Toko {shop_id_str}"  # Default fallback
-    
-    # Method 1: Try get_shop_info
-    try:
-        path_info = "/api/v2/shop/get_shop_info"
-        info_data, error = call_shopee_api(path_info, method='GET', shop_id=int(shop_id_str), access_token=access_token)
-        
-        app.logger.info(f"Shop info API response: {info_data}")
-        app.logger.info(f"Shop info API error: {error}")
-        
-        if error:
-            app.logger.warning(f"Method 1 failed - get_shop_info error: {error}")
-        elif info_data and 'response' in info_data:
-            response_data = info_data.get('response', {})
-            app.logger.info(f"DEBUG: response_data keys: {list(response_data.keys())}")
-            app.logger.info(f"DEBUG: shop_name value: '{response_data.get('shop_name')}'")
-            app.logger.info(f"DEBUG: shop_name type: {type(response_data.get('shop_name'))}")
-            
-            extracted_shop_name = response_data.get('shop_name', '').strip()
-            if extracted_shop_name:
-                shop_name = extracted_shop_name
-                app.logger.info(f"SUCCESS: Found shop name via get_shop_info: '{shop_name}'")
-            else:
-                app.logger.warning(f"Method 1 failed - no valid shop_name in response: {response_data}")
-        else:
-            app.logger.warning(f"Method 1 failed - no response data: {info_data}")
-            
-    except Exception as e:
-        app.logger.error(f"Exception in get_shop_info: {e}")
-    
-    # Method 2: Try get_profile if first method failed
-    if shop_name == f"Toko {shop_id_str}":
-        try:
-            profile_data, profile_error = call_shopee_api("/api/v2/shop/get_profile", method='GET', 
-                                                        shop_id=int(shop_id_str), access_token=access_token)
-            
-            app.logger.info(f"Shop profile API response: {profile_data}")
-            app.logger.info(f"Shop profile API error: {profile_error}")
-            
-            if not profile_error and profile_data and 'response' in profile_data:
-                response_data = profile_data.get('response', {})
-                extracted_shop_name = response_data.get('shop_name', '').strip()
-                if extracted_shop_name:
-                    shop_name = extracted_shop_name
-                    app.logger.info(f"SUCCESS: Found shop name via get_profile: '{shop_name}'")
-                    
-        except Exception as e:
-            app.logger.error(f"Exception in get_profile: {e}")
-    
-    # Final check
-    if shop_name == f"Toko {shop_id_str}":
-        flash(f"Tidak dapat mengambil nama toko. Menggunakan ID sebagai nama: {shop_name}", 'warning')
-        app.logger.warning(f"FAILED: Could not retrieve shop name, using fallback: {shop_name}")
-    else:
-        app.logger.info(f"FINAL: Using shop name: {shop_name}")
+def get_endpoint_size(path):
+    """Ukuran halaman/batch terbesar yang diketahui aman untuk endpoint ini."""
+    defaults = ENDPOINT_DEFAULTS.get(path, {})
+    with endpoint_profile_lock:
+        profile = dict(_get_endpoint_profile(path))
+    size = profile.get('accepted_size') or defaults.get('size')
+    if not size:
+        return None
+    if profile.get('server_cap'):
+        size = min(size, profile['server_cap'])
+    if profile.get('rejected_size'):
+        size = min(size, profile['rejected_size'] - 1)
+    return max(1, size)
 
-    shops = session.get('shops', {})
-    shops[shop_id_str] = {
-        'shop_id': shop_id_str,
-        'shop_name': shop_name,
-        'access_token': access_token,
-        'refresh_token': token_data.get('refresh_token'),
-        'expire_in': int(time.time()) + token_data.get('expire_in', 14400)
-    }
-    session['shops'] = shops
-    session.modified = True
+def get_endpoint_concurrency(path):
+    """Jumlah panggilan paralel terbaik yang diketahui untuk endpoint ini."""
+    defaults = ENDPOINT_DEFAULTS.get(path, {})
+    with endpoint_profile_lock:
+        concurrency = _get_endpoint_profile(path).get('concurrency')
+    return max(1, concurrency or defaults.get('concurrency', 1))
 
-    flash(f"Toko '{shop_name}' berhasil dihubungkan.", 'success')
-    return redirect(url_for('dashboard'))
-    
-@app.route('/clear_session')
-def clear_session():
-    """Menghapus semua data dari session untuk memulai dari awal."""
-    session.clear()
-    flash('Semua data sesi dan toko terhubung telah dihapus.', 'info')
-    return redirect(url_for('dashboard'))
+def get_endpoint_throttle_count(path):
+    """Jumlah respons 429 yang pernah tercatat untuk endpoint ini."""
+    with endpoint_profile_lock:
+        return _get_endpoint_profile(path).get('throttle_count', 0)
 
-@app.route('/clear_temp_data')
-def clear_temp_data():
-    """Menghapus data sementara export (export_progress_store) tanpa menghapus session."""
-    global export_progress_store
-    
+def record_endpoint_response(path, body, response_data):
+    """Catat respons sukses dari traffic live/probe untuk memperbarui profil ukuran."""
+    defaults = ENDPOINT_DEFAULTS.get(path)
+    size = _requested_size(path, body)
+    if not defaults or not size:
+        return
+    data = response_data.get('response') or {}
+    items = data.get(defaults.get('list_key'), []) if isinstance(data, dict) else []
+    has_more = bool(data.get('more') or data.get('has_next_page') or data.get('next_cursor')) if isinstance(data, dict) else False
+
+    with endpoint_profile_lock:
+        profile = _get_endpoint_profile(path)
+        changed = False
+        if size > (profile.get('accepted_size') or 0):
+            profile['accepted_size'] = size
+            changed = True
+        if profile.get('rejected_size') and size >= profile['rejected_size']:
+            profile.pop('rejected_size')
+            changed = True
+        # Shopee kadang memotong page_size diam-diam: halaman penuh lebih kecil dari
+        # yang diminta padahal masih ada halaman berikutnya.
+        if defaults.get('paging') and has_more and isinstance(items, list) and 0 < len(items) < size:
+            if profile.get('server_cap') != len(items):
+                profile['server_cap'] = len(items)
+                changed = True
+        if changed:
+            profile['updated_at'] = int(time.time())
+            _save_endpoint_profiles()
+
+def record_endpoint_error(path, body, error_msg):
+    """Catat error dari Shopee; jika karena ukuran terlalu besar, turunkan batas ukuran."""
+    size = _requested_size(path, body)
+    if not size or not _is_size_error(path, error_msg):
+        return
+    with endpoint_profile_lock:
+        profile = _get_endpoint_profile(path)
+        if profile.get('rejected_size') and profile['rejected_size'] <= size:
+            return
+        profile['rejected_size'] = size
+        if profile.get('accepted_size') and profile['accepted_size'] >= size:
+            profile.pop('accepted_size')
+        profile['updated_at'] = int(time.time())
+        app.logger.warning(f"Endpoint {path} rejected size {size}, lowering limit")
+        _save_endpoint_profiles()
+
+def record_endpoint_throttle(path):
+    """Catat respons 429 untuk endpoint ini."""
+    with endpoint_profile_lock:
+        profile = _get_endpoint_profile(path)
+        profile['throttle_count'] = profile.get('throttle_count', 0) + 1
+
+def get_endpoint_profiles_snapshot():
+    """Ringkasan profil semua endpoint beserta ukuran dan concurrency yang dipakai saat ini."""
+    snapshot = {}
+    for path in ENDPOINT_DEFAULTS:
+        with endpoint_profile_lock:
+            profile = dict(_get_endpoint_profile(path))
+        profile['current_size'] = get_endpoint_size(path)
+        with concurrency_limiters_lock:
+            limits = [limiter.current_limit for (_, limiter_path), limiter in concurrency_limiters.items()
+                      if limiter_path == path]
+        # Batas tertinggi di antara toko yang sudah memakai endpoint ini
+        profile['current_concurrency'] = max(limits) if limits else get_endpoint_concurrency(path)
+        snapshot[path] = profile
+    return snapshot
+
+# ==============================================================================
+# LIMITER CONCURRENCY ADAPTIF (AIMD)
+# ==============================================================================
+# Latensi dianggap melonjak jika rata-rata terbaru melebihi baseline sebesar faktor ini
+CONCURRENCY_LATENCY_SPIKE_FACTOR = 2.0
+# Pengali batas concurrency saat kena throttle, timeout, atau lonjakan latensi
+CONCURRENCY_DECREASE_FACTOR = 0.7
+# Batas baru disimpan ke profil endpoint paling sering sekali per sekian detik
+CONCURRENCY_PERSIST_INTERVAL = 30
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Batas jumlah panggilan paralel ke satu endpoint yang menyesuaikan diri (AIMD): naik +1 per
+    "putaran" selama latensi stabil, dikali CONCURRENCY_DECREASE_FACTOR saat kena 429, timeout,
+    atau latensi melonjak.
+    """
+
+    def __init__(self, path, initial_limit, max_limit, min_limit=1):
+        self.path = path
+        self.min_limit = min_limit
+        self.max_limit = max(min_limit, max_limit)
+        self.limit = float(min(max(initial_limit, min_limit), self.max_limit))
+        self.in_flight = 0
+        self.baseline_latency = None
+        self.recent_latency = None
+        self.last_decrease = 0.0
+        self.last_persist = 0.0
+        self.condition = threading.Condition()
+
+    @property
+    def current_limit(self):
+        return int(self.limit)
+
+    def acquire(self):
+        """Tunggu sampai jumlah panggilan yang berjalan di bawah batas saat ini."""
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency=None, outcome='ok'):
+        """
+        Lepas satu slot dan perbarui batas. outcome: 'ok', 'throttled', 'timeout', atau 'error'
+        (error biasa tidak mengubah batas).
+        """
+        with self.condition:
+            self.in_flight -= 1
+            previous_limit = int(self.limit)
+            if outcome in ('throttled', 'timeout'):
+                self._decrease()
+            elif outcome == 'ok' and latency is not None:
+                self.recent_latency = latency if self.recent_latency is None else 0.7 * self.recent_latency + 0.3 * latency
+                if self.baseline_latency is None:
+                    self.baseline_latency = latency
+                elif self.recent_latency > self.baseline_latency * CONCURRENCY_LATENCY_SPIKE_FACTOR:
+                    self._decrease()
+                else:
+                    # Baseline mengikuti latensi secara perlahan supaya perubahan normal tidak dianggap lonjakan
+                    self.baseline_latency = 0.98 * self.baseline_latency + 0.02 * latency
+                    self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            limit_changed = int(self.limit) != previous_limit
+            self.condition.notify_all()
+        if limit_changed:
+            app.logger.info(f"Concurrency limit {self.path}: {previous_limit} -> {int(self.limit)} ({outcome})")
+            self._persist()
+
+    def record_throttle(self):
+        """Throttle yang terdeteksi dari payload error (bukan status HTTP) setelah slot dilepas."""
+        with self.condition:
+            self._decrease()
+
+    def _decrease(self):
+        """Turunkan batas, paling sering sekali per latensi rata-rata (satu putaran). Lock harus dipegang."""
+        now = time.monotonic()
+        if now - self.last_decrease < max(0.5, self.recent_latency or 0):
+            return
+        self.last_decrease = now
+        self.limit = max(self.min_limit, self.limit * CONCURRENCY_DECREASE_FACTOR)
+
+    def _persist(self):
+        """Simpan batas terakhir sebagai titik awal concurrency endpoint untuk run berikutnya."""
+        now = time.monotonic()
+        if now - self.last_persist < CONCURRENCY_PERSIST_INTERVAL:
+            return
+        self.last_persist = now
+        with endpoint_profile_lock:
+            profile = _get_endpoint_profile(self.path)
+            profile['concurrency'] = int(self.limit)
+            profile['updated_at'] = int(time.time())
+            _save_endpoint_profiles()
+
+    def snapshot(self):
+        with self.condition:
+            return {
+                'limit': int(self.limit),
+                'max_limit': self.max_limit,
+                'in_flight': self.in_flight,
+                'baseline_latency': round(self.baseline_latency, 3) if self.baseline_latency else None,
+                'recent_latency': round(self.recent_latency, 3) if self.recent_latency else None
+            }
+
+concurrency_limiters = {}
+concurrency_limiters_lock = threading.Lock()
+
+def get_concurrency_limiter(path, shop_id=None):
+    """
+    Limiter adaptif untuk satu endpoint di satu toko (batas Shopee berlaku per toko), dibuat dari
+    profil endpoint saat pertama dipakai.
+    """
+    key = (str(shop_id or ''), path)
+    with concurrency_limiters_lock:
+        limiter = concurrency_limiters.get(key)
+        if limiter is None:
+            defaults = ENDPOINT_DEFAULTS.get(path, {})
+            initial_limit = get_endpoint_concurrency(path)
+            limiter = AdaptiveConcurrencyLimiter(path, initial_limit, defaults.get('max_concurrency', initial_limit))
+            concurrency_limiters[key] = limiter
+        return limiter
+
+def get_concurrency_snapshot():
+    """Batas concurrency saat ini untuk setiap toko dan endpoint yang sudah dipakai ("shop_id:path")."""
+    with concurrency_limiters_lock:
+        limiters = dict(concurrency_limiters)
+    return {f"{shop_id}:{path}" if shop_id else path: limiter.snapshot()
+            for (shop_id, path), limiter in limiters.items()}
+
+class LatencyTracker:
+    """Simpan latensi terakhir per endpoint (jendela geser) untuk menghitung persentil."""
+
+    def __init__(self, window=200, min_samples=20):
+        self.window = window
+        self.min_samples = min_samples
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def record(self, path, latency):
+        with self.lock:
+            self.samples.setdefault(path, collections.deque(maxlen=self.window)).append(latency)
+
+    def percentile(self, path, pct):
+        """Persentil latensi (detik), None jika sampel belum cukup."""
+        with self.lock:
+            samples = sorted(self.samples.get(path, ()))
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(math.ceil(pct / 100.0 * len(samples))) - 1)]
+
+endpoint_latency_tracker = LatencyTracker()
+
+class AdaptiveExecutor(concurrent.futures.ThreadPoolExecutor):
+    """
+    Thread pool untuk fan-out ke satu endpoint. Jumlah thread = batas maksimal, sedangkan
+    jumlah panggilan yang benar-benar berjalan diatur limiter adaptif di call_shopee_api.
+    """
+
+    def __init__(self, path, shop_id=None, thread_name_prefix=''):
+        self.limiter = get_concurrency_limiter(path, shop_id)
+        super().__init__(max_workers=self.limiter.max_limit, thread_name_prefix=thread_name_prefix)
+
+    @property
+    def current_limit(self):
+        return self.limiter.current_limit
+
+def _fallback_page_size(path, page_size, offset, error):
+    """Ukuran halaman lebih kecil setelah Shopee menolak ukuran saat ini (None jika tidak perlu)."""
+    if page_size <= 1 or not _is_size_error(path, error):
+        return None
+    # Coba separuh ukuran saat ini, kecuali profil sudah tahu ukuran aman yang lebih besar
+    candidate = max(get_endpoint_size(path) or 1, page_size // 2)
+    if candidate >= page_size:
+        candidate = page_size // 2
+    # Untuk paginasi page_no, offset yang sudah diambil harus tetap kelipatan ukuran baru
+    if offset:
+        candidate = math.gcd(offset, candidate)
+    return max(1, candidate)
+
+def iterate_shopee_pages(path, shop_id, access_token, body=None, export_id=None, max_pages=200):
+    """
+    Generator paginasi untuk endpoint list Shopee. Ukuran halaman diambil dari profil
+    endpoint dan diturunkan otomatis jika Shopee menolaknya.
+    Menghasilkan tuple (page_no, item_list, error) untuk setiap halaman.
+    """
+    defaults = ENDPOINT_DEFAULTS[path]
+    size_field = defaults['size_field']
+    paging = defaults['paging']
+    list_key = defaults['list_key']
+
+    page_size = get_endpoint_size(path)
+    request_body = dict(body or {})
+    cursor = request_body.get('cursor', '')
+    offset = 0
+    page_no = 1
+
+    while page_no <= max_pages:
+        request_body[size_field] = page_size
+        if paging == 'page_no':
+            request_body['page_no'] = offset // page_size + 1
+        elif paging == 'offset':
+            request_body['offset'] = offset
+        else:
+            request_body['cursor'] = cursor
+
+        response, error = call_shopee_api(path, method='GET', shop_id=shop_id, access_token=access_token,
+                                          body=dict(request_body), export_id=export_id)
+        if error:
+            smaller_size = _fallback_page_size(path, page_size, offset, error)
+            if smaller_size:
+                app.logger.warning(f"Page size {page_size} rejected for {path}, retrying with {smaller_size}")
+                page_size = smaller_size
+                continue
+            yield page_no, [], error
+            return
+
+        data = response.get('response', {}) or {}
+        item_list = data.get(list_key, []) or []
+        if not item_list:
+            return
+
+        yield page_no, item_list, None
+        page_no += 1
+
+        if paging == 'cursor':
+            cursor = data.get('next_cursor', '')
+            if not cursor or data.get('more') is False:
+                return
+        else:
+            if paging == 'offset' and data.get('next_offset') is not None:
+                offset = data['next_offset']
+            else:
+                offset += page_size
+            if data.get('more') is False or data.get('has_next_page') is False:
+                return
+
+def iterate_return_pages(shop_id, access_token, body=None, export_id=None, max_pages=200):
+    """
+    Paginasi get_return_list (page_no) yang tahan terhadap daftar yang berubah selama paging.
+    Retur yang sudah pernah dihasilkan (berdasarkan return_sn) dilewati. Jika ada halaman yang
+    berisi retur yang sudah terlihat, berarti retur baru masuk di depan dan halaman bergeser;
+    setelah paging selesai halaman-halaman awal diambil ulang sampai ketemu halaman yang isinya
+    sudah terlihat semua. Menghasilkan tuple (page_no, item_list_baru, error).
+    """
+    path = "/api/v2/returns/get_return_list"
+    seen_return_sns = set()
+    shifted_items = 0
+    last_page_no = 0
+
+    def unseen(item_list):
+        new_items = []
+        for item in item_list:
+            return_sn = item.get('return_sn')
+            if return_sn in seen_return_sns:
+                continue
+            seen_return_sns.add(return_sn)
+            new_items.append(item)
+        return new_items
+
+    for page_no, item_list, error in iterate_shopee_pages(path, shop_id, access_token, body=body,
+                                                          export_id=export_id, max_pages=max_pages):
+        if error:
+            yield page_no, [], error
+            return
+        new_items = unseen(item_list)
+        if len(new_items) < len(item_list):
+            shifted_items += len(item_list) - len(new_items)
+        last_page_no = page_no
+        yield page_no, new_items, None
+
+    if not shifted_items:
+        return
+    app.logger.info(f"Return list shifted by {shifted_items} items while paging, re-fetching leading pages")
+    for _, item_list, error in iterate_shopee_pages(path, shop_id, access_token, body=body,
+                                                    export_id=export_id, max_pages=max_pages):
+        if error:
+            yield last_page_no + 1, [], error
+            return
+        new_items = unseen(item_list)
+        if not new_items:
+            return # Sudah sampai bagian yang terlihat sebelumnya
+        last_page_no += 1
+        yield last_page_no, new_items, None
+
+# ==============================================================================
+# METADATA TOKO (NAMA, REGION, STATUS) DENGAN CACHE
+# ==============================================================================
+SHOP_METADATA_FILE = os.path.join(DATA_DIR, 'shop_metadata.json')
+
+# Endpoint yang bisa memberi nama toko; ditanya bersamaan, jawaban valid pertama dipakai
+SHOP_METADATA_ENDPOINTS = ["/api/v2/shop/get_shop_info", "/api/v2/shop/get_profile"]
+
+shop_metadata_cache = {}
+shop_metadata_lock = threading.Lock()
+_shop_metadata_loaded = False
+shop_metadata_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix='shop-metadata')
+
+def _load_shop_metadata():
+    """Load cache metadata toko dari disk (sekali saja). Harus dipanggil dengan lock dipegang."""
+    global _shop_metadata_loaded
+    if _shop_metadata_loaded:
+        return
+    _shop_metadata_loaded = True
+    try:
+        with open(SHOP_METADATA_FILE, 'r', encoding='utf-8') as f:
+            shop_metadata_cache.update(json.load(f))
+    except FileNotFoundError:
+        pass
+    except (ValueError, OSError) as e:
+        app.logger.warning(f"Could not load shop metadata cache: {e}")
+
+def _save_shop_metadata():
+    """Simpan cache metadata toko ke disk. Harus dipanggil dengan lock dipegang."""
+    try:
+        os.makedirs(DATA_DIR, exist_ok=True)
+        tmp_path = f"{SHOP_METADATA_FILE}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(shop_metadata_cache, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, SHOP_METADATA_FILE)
+    except OSError as e:
+        app.logger.warning(f"Could not save shop metadata cache: {e}")
+
+def get_cached_shop_metadata(shop_id, include_expired=False):
+    """Metadata toko dari cache tanpa memanggil API (None jika tidak ada atau sudah kedaluwarsa)."""
+    with shop_metadata_lock:
+        _load_shop_metadata()
+        metadata = shop_metadata_cache.get(str(shop_id))
+    if not metadata:
+        return None
+    if not include_expired and time.time() - metadata.get('fetched_at', 0) > SHOP_METADATA_TTL:
+        return None
+    return dict(metadata)
+
+def _update_shop_metadata(shop_id, fields):
+    with shop_metadata_lock:
+        _load_shop_metadata()
+        metadata = shop_metadata_cache.setdefault(str(shop_id), {})
+        metadata.update({key: value for key, value in fields.items() if value})
+        metadata['fetched_at'] = int(time.time())
+        _save_shop_metadata()
+        return dict(metadata)
+
+def _parse_shop_metadata(response):
+    """Ambil shop_name, region, status dari respons get_shop_info/get_profile."""
+    if not response:
+        return {}
+    # get_shop_info mengembalikan field di level atas, get_profile di dalam 'response'
+    data = response.get('response') if isinstance(response.get('response'), dict) else response
+    return {
+        'shop_name': (data.get('shop_name') or response.get('shop_name') or '').strip(),
+        'region': data.get('region') or response.get('region'),
+        'status': data.get('status') or response.get('status')
+    }
+
+def get_shop_metadata(shop_id, access_token, force_refresh=False):
+    """
+    Metadata toko (shop_name, region, status). Diambil dari cache jika masih berlaku; jika tidak,
+    semua endpoint kandidat ditanya bersamaan dan nama valid pertama langsung dipakai. Respons
+    yang datang belakangan tetap melengkapi cache (mis. region/status) di background.
+    Mengembalikan None jika tidak ada endpoint yang memberi nama toko.
+    """
+    if not force_refresh:
+        cached = get_cached_shop_metadata(shop_id)
+        if cached and cached.get('shop_name'):
+            return cached
+
+    def fetch(path):
+        response, error = call_shopee_api(path, method='GET', shop_id=int(shop_id), access_token=access_token, max_retries=2)
+        if error:
+            app.logger.warning(f"Shop metadata {path} failed for shop {shop_id}: {error}")
+            return {}
+        return _parse_shop_metadata(response)
+
+    def without_name(fields):
+        # Nama toko tetap dari jawaban valid pertama; respons lain hanya melengkapi region/status
+        return {key: value for key, value in fields.items() if key != 'shop_name'}
+
+    def merge_late_result(future):
+        if not future.cancelled() and future.result():
+            _update_shop_metadata(shop_id, without_name(future.result()))
+
+    futures = [shop_metadata_executor.submit(fetch, path) for path in SHOP_METADATA_ENDPOINTS]
+    metadata = None
+    for future in concurrent.futures.as_completed(futures):
+        fields = future.result()
+        if fields.get('shop_name'):
+            metadata = _update_shop_metadata(shop_id, fields)
+            break
+    if metadata is None:
+        return None
+    for future in futures:
+        if not future.done():
+            future.add_done_callback(merge_late_result)
+        elif future.result() and future.result() is not fields:
+            metadata = _update_shop_metadata(shop_id, without_name(future.result()))
+    return metadata
+
+# ==============================================================================
+# RUTE-RUTE (HALAMAN) APLIKASI
+# ==============================================================================
+@app.before_request
+def refresh_session_tokens():
+    """Pastikan token toko di session selalu sama dengan token terbaru di token manager."""
+    start_background_sync()
+    shops = session.get('shops')
+    if shops and sync_session_tokens(shops):
+        session['shops'] = shops
+        session.modified = True
+
+@app.route('/')
+def dashboard():
+    """Menampilkan halaman utama dengan daftar toko dari session."""
+    shops = session.get('shops', {})
+    # Region/status toko hanya dari cache metadata, tanpa panggilan API
+    shop_metadata = {shop_id: get_cached_shop_metadata(shop_id, include_expired=True) or {} for shop_id in shops}
+    
+    today = datetime.now()
+    date_to_default = today.strftime('%Y-%m-%d')
+    date_from_default = (today - timedelta(days=7)).strftime('%Y-%m-%d')
+
+    # KPI 30 hari terakhir dari agregat lokal (hanya jika ada toko yang sudah disinkronkan)
+    synced_shops = [shop_id for shop_id in shops if local_store.get_sync_state(shop_id, 'returns')]
+    kpi_summary = build_kpi_summary(synced_shops, (today - timedelta(days=30)).strftime('%Y-%m-%d'),
+                                    date_to_default, top=5) if synced_shops else None
+
+    return render_template(
+        'dashboard.html', 
+        shops=shops, 
+        shop_metadata=shop_metadata,
+        kpi_summary=kpi_summary,
+        date_from=date_from_default, 
+        date_to=date_to_default
+    )
+
+@app.route('/authorize')
+def authorize():
+    """Mengarahkan pengguna ke halaman otorisasi Shopee."""
+    path = "/api/v2/shop/auth_partner"
+    sign = generate_signature(path, int(time.time()))
+    redirect_full_url = f"{REDIRECT_URL_DOMAIN}{url_for('callback')}"
+    
+    auth_url = f"{BASE_URL}{path}?partner_id={PARTNER_ID}&redirect={redirect_full_url}&sign={sign}&timestamp={int(time.time())}"
+    return redirect(auth_url)
+
+@app.route('/callback')
+def callback():
+    """Menangani callback dari Shopee setelah otorisasi."""
+    code = request.args.get('code')
+    shop_id_str = request.args.get('shop_id')
+
+    if not code or not shop_id_str:
+        flash("Callback dari Shopee tidak valid.", 'danger')
+        return redirect(url_for('dashboard'))
+
+    path_token = "/api/v2/auth/token/get"
+    body_token = {"code": code, "shop_id": int(shop_id_str)}
+    token_data, error = call_shopee_api(path_token, body=body_token)
+
+    if error:
+        flash(f"Gagal mendapatkan token: {error}", 'danger')
+        return redirect(url_for('dashboard'))
+
+    access_token = token_data.get('access_token')
+    if not access_token:
+        flash("Respons token dari Shopee tidak lengkap.", 'danger')
+        return redirect(url_for('dashboard'))
+
+    # Token baru didaftarkan dulu: call_shopee_api memakai token tersimpan, jadi metadata toko
+    # yang diotorisasi ulang tidak boleh diambil dengan token lama (yang mungkin sudah dicabut)
+    expire_in = int(time.time()) + token_data.get('expire_in', 14400)
+    shop_token_manager.register(shop_id_str, access_token, token_data.get('refresh_token'), expire_in)
+
+    # Nama toko dari cache metadata, atau dari get_shop_info/get_profile yang ditanya bersamaan
+    shops = session.get('shops', {})
+    known_name = (shop_token_manager.get_token(shop_id_str) or {}).get('shop_name') or shops.get(shop_id_str, {}).get('shop_name')
+    shop_name = known_name or f"Toko {shop_id_str}"  # Default fallback: nama yang sudah dikenal, lalu ID
+    metadata = get_shop_metadata(shop_id_str, access_token)
+    if metadata:
+        shop_name = metadata['shop_name']
+        shop_token_manager.set_shop_name(shop_id_str, shop_name)
+    else:
+        flash(f"Tidak dapat mengambil nama toko. Menggunakan nama: {shop_name}", 'warning')
+        app.logger.warning(f"Could not retrieve shop name for {shop_id_str}, using fallback: {shop_name}")
+
+    shops[shop_id_str] = {
+        'shop_id': shop_id_str,
+        'shop_name': shop_name,
+        'access_token': access_token,
+        'refresh_token': token_data.get('refresh_token'),
+        'expire_in': expire_in
+    }
+    session['shops'] = shops
+    session.modified = True
+
+    flash(f"Toko '{shop_name}' berhasil dihubungkan.", 'success')
+    return redirect(url_for('dashboard'))
+    
+@app.route('/clear_session')
+def clear_session():
+    """Menghapus semua data dari session untuk memulai dari awal."""
+    session.clear()
+    flash('Semua data sesi dan toko terhubung telah dihapus.', 'info')
+    return redirect(url_for('dashboard'))
+
+@app.route('/clear_temp_data')
+def clear_temp_data():
+    """Menghapus data sementara export (export_progress_store) tanpa menghapus session."""
+    global export_progress_store
+    
     # Count berapa data yang akan dihapus
     count_before = len(export_progress_store)
     
-    # Clear semua data sementara
+    # Clear semua data sementara (termasuk file spool hasil export)
+    for stored_export in export_progress_store.values():
+        discard_export_results(stored_export)
     export_progress_store.clear()
     
     flash(f'Data sementara berhasil dihapus ({count_before} export data dihapus dari memory).', 'success')
@@ -352,43 +1652,16 @@ def test_shop_info():
     shop_id, shop_data = next(iter(shops.items()))
     access_token = shop_data['access_token']
     
-    results = {}
-    
-    # Test berbagai endpoint untuk ambil nama toko
-    endpoints_to_test = [
-        "/api/v2/shop/get_shop_info",
-        "/api/v2/shop/get_profile", 
-        "/api/v2/public/get_shops_by_partner",
-        "/api/v2/merchant/get_merchant_info"
-    ]
-    
-    for endpoint in endpoints_to_test:
-        try:
-            response, error = call_shopee_api(endpoint, method='GET', 
-                                            shop_id=shop_id, access_token=access_token)
-            
-            results[endpoint] = {
-                "response": response,
-                "error": error,
-                "shop_name_found": response.get('response', {}).get('shop_name') if response else None
-            }
-        except Exception as e:
-            results[endpoint] = {"error": str(e)}
-    
-    # Test dengan body parameter juga
-    try:
-        body_test = {}
-        response, error = call_shopee_api("/api/v2/shop/get_shop_info", method='GET', 
-                                        shop_id=shop_id, access_token=access_token, body=body_test)
-        results["get_shop_info_with_body"] = {
-            "response": response,
-            "error": error,
-            "shop_name_found": response.get('response', {}).get('shop_name') if response else None
-        }
-    except Exception as e:
-        results["get_shop_info_with_body"] = {"error": str(e)}
-    
-    return results
+    # ?refresh=1 memaksa endpoint metadata ditanya ulang (mengabaikan cache)
+    force_refresh = request.args.get('refresh') == '1'
+    cached = get_cached_shop_metadata(shop_id, include_expired=True)
+    return {
+        "shop_id": shop_id,
+        "cached_metadata": cached,
+        "cache_ttl_seconds": SHOP_METADATA_TTL,
+        "metadata": get_shop_metadata(shop_id, access_token, force_refresh=force_refresh),
+        "endpoints": SHOP_METADATA_ENDPOINTS
+    }
 
 @app.route('/test_date_filter_specific_shop')
 def test_date_filter_specific_shop():
@@ -1156,8 +2429,12 @@ def export_data():
     date_to_str = request.form.get('date_to', '')
     # Single mode: manual date filter that includes RRBOC
     
-    shop_data = session.get('shops', {}).get(shop_id)
-    if not shop_data:
+    shops = session.get('shops', {})
+    if shop_id == ALL_SHOPS_ID:
+        if not shops:
+            flash("Belum ada toko yang terhubung di sesi ini.", 'danger')
+            return redirect(url_for('dashboard'))
+    elif not shops.get(shop_id):
         flash(f"Toko dengan ID {shop_id} tidak ditemukan di sesi ini.", 'danger')
         return redirect(url_for('dashboard'))
     
@@ -1169,6 +2446,9 @@ def export_data():
         'data_type': data_type,
         'date_from': date_from_str,
         'date_to': date_to_str,
+        'include_failed_delivery': request.form.get('include_failed_delivery') == '1',
+        'include_return_detail': request.form.get('include_return_detail') == '1',
+        'delta_export': request.form.get('delta_export') == '1',
         'status': 'initializing',
         'progress': 0,
         'total_estimated': 0,
@@ -1176,6 +2456,8 @@ def export_data():
         'data': [],
         'error': None
     }
+    if shop_id == ALL_SHOPS_ID:
+        export_data['shop_ids'] = list(shops.keys())
     
     # Store in both global store and session
     export_progress_store[export_id] = export_data
@@ -1216,15 +2498,16 @@ def progress_status():
     
     # Get updated data from global store
     export_id = export_data.get('export_id')
-    if export_id and export_id in export_progress_store:
-        export_data = export_progress_store[export_id]
+    latest_export = get_export_record(export_id) if export_id else None
+    if latest_export:
+        export_data = latest_export
         # Update session with latest data (WITHOUT the data field to reduce cookie size)
         session_data = export_data.copy()
         session_data.pop('data', None)  # Remove data from session to fix cookie size
         session['current_export'] = session_data
         session.modified = True
         # Safe print untuk data besar
-        data_count = len(export_data.get('data', []))
+        data_count = get_export_row_count(export_data)
         print(f"Using updated data from global store: Progress={export_data.get('progress')}%, Status={export_data.get('status')}, Records={data_count}")
     
     response_data = {
@@ -1232,11 +2515,115 @@ def progress_status():
         "progress": export_data.get('progress', 0),
         "current_step": export_data.get('current_step', ''),
         "error": export_data.get('error'),
-        "data_count": len(export_data.get('data', []))
+        "data_count": get_export_row_count(export_data)
     }
+    if export_data.get('shop_progress'):
+        response_data["shop_progress"] = export_data['shop_progress']
+    response_data["concurrency_limits"] = {path: limiter['limit'] for path, limiter in get_concurrency_snapshot().items()}
     print(f"Returning progress status: Progress={response_data['progress']}%, Status={response_data['status']}, Records={response_data['data_count']}")
     return response_data
 
+@app.route('/api/local_query')
+def api_local_query():
+    """
+    Filter ad-hoc atas data yang sudah disinkronkan (tanpa memanggil API Shopee).
+    Parameter: data_type (orders/returns), shop_id (atau 'all'), date_from, date_to,
+    dan filter opsional status, sku, reason, province, payment_method, serta limit.
+    """
+    shops = session.get('shops', {})
+    shop_id = request.args.get('shop_id', ALL_SHOPS_ID)
+    data_type = request.args.get('data_type', 'returns')
+    if data_type not in SYNC_DATA_TYPES:
+        return {"error": f"data_type harus salah satu dari {', '.join(SYNC_DATA_TYPES)}"}, 400
+    shop_ids = list(shops) if shop_id == ALL_SHOPS_ID else [shop_id]
+    if not shop_ids or any(sid not in shops for sid in shop_ids):
+        return {"error": "Toko tidak ditemukan di sesi ini"}, 404
+    try:
+        time_from = datetime.strptime(request.args['date_from'], '%Y-%m-%d').timestamp()
+        time_to = datetime.strptime(request.args['date_to'], '%Y-%m-%d').replace(hour=23, minute=59, second=59).timestamp()
+        limit = int(request.args.get('limit', 500))
+    except (KeyError, ValueError):
+        return {"error": "date_from dan date_to wajib diisi dengan format YYYY-MM-DD"}, 400
+    filters = {name: request.args[name] for name in LOCAL_QUERY_FILTERS if request.args.get(name)}
+
+    started = time.time()
+    rows = []
+    total = 0
+    not_synced = []
+    for sid in shop_ids:
+        if not local_store.get_sync_state(sid, data_type):
+            not_synced.append(sid)
+            continue
+        if data_type == 'orders':
+            records = local_store.query_orders(sid, time_from, time_to, filters=filters)
+            total += len(records)
+            formatted = format_order_data_for_excel(records[:max(0, limit - len(rows))])
+        else:
+            records = local_store.query_returns(sid, time_from, time_to, filters)
+            total += len(records)
+            records = records[:max(0, limit - len(rows))]
+            order_sns = [item['order_sn'] for item in records if item.get('order_sn')]
+            formatted = format_return_data_for_excel(records, local_store.get_orders(sid, order_sns),
+                                                     local_store.get_tracking(sid, order_sns))
+        rows.extend({"ID Toko": sid, **row} for row in formatted)
+    return {
+        "data_type": data_type,
+        "filters": filters,
+        "count": total,
+        "rows": rows[:limit],
+        "not_synced_shops": not_synced,
+        "query_ms": round((time.time() - started) * 1000, 1)
+    }
+
+@app.route('/api/kpi_summary')
+def api_kpi_summary():
+    """
+    Ringkasan KPI (retur per alasan/SKU, refund, pembatalan, gagal kirim per provinsi, per hari)
+    dari agregat data yang sudah disinkronkan. Parameter: shop_id (atau 'all'), date_from, date_to, top.
+    """
+    shops = session.get('shops', {})
+    shop_id = request.args.get('shop_id', ALL_SHOPS_ID)
+    shop_ids = list(shops) if shop_id == ALL_SHOPS_ID else [shop_id]
+    if not shop_ids or any(sid not in shops for sid in shop_ids):
+        return {"error": "Toko tidak ditemukan di sesi ini"}, 404
+    today = datetime.now()
+    date_from = request.args.get('date_from') or (today - timedelta(days=30)).strftime('%Y-%m-%d')
+    date_to = request.args.get('date_to') or today.strftime('%Y-%m-%d')
+    try:
+        datetime.strptime(date_from, '%Y-%m-%d')
+        datetime.strptime(date_to, '%Y-%m-%d')
+        top = int(request.args.get('top', 10))
+    except ValueError:
+        return {"error": "date_from/date_to harus berformat YYYY-MM-DD"}, 400
+    summary = build_kpi_summary(shop_ids, date_from, date_to, top)
+    summary['not_synced_shops'] = [sid for sid in shop_ids if not local_store.get_sync_state(sid, 'returns')]
+    return summary
+
+@app.route('/api/metrics')
+def api_metrics():
+    """Metrik runtime: batas concurrency adaptif, request yang digabung, jatah retry, dan status export."""
+    with shopee_retry_budget.lock:
+        retry_budget_exhausted = {f"{shop_id} {path}": count for (shop_id, path), count in shopee_retry_budget.exhausted.items()}
+    with shopee_request_coalescer.lock:
+        coalescing = {
+            "in_flight": len(shopee_request_coalescer.in_flight),
+            "shared_calls": shopee_request_coalescer.shared_calls
+        }
+    return {
+        "concurrency": get_concurrency_snapshot(),
+        "request_coalescing": coalescing,
+        "retry_budget_exhausted": retry_budget_exhausted,
+        "circuit_breakers": shopee_circuit_breakers.snapshot(),
+        "local_sync": local_store.get_all_sync_state(),
+        "push": {"queued": push_queue.qsize(), **push_stats},
+        "hedging": {
+            "enabled": HEDGE_ORDER_DETAIL_REQUESTS,
+            "order_detail_p95": endpoint_latency_tracker.percentile("/api/v2/order/get_order_detail", 95),
+            **hedge_stats
+        },
+        "exports": dict(collections.Counter(export.get('status', 'unknown') for export in list(export_progress_store.values())))
+    }
+
 @app.route('/start_chunked_export', methods=['POST'])
 def start_chunked_export():
     """Start the actual chunked export process (SYNC VERSION for debugging)."""
@@ -1258,7 +2645,20 @@ def start_chunked_export():
         return {"status": "already_processing", "progress": export_data.get('progress', 0)}
     
     try:
-        shop_data = session.get('shops', {}).get(export_data['shop_id'])
+        shops = session.get('shops', {})
+        if export_data['shop_id'] == ALL_SHOPS_ID:
+            # Mode semua toko: kumpulkan token setiap toko yang dipilih saat export dibuat
+            shop_data = {
+                'access_token': None,
+                'shop_tokens': {
+                    shop_id: {'access_token': shops[shop_id]['access_token'], 'shop_name': shops[shop_id].get('shop_name', shop_id)}
+                    for shop_id in export_data.get('shop_ids', []) if shop_id in shops
+                }
+            }
+            if not shop_data['shop_tokens']:
+                shop_data = None
+        else:
+            shop_data = shops.get(export_data['shop_id'])
         print(f"Shop data found: {shop_data is not None}")
         app.logger.info(f"Shop data found: {shop_data is not None}")
         
@@ -1283,6 +2683,24 @@ def start_chunked_export():
         print(f"Starting async export for data_type: {export_data['data_type']}")
         app.logger.info(f"Starting async export for data_type: {export_data['data_type']}")
         
+        if EXPORT_EXECUTION_MODE == 'worker':
+            # Proses web hanya memasukkan job ke antrean; token diambil worker dari penyimpanan token
+            export_id = export_data.get('export_id')
+            if export_id not in export_progress_store:
+                return {"error": "Export tidak ditemukan"}
+            # Job tanpa token toko di server tidak dimasukkan ke antrean (worker tidak bisa memakainya)
+            _, _, token_error = resolve_export_tokens(export_progress_store[export_id])
+            if token_error:
+                export_data['status'] = 'error'
+                export_data['error'] = token_error
+                export_progress_store[export_id].update({'status': 'error', 'error': token_error})
+                return {"error": token_error}
+            queued_export = export_progress_store.pop(export_id)
+            queued_export.update({'status': 'processing', 'progress': 1.0, 'current_step': 'Menunggu worker export...'})
+            export_job_store.enqueue(queued_export)
+            app.logger.info(f"Export {export_id} queued for worker")
+            return {"status": "started", "progress": 1.0, "message": "Export dimasukkan ke antrean worker"}
+        
         # Start processing in background thread using global store
         def background_process():
             try:
@@ -1290,16 +2708,7 @@ def start_chunked_export():
                 if not export_id or export_id not in export_progress_store:
                     return
                 
-                current_export = export_progress_store[export_id]
-                
-                if current_export['data_type'] == 'returns':
-                    process_returns_with_manual_filter_global(export_id, access_token)
-                elif current_export['data_type'] == 'orders':
-                    process_orders_chunked_global(export_id, access_token)
-                elif current_export['data_type'] == 'products':
-                    process_products_chunked_global(export_id, access_token)
-                elif current_export['data_type'] == 'combined_report':
-                    process_combined_data_global(export_id, access_token)
+                execute_export(export_id, access_token, shop_data.get('shop_tokens'))
             except Exception as e:
                 app.logger.error(f"Background process error: {e}")
                 # Update global store with error
@@ -1352,47 +2761,432 @@ def load_checkpoint(export_id):
         return export_progress_store[export_id].get('checkpoint', {})
     return {}
 
-def get_batch_order_and_tracking_details(shop_id, access_token, order_sns, progress_callback=None, export_id=None):
+# ==============================================================================
+# SPOOL HASIL EXPORT (baris hasil disimpan di disk, bukan di memory)
+# ==============================================================================
+SPOOL_DIR = os.path.join(DATA_DIR, 'spool')
+
+class ResultSpool:
+    """Menampung baris hasil export di file JSON lines agar memory tetap kecil untuk data besar."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    @classmethod
+    def create(cls, export_id):
+        """Buat spool kosong baru untuk satu export."""
+        os.makedirs(SPOOL_DIR, exist_ok=True)
+        path = os.path.join(SPOOL_DIR, f"{export_id}.jsonl")
+        open(path, 'w', encoding='utf-8').close()
+        return cls(path)
+
+    def append_rows(self, rows):
+        """Tambahkan beberapa baris ke spool."""
+        if not rows:
+            return
+        lines = "".join(json.dumps(row, ensure_ascii=False, default=str) + "\n" for row in rows)
+        with self.lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(lines)
+
+    def __iter__(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def delete(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+def attach_result_spool(export_data):
+    """Siapkan spool untuk export ini dan catat path-nya di export_data."""
+    spool = ResultSpool.create(export_data['export_id'])
+    export_data['spool_path'] = spool.path
+    export_data['data_count'] = 0
+    return spool
+
+def spool_export_rows(export_data, spool, rows):
+    """Tulis baris ke spool dan perbarui jumlah baris export."""
+    spool.append_rows(rows)
+    export_data['data_count'] = export_data.get('data_count', 0) + len(rows)
+
+def get_export_row_count(export_data):
+    """Jumlah baris hasil export, baik yang di memory maupun di spool."""
+    if export_data.get('spool_path'):
+        return export_data.get('data_count', 0)
+    return len(export_data.get('data', []))
+
+def iter_export_rows(export_data):
+    """Iterasi baris hasil export, baik yang di memory maupun di spool."""
+    if export_data.get('spool_path'):
+        return iter(ResultSpool(export_data['spool_path']))
+    return iter(export_data.get('data', []))
+
+def discard_export_results(export_data):
+    """Hapus file spool milik export (jika ada)."""
+    if export_data and export_data.get('spool_path'):
+        ResultSpool(export_data['spool_path']).delete()
+
+# Kolom teks dijadikan pd.Categorical jika jumlah nilai uniknya paling banyak sekian bagian dari jumlah baris
+CATEGORICAL_MAX_UNIQUE_RATIO = 0.5
+
+class ResultColumn:
     """
-    Efficiently fetches order details and tracking numbers for a list of order_sn
-    using batch processing for order details.
+    Satu kolom hasil export. Angka disimpan di array bertipe (int64/float64); nilai lain
+    di-encode dengan kamus (setiap nilai unik disimpan sekali, baris hanya menyimpan kode int32).
+    Nilai kosong: NaN untuk angka, kode -1 untuk kolom kamus.
     """
-    order_details_map = {}
-    tracking_numbers_map = {}
-    unique_order_sns = list(set(order_sns))
-    total_sns = len(unique_order_sns)
-    
-    app.logger.info(f"Starting batch fetch for {total_sns} unique order SNs.")
 
-    # Helper function for parallel execution
-    def fetch_order_detail_chunk(chunk, shop_id, access_token, export_id):
-        params = {"order_sn_list": ",".join(chunk), "response_optional_fields": "tracking_number"}
-        response, error = call_shopee_api(
-            "/api/v2/order/get_order_detail", 
+    def __init__(self, leading_missing=0):
+        self.kind = None # 'int', 'float', atau 'dict'
+        self.values = None
+        self.categories = []
+        self.category_codes = {}
+        self.missing = leading_missing # Nilai kosong sebelum tipe kolom diketahui
+
+    def __len__(self):
+        return self.missing if self.values is None else len(self.values)
+
+    def append(self, value):
+        if value is None:
+            if self.values is None:
+                self.missing += 1
+            elif self.kind == 'int':
+                self._convert('float')
+                self.values.append(math.nan)
+            else:
+                self.values.append(math.nan if self.kind == 'float' else -1)
+            return
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            kind = 'dict'
+        else:
+            kind = 'int' if isinstance(value, int) else 'float'
+        if self.values is None:
+            self._start(kind)
+        elif kind != self.kind and self.kind != 'dict' and (kind, self.kind) != ('int', 'float'):
+            self._convert('float' if kind == 'float' and self.kind == 'int' else 'dict')
+        if self.kind == 'dict':
+            self.values.append(self._code(value))
+        elif self.kind == 'int' and not -2 ** 63 <= value < 2 ** 63:
+            self._convert('dict')
+            self.values.append(self._code(value))
+        else:
+            self.values.append(value)
+
+    def _code(self, value):
+        if isinstance(value, (list, dict)):
+            value = json.dumps(value, ensure_ascii=False, default=str)
+        # Selain string, kunci menyertakan tipe supaya True dan 1 tidak berbagi kode
+        key = value if value.__class__ is str else (value.__class__, value)
+        code = self.category_codes.get(key)
+        if code is None:
+            code = self.category_codes[key] = len(self.categories)
+            self.categories.append(value)
+        return code
+
+    def _start(self, kind):
+        self.kind = kind
+        if kind == 'int' and self.missing:
+            kind = self.kind = 'float'
+        self.values = array.array({'int': 'q', 'float': 'd', 'dict': 'i'}[kind])
+        self.values.extend([math.nan if kind == 'float' else -1] * self.missing)
+
+    def _convert(self, kind):
+        old_kind, old_values = self.kind, self.values
+        self.kind = kind
+        if kind == 'float':
+            self.values = array.array('d', old_values)
+            return
+        self.values = array.array('i')
+        for value in old_values:
+            is_missing = old_kind == 'float' and math.isnan(value)
+            self.values.append(-1 if is_missing else self._code(value))
+
+    def to_pandas(self, row_count):
+        """Materialisasi kolom untuk DataFrame: array numerik, pd.Categorical, atau object."""
+        import numpy as np
+        import pandas as pd
+        if self.values is None:
+            return np.full(row_count, None, dtype=object)
+        if self.kind == 'int':
+            return np.frombuffer(self.values, dtype=np.int64)
+        if self.kind == 'float':
+            return np.frombuffer(self.values, dtype=np.float64)
+        codes = np.frombuffer(self.values, dtype=np.int32)
+        categories = pd.Index(self.categories, dtype=object)
+        if len(self.categories) > max(1, row_count * CATEGORICAL_MAX_UNIQUE_RATIO) or not categories.is_unique:
+            # Hampir semua unik (kamus tidak menghemat apa pun) atau nilai campuran yang dianggap sama
+            # oleh pandas (mis. True dan 1): jadikan kolom object biasa; kode -1 menunjuk ke None
+            lookup = np.empty(len(self.categories) + 1, dtype=object)
+            lookup[:-1] = self.categories
+            return lookup[codes]
+        return pd.Categorical.from_codes(codes, categories=categories)
+
+class ColumnarTable:
+    """Hasil export dalam bentuk kolom (lihat ResultColumn); string baru dibentuk saat file ditulis."""
+
+    def __init__(self):
+        self.columns = {}
+        self.row_count = 0
+
+    def append_rows(self, rows):
+        for row in rows:
+            for name, value in row.items():
+                column = self.columns.get(name)
+                if column is None:
+                    column = self.columns[name] = ResultColumn(leading_missing=self.row_count)
+                column.append(value)
+            self.row_count += 1
+            if len(row) < len(self.columns):
+                for column in self.columns.values():
+                    if len(column) < self.row_count:
+                        column.append(None)
+
+    def to_dataframe(self):
+        import pandas as pd
+        return pd.DataFrame({name: column.to_pandas(self.row_count) for name, column in self.columns.items()},
+                            columns=list(self.columns))
+
+def load_export_table(export_data):
+    """Baca hasil export (spool atau memory) ke ColumnarTable secara streaming."""
+    table = ColumnarTable()
+    rows = iter_export_rows(export_data)
+    while True:
+        chunk = list(itertools.islice(rows, 5000))
+        if not chunk:
+            return table
+        table.append_rows(chunk)
+
+# Field tambahan get_order_detail untuk export pesanan (field default seperti cod,
+# currency dan message_to_seller selalu dikembalikan)
+ORDER_DETAIL_OPTIONAL_FIELDS = "buyer_username,recipient_address,total_amount,payment_method,estimated_shipping_fee,item_list,package_list,cancel_reason"
+
+# order_sn yang detailnya sedang diambil: (shop_id, optional_fields, order_sn) -> Future
+order_detail_in_flight = {}
+order_detail_in_flight_lock = threading.Lock()
+
+def fetch_order_details_batch(shop_id, access_token, order_sns, export_id=None, optional_fields="tracking_number"):
+    """
+    Ambil detail untuk satu batch order_sn. order_sn yang sedang diambil oleh export lain
+    tidak diminta ulang; hasilnya ditunggu dari request yang sudah berjalan.
+    """
+    owned, shared = [], []
+    with order_detail_in_flight_lock:
+        # order_sn ganda dalam satu batch cukup diambil sekali (bukan menunggu future miliknya sendiri)
+        for order_sn in dict.fromkeys(order_sns):
+            key = (str(shop_id), optional_fields, order_sn)
+            future = order_detail_in_flight.get(key)
+            if future is None:
+                future = concurrent.futures.Future()
+                order_detail_in_flight[key] = future
+                owned.append((order_sn, future))
+            else:
+                shared.append(future)
+
+    details = []
+    try:
+        if owned:
+            details = _request_order_details(shop_id, access_token, [sn for sn, _ in owned], export_id, optional_fields)
+    finally:
+        details_map = {detail.get('order_sn'): detail for detail in details}
+        with order_detail_in_flight_lock:
+            for order_sn, _ in owned:
+                order_detail_in_flight.pop((str(shop_id), optional_fields, order_sn), None)
+        for order_sn, future in owned:
+            future.set_result(details_map.get(order_sn))
+
+    for future in shared:
+        detail = future.result()
+        if detail:
+            details.append(copy.deepcopy(detail))
+    return details
+
+# Thread untuk request primary/hedge get_order_detail dan jatah request hedge
+hedge_executor = concurrent.futures.ThreadPoolExecutor(max_workers=32, thread_name_prefix='hedge')
+hedge_budget = RateLimiter(max(0.1, SHOPEE_MAX_REQUESTS_PER_SECOND * HEDGE_BUDGET_FRACTION))
+hedge_stats = collections.Counter()
+
+def hedged_call(path, send):
+    """
+    Jalankan send(coalesce); jika belum selesai setelah latensi p95 endpoint, kirim duplikat
+    (tanpa coalescing, dalam jatah hedge) dan pakai respons yang lebih dulu berhasil.
+    """
+    threshold = endpoint_latency_tracker.percentile(path, 95)
+    if threshold is None:
+        return send(True)
+    primary = hedge_executor.submit(send, True)
+    try:
+        return primary.result(timeout=threshold)
+    except concurrent.futures.TimeoutError:
+        pass
+    if not hedge_budget.try_acquire():
+        return primary.result()
+    hedge_stats['hedged'] += 1
+    hedge = hedge_executor.submit(send, False)
+    done, _ = concurrent.futures.wait([primary, hedge], return_when=concurrent.futures.FIRST_COMPLETED)
+    winner, loser = (primary, hedge) if primary in done else (hedge, primary)
+    # Request yang sudah terkirim tidak bisa dibatalkan; hasilnya cukup diabaikan
+    loser.cancel()
+    result = winner.result()
+    if result[1] and not loser.cancelled():
+        winner, result = loser, loser.result()
+    if winner is hedge:
+        hedge_stats['hedge_wins'] += 1
+    return result
+
+def _request_order_details(shop_id, access_token, order_sns, export_id=None, optional_fields="tracking_number"):
+    """Satu panggilan get_order_detail (dengan hedging jika aktif); dipecah dua jika batch terlalu besar."""
+    detail_path = "/api/v2/order/get_order_detail"
+    params = {"order_sn_list": ",".join(order_sns), "response_optional_fields": optional_fields}
+
+    def send(coalesce):
+        return call_shopee_api(
+            detail_path,
+            method='GET',
+            shop_id=shop_id,
+            access_token=access_token,
+            body=params,
+            max_retries=3,
+            export_id=export_id,
+            coalesce=coalesce
+        )
+
+    response, error = hedged_call(detail_path, send) if HEDGE_ORDER_DETAIL_REQUESTS else send(True)
+    if error:
+        # Batch terlalu besar: pecah dua dan coba lagi (profil endpoint sudah diturunkan)
+        if len(order_sns) > 1 and _is_size_error(detail_path, error):
+            half = len(order_sns) // 2
+            return (_request_order_details(shop_id, access_token, order_sns[:half], export_id, optional_fields) +
+                    _request_order_details(shop_id, access_token, order_sns[half:], export_id, optional_fields))
+        app.logger.warning(f"Batch order detail error for chunk: {error}")
+        return []
+    return response.get('response', {}).get('order_list', [])
+
+def fetch_tracking_number(shop_id, access_token, order_sn, export_id=None):
+    """
+    Ambil no. resi satu pesanan: dari penyimpanan lokal jika sudah pernah diambil, jika tidak
+    dari logistics API (string kosong jika tidak ada).
+    """
+    stored = local_store.get_tracking(shop_id, [order_sn]).get(order_sn)
+    if stored:
+        return stored
+    try:
+        tracking_params = {"order_sn": order_sn}
+        tracking_response, tracking_error = call_shopee_api(
+            "/api/v2/logistics/get_tracking_number", 
             method='GET', 
             shop_id=shop_id, 
             access_token=access_token, 
-            body=params,
-            max_retries=3,
+            body=tracking_params, 
+            max_retries=1,
             export_id=export_id
         )
-        if error:
-            app.logger.warning(f"Batch order detail error for chunk: {error}")
-            return []
-        return response.get('response', {}).get('order_list', [])
+        if tracking_response and not tracking_error:
+            tracking_number = tracking_response.get('response', {}).get('tracking_number', '')
+            local_store.save_tracking(shop_id, {order_sn: tracking_number})
+            return tracking_number
+        app.logger.warning(f"Could not get tracking number for {order_sn}: {tracking_error}")
+    except Exception as e:
+        app.logger.error(f"Exception getting tracking number for {order_sn}: {e}")
+    return ""
+
+# ==============================================================================
+# DETAIL RETUR (ENRICHMENT OPSIONAL + CACHE)
+# ==============================================================================
+RETURN_DETAIL_PATH = "/api/v2/returns/get_return_detail"
+
+# Detail retur dengan status ini tidak berubah lagi, jadi aman disimpan di cache (tabel return_details
+# di penyimpanan lokal, dipakai bersama proses web dan worker)
+FINAL_RETURN_STATUSES = {'CLOSED', 'CANCELLED'}
+
+# Kolom tambahan dari get_return_detail (hanya ada jika enrichment detail retur aktif)
+RETURN_DETAIL_COLUMNS = [
+    "Solusi Negosiasi", "Penawaran Terakhir", "Status Bukti Penjual", "Batas Bukti Penjual",
+    "Status Logistik Retur", "Status Kompensasi Penjual"
+]
+
+def fetch_return_detail(shop_id, access_token, return_sn, export_id=None):
+    """Ambil detail satu retur (None jika gagal)."""
+    response, error = call_shopee_api(RETURN_DETAIL_PATH, method='GET', shop_id=shop_id, access_token=access_token,
+                                      body={"return_sn": return_sn}, max_retries=2, export_id=export_id)
+    if error:
+        app.logger.warning(f"Could not get return detail for {return_sn}: {error}")
+        return None
+    return response.get('response') or None
+
+def request_return_details(shop_id, access_token, return_sns, executor, export_id=None):
+    """
+    Mulai ambil detail retur secara paralel di executor (yang sudah selesai diambil dari cache)
+    dan kembalikan fungsi untuk menunggu hasilnya sebagai dict return_sn -> detail. Dengan begitu
+    pemanggil bisa mengerjakan enrichment lain selagi detail retur diambil.
+    """
+    details = local_store.get_return_details(shop_id, return_sns)
+    missing = [sn for sn in dict.fromkeys(return_sns) if sn not in details]
+    if missing and shopee_circuit_breakers.is_open(shop_id, RETURN_DETAIL_PATH):
+        app.logger.warning(f"Return detail API unavailable for shop {shop_id}, skipping {len(missing)} lookups")
+        missing = []
+    futures = {sn: executor.submit(fetch_return_detail, shop_id, access_token, sn, export_id) for sn in missing}
+
+    def collect():
+        finished = {}
+        for return_sn, future in futures.items():
+            detail = future.result()
+            if detail:
+                details[return_sn] = detail
+                if detail.get('status') in FINAL_RETURN_STATUSES:
+                    finished[return_sn] = detail
+        if finished:
+            local_store.save_return_details(shop_id, finished)
+        return details
+    return collect
+
+def format_return_detail_columns(detail):
+    """Kolom tambahan Excel dari satu detail retur (kosong jika detail tidak ada)."""
+    detail = detail or {}
+    negotiation = detail.get('negotiation') or {}
+    seller_proof = detail.get('seller_proof') or {}
+    seller_compensation = detail.get('seller_compensation') or {}
+    evidence_deadline = seller_proof.get('seller_evidence_deadline')
+    return {
+        "Solusi Negosiasi": negotiation.get('latest_solution', ''),
+        "Penawaran Terakhir": negotiation.get('latest_offer_amount', ''),
+        "Status Bukti Penjual": seller_proof.get('seller_proof_status', ''),
+        "Batas Bukti Penjual": datetime.fromtimestamp(evidence_deadline).strftime('%Y-%m-%d %H:%M:%S') if evidence_deadline else '',
+        "Status Logistik Retur": detail.get('logistics_status', ''),
+        "Status Kompensasi Penjual": seller_compensation.get('seller_compensation_status', '')
+    }
+
+def get_batch_order_and_tracking_details(shop_id, access_token, order_sns, progress_callback=None, export_id=None):
+    """
+    Efficiently fetches order details and tracking numbers for a list of order_sn
+    using batch processing for order details.
+    """
+    order_details_map = {}
+    tracking_numbers_map = {}
+    unique_order_sns = list(set(order_sns))
+    total_sns = len(unique_order_sns)
+    
+    app.logger.info(f"Starting batch fetch for {total_sns} unique order SNs.")
+
+    detail_path = "/api/v2/order/get_order_detail"
+
+    # Helper function for parallel execution
+    def fetch_order_detail_chunk(chunk, shop_id, access_token, export_id):
+        return fetch_order_details_batch(shop_id, access_token, chunk, export_id)
 
     # === Batch fetch order details with parallel execution ===
-    order_chunk_size = 50  # Max 50 per call for get_order_detail
+    # Batch size dan jumlah paralel diambil dari profil endpoint (hasil probe + traffic live)
+    order_chunk_size = get_endpoint_size(detail_path)
     order_chunks = [unique_order_sns[i:i + order_chunk_size] for i in range(0, total_sns, order_chunk_size)]
-    
-    # Use ThreadPoolExecutor for parallel API calls
-    # Limiting max_workers to a reasonable number to avoid overwhelming the API
-    max_parallel_calls = 5 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_parallel_calls) as executor:
+
+    with AdaptiveExecutor(detail_path, shop_id, thread_name_prefix='order-detail') as executor:
         future_to_chunk = {executor.submit(fetch_order_detail_chunk, chunk, shop_id, access_token, export_id): chunk for chunk in order_chunks}
         
         for i, future in enumerate(concurrent.futures.as_completed(future_to_chunk)):
-            chunk = future_to_chunk[future]
             if progress_callback:
                 progress = 75 + (i / len(order_chunks)) * 10
                 progress_callback(progress, f'Mengambil detail pesanan batch {i+1}/{len(order_chunks)} (parallel)...')
@@ -1404,46 +3198,70 @@ def get_batch_order_and_tracking_details(shop_id, access_token, order_sns, progr
             except Exception as exc:
                 app.logger.error(f'Chunk generated an exception: {exc}')
 
-    # === Fetch tracking numbers (one by one, as there's no batch endpoint) ===
-    for i, order_sn in enumerate(unique_order_sns):
-        if progress_callback:
-            # Progress for this sub-step (e.g., from 85% to 95%)
-            progress = 85 + (i / total_sns) * 10
-            progress_callback(progress, f'Mengambil no. resi {i+1}/{total_sns}...')
+    # === Fetch tracking numbers (no batch endpoint: one call per order, in parallel) ===
+    tracking_path = "/api/v2/logistics/get_tracking_number"
 
-        # First, check if tracking is available in the already-fetched order detail
-        order_detail = order_details_map.get(order_sn, {})
-        tracking_number = order_detail.get('tracking_number') # Some orders have it directly
-        if not tracking_number:
-            # If not, call the specific logistics API
-            try:
-                tracking_params = {"order_sn": order_sn}
-                tracking_response, tracking_error = call_shopee_api(
-                    "/api/v2/logistics/get_tracking_number", 
-                    method='GET', 
-                    shop_id=shop_id, 
-                    access_token=access_token, 
-                    body=tracking_params, 
-                    max_retries=1,
-                    export_id=export_id
-                )
-                if tracking_response and not tracking_error:
-                    tracking_number = tracking_response.get('response', {}).get('tracking_number', '')
-                else:
-                    app.logger.warning(f"Could not get tracking number for {order_sn}: {tracking_error}")
-            except Exception as e:
-                app.logger.error(f"Exception getting tracking number for {order_sn}: {e}")
+    def fetch_tracking(order_sn):
+        # Dilewati selama circuit breaker logistics API terbuka
+        if shopee_circuit_breakers.is_open(shop_id, tracking_path):
+            return ""
+        return fetch_tracking_number(shop_id, access_token, order_sn, export_id)
 
-        tracking_numbers_map[order_sn] = tracking_number or "" # Ensure it's a string
-                    
+    missing_sns = []
+    for order_sn in unique_order_sns:
+        # Some orders already carry the tracking number in the order detail
+        tracking_number = order_details_map.get(order_sn, {}).get('tracking_number')
+        if tracking_number:
+            tracking_numbers_map[order_sn] = tracking_number
+        else:
+            missing_sns.append(order_sn)
+
+    with AdaptiveExecutor(tracking_path, shop_id, thread_name_prefix='order-tracking') as executor:
+        future_to_sn = {executor.submit(fetch_tracking, order_sn): order_sn for order_sn in missing_sns}
+        for i, future in enumerate(concurrent.futures.as_completed(future_to_sn)):
+            if progress_callback:
+                # Progress for this sub-step (e.g., from 85% to 95%)
+                progress = 85 + (i / len(missing_sns)) * 10
+                progress_callback(progress, f'Mengambil no. resi {i+1}/{len(missing_sns)} (parallel)...')
+            try:
+                tracking_numbers_map[future_to_sn[future]] = future.result() or "" # Ensure it's a string
+            except Exception as exc:
+                app.logger.error(f'Tracking lookup generated an exception: {exc}')
+                tracking_numbers_map[future_to_sn[future]] = ""
 
     app.logger.info(f"Finished batch fetch. Got details for {len(order_details_map)} orders and {len(tracking_numbers_map)} tracking numbers.")
     return order_details_map, tracking_numbers_map
 
-def format_return_data_for_excel(chunk_returns, order_details_map, tracking_numbers_map):
+def process_chunk_data(chunk_data, data_type, shop_id, access_token, export_id=None, include_return_detail=False):
+    """
+    Ambil detail pesanan + no. resi untuk satu chunk data retur lalu format untuk Excel.
+    Jika include_return_detail, detail retur diambil paralel selagi detail pesanan diproses.
+    """
+    if data_type != 'returns' or not chunk_data:
+        return []
+    order_sns = [item['order_sn'] for item in chunk_data if item.get('order_sn')]
+    if not include_return_detail:
+        order_details_map, tracking_numbers_map = get_batch_order_and_tracking_details(
+            shop_id, access_token, order_sns, export_id=export_id
+        )
+        return format_return_data_for_excel(chunk_data, order_details_map, tracking_numbers_map)
+
+    with AdaptiveExecutor(RETURN_DETAIL_PATH, shop_id, thread_name_prefix='return-detail') as return_detail_executor:
+        collect_return_details = request_return_details(
+            shop_id, access_token, [item['return_sn'] for item in chunk_data if item.get('return_sn')],
+            return_detail_executor, export_id
+        )
+        order_details_map, tracking_numbers_map = get_batch_order_and_tracking_details(
+            shop_id, access_token, order_sns, export_id=export_id
+        )
+        return_details_map = collect_return_details()
+    return format_return_data_for_excel(chunk_data, order_details_map, tracking_numbers_map, return_details_map)
+
+def format_return_data_for_excel(chunk_returns, order_details_map, tracking_numbers_map, return_details_map=None):
     """
     Formats the raw return data into a list of dictionaries for Excel export.
     Crucially, it creates a SEPARATE ROW for each item in a return.
+    Kolom detail retur ditambahkan jika return_details_map diberikan.
     """
     if not chunk_returns:
         return []
@@ -1483,6 +3301,8 @@ def format_return_data_for_excel(chunk_returns, order_details_map, tracking_numb
             "Negotiation Status": item.get('negotiation_status'),
             "Needs Logistics": "Ya" if item.get('needs_logistics') else "Tidak"
         }
+        if return_details_map is not None:
+            parent_info.update(format_return_detail_columns(return_details_map.get(item.get('return_sn'))))
 
         # Loop through each product in the return and create a row for it
         items_data = item.get('item', [])
@@ -1513,10 +3333,11 @@ def format_return_data_for_excel(chunk_returns, order_details_map, tracking_numb
     
     return processed_items
 
-def format_combined_data_for_excel(combined_data, order_details_map, tracking_numbers_map):
+def format_combined_data_for_excel(combined_data, order_details_map, tracking_numbers_map, return_details_map=None):
     """
     Formats combined data (returns, failed deliveries, cancelled orders) into a list of dictionaries for Excel export.
     Creates a SEPARATE ROW for each item in a return, failed delivery, or cancelled order.
+    Kolom detail retur ditambahkan jika return_details_map diberikan.
     """
     processed_rows = []
 
@@ -1530,6 +3351,8 @@ def format_combined_data_for_excel(combined_data, order_details_map, tracking_nu
         "Negotiation Status", "Needs Logistics", "SKU Code", "Nama Produk", "Qty",
         "Harga Satuan", "Harga Diskon", "Kota Pembeli", "Provinsi Pembeli"
     ]
+    if return_details_map is not None:
+        all_columns += RETURN_DETAIL_COLUMNS
 
     for item_data in combined_data:
         item_type = item_data.get('type')
@@ -1543,7 +3366,7 @@ def format_combined_data_for_excel(combined_data, order_details_map, tracking_nu
         order_update_time = datetime.fromtimestamp(order_detail.get('update_time')).strftime('%Y-%m-%d %H:%M:%S') if order_detail.get('update_time') else None
         
         is_cod = order_detail.get('cod', False)
-        payment_method = "COD (Cash on Delivery)" if is_cod else order_detail.get('payment_method_name', 'Online Payment')
+        payment_method = "COD (Cash on Delivery)" if is_cod else (order_detail.get('payment_method') or 'Online Payment')
         
         buyer_username = order_detail.get('buyer_username')
         buyer_city = order_detail.get('recipient_address', {}).get('city')
@@ -1584,6 +3407,8 @@ def format_combined_data_for_excel(combined_data, order_details_map, tracking_nu
                 "Negotiation Status": item_data.get('negotiation_status'),
                 "Needs Logistics": "Ya" if item_data.get('needs_logistics') else "Tidak"
             })
+            if return_details_map is not None:
+                parent_info.update(format_return_detail_columns(return_details_map.get(item_data.get('return_sn'))))
             items_list_for_excel = item_data.get('item', [])
             if not items_list_for_excel: # Handle returns with no item data
                 items_list_for_excel.append({'name': 'N/A (No item data in return)', 'amount': 0, 'variation_sku': '', 'item_sku': ''})
@@ -1648,16 +3473,87 @@ def format_combined_data_for_excel(combined_data, order_details_map, tracking_nu
 
 
 
+# Kata kunci cancel_reason yang menandakan pesanan batal karena gagal kirim
+FAILED_DELIVERY_KEYWORDS = [
+    "DISTRIBUTION_FAILED_CREATE_OUT_ORDER",
+    "DISTRIBUTION_UNASSIGNED_WAREHOUSE",
+    "failed delivery", # Common phrase
+    "gagal kirim", # Indonesian phrase
+    "pengiriman gagal", # Indonesian phrase
+    "alamat tidak ditemukan",
+    "penerima tidak dikenal",
+    "kurir tidak dapat menemukan lokasi"
+]
+
+# Jumlah maksimal item yang menunggu di antrian pipeline laporan gabungan
+COMBINED_PIPELINE_QUEUE_SIZE = 500
+
+# Jumlah sumber list (retur, chunk pesanan batal, gagal kirim) yang dipaging bersamaan
+COMBINED_SOURCE_CONCURRENCY = 4
+
+# Batch detail yang belum penuh baru dikirim setelah item pertamanya menunggu sekian detik
+# (atau saat semua sumber selesai), supaya listing yang lambat tidak memicu banyak panggilan kecil
+COMBINED_PARTIAL_BATCH_WAIT = 5.0
+
+def classify_failed_delivery(item, order_detail):
+    """Tandai ulang pesanan batal sebagai failed_delivery jika cancel_reason menunjukkan gagal kirim."""
+    cancellation_reason = order_detail.get('cancel_reason', '')
+    if not cancellation_reason:
+        return
+    if any(keyword.lower() in cancellation_reason.lower() for keyword in FAILED_DELIVERY_KEYWORDS):
+        item['type'] = 'failed_delivery' # Re-tag as failed_delivery
+        item['failed_delivery_reason'] = cancellation_reason # Store the reason
+        item['create_time'] = order_detail.get('create_time') # Use order create time
+
+def enrich_combined_batch(shop_id, access_token, batch_items, tracking_executor, export_id=None, return_detail_executor=None):
+    """
+    Ambil detail pesanan (satu batch get_order_detail) dan no. resi (paralel) untuk satu batch
+    data laporan gabungan, lalu kembalikan baris Excel-nya. Jika return_detail_executor
+    diberikan, detail retur ikut diambil paralel.
+    """
+    collect_return_details = None
+    if return_detail_executor:
+        collect_return_details = request_return_details(
+            shop_id, access_token, [item['return_sn'] for item in batch_items if item['type'] == 'return' and item.get('return_sn')],
+            return_detail_executor, export_id
+        )
+    order_sns = list({item['order_sn'] for item in batch_items if item.get('order_sn')})
+    order_details_map = {
+        detail['order_sn']: detail
+        for detail in fetch_order_details_batch(shop_id, access_token, order_sns, export_id, ORDER_DETAIL_OPTIONAL_FIELDS)
+    }
+
+    tracking_numbers_map = {sn: order_details_map.get(sn, {}).get('tracking_number') or "" for sn in order_sns}
+    missing_tracking = [sn for sn in order_sns if not tracking_numbers_map[sn]]
+    if missing_tracking and shopee_circuit_breakers.is_open(shop_id, "/api/v2/logistics/get_tracking_number"):
+        # API no. resi sedang gagal terus: lewati, baris tetap ditulis dengan no. resi kosong
+        app.logger.warning(f"Tracking API unavailable for shop {shop_id}, skipping {len(missing_tracking)} tracking lookups")
+        missing_tracking = []
+    fetched_numbers = tracking_executor.map(lambda sn: fetch_tracking_number(shop_id, access_token, sn, export_id), missing_tracking)
+    for order_sn, tracking_number in zip(missing_tracking, fetched_numbers):
+        tracking_numbers_map[order_sn] = tracking_number or ""
+
+    for item in batch_items:
+        if item['type'] == 'cancelled_order':
+            classify_failed_delivery(item, order_details_map.get(item.get('order_sn'), {}))
+
+    return_details_map = collect_return_details() if collect_return_details else None
+    return format_combined_data_for_excel(batch_items, order_details_map, tracking_numbers_map, return_details_map)
+
 def process_combined_data_global(export_id, access_token):
     """
-    Get ALL returns, failed deliveries, and cancelled orders, filter manually, then use BATCH processing to get details.
+    Laporan gabungan (retur, pesanan dibatalkan, gagal kirim) sebagai pipeline streaming:
+    setiap sumber list dipaging paralel oleh producer-nya sendiri, item di-dedupe lalu masuk ke
+    antrian terbatas, batch detail/no. resi diproses paralel begitu item tersedia, dan baris
+    hasil langsung ditulis ke spool.
     """
-    app.logger.info("=== STARTING process_combined_data_global (v5 - Combined Report) ===")
+    app.logger.info("=== STARTING process_combined_data_global (v7 - Parallel Sources Pipeline) ===")
     
     if export_id not in export_progress_store:
         return
     
     export_data = export_progress_store[export_id]
+    export_data['status'] = 'processing'
     
     def update_progress(progress, step):
         export_data['progress'] = round(progress, 1)
@@ -1677,152 +3573,217 @@ def process_combined_data_global(export_id, access_token):
         return
 
     shop_id = export_data['shop_id']
-    combined_raw_data = []
-    all_order_sns_for_detail_fetch = set()
+    spool = attach_result_spool(export_data)
 
-    # Step 2: Fetch all raw return data (NO DATE FILTERING AT API LEVEL)
-    update_progress(5.0, 'Mengambil SEMUA data retur dari API...')
-    all_raw_returns = []
-    page_no = 1
-    while True:
-        update_progress(5 + (page_no * 0.1), f'Mengambil halaman {page_no} (data retur)...')
-        response, error = call_shopee_api("/api/v2/returns/get_return_list", method='GET', 
-                                        shop_id=shop_id, access_token=access_token, body={"page_no": page_no, "page_size": 100}, export_id=export_id)
+    item_queue = queue.Queue(maxsize=COMBINED_PIPELINE_QUEUE_SIZE)
+    end_of_stream = object()
+    pipeline_state = {'error': None, 'listed': 0, 'pages': 0, 'enriched': 0, 'listing_done': False}
+    state_lock = threading.Lock()
+    seen_keys = set()
+    stop_event = threading.Event()
+
+    def put_item(item):
+        # Dedupe lintas sumber berdasarkan (type, return_sn/order_sn)
+        item_sn = item.get('return_sn') if item['type'] == 'return' else item.get('order_sn')
+        with state_lock:
+            if (item['type'], item_sn) in seen_keys:
+                return
+            seen_keys.add((item['type'], item_sn))
+            pipeline_state['listed'] += 1
+        # Blok saat antrian penuh (backpressure), kecuali pipeline sudah dihentikan
+        while not stop_event.is_set():
+            try:
+                item_queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def stream_pages(pages, item_type, error_label, item_filter=None):
+        """Paging satu sumber dan masukkan item-nya ke antrian. Mengembalikan pesan error atau None."""
+        for page_no, item_list, error in pages:
+            if error:
+                return f"Gagal mengambil {error_label}: {error}"
+            with state_lock:
+                pipeline_state['pages'] += 1
+            for item in item_list:
+                if item_filter is None or item_filter(item):
+                    item['type'] = item_type
+                    put_item(item)
+            if stop_event.is_set():
+                return None
+        return None
+
+    # Step 2: Producers - setiap sumber punya paginator sendiri dan berjalan paralel
+    def in_date_range(item):
+        return bool(item.get('create_time')) and date_from <= datetime.fromtimestamp(item['create_time']) <= date_to
+
+    # Toko yang sudah disinkronkan: retur dan pesanan batal dibaca dari penyimpanan lokal setelah delta diambil
+    update_progress(2.0, 'Memeriksa data lokal...')
+    local_returns = load_synced_records(shop_id, access_token, 'returns', date_from.timestamp(), date_to.timestamp())
+    local_cancelled = load_synced_records(shop_id, access_token, 'orders', date_from.timestamp(), date_to.timestamp(),
+                                          statuses=('CANCELLED',))
+
+    # (nama sumber, fungsi fetch, wajib?)
+    sources = [(
+        'retur',
+        # Retur tanpa filter tanggal di API (supaya RRBOC ikut), difilter manual
+        lambda: stream_pages(iterate_local_pages(local_returns), 'return', 'daftar retur') if local_returns is not None else
+                stream_pages(iterate_return_pages(shop_id, access_token, export_id=export_id), 'return', 'daftar retur', in_date_range),
+        True
+    )]
+    if local_cancelled is not None:
+        sources.append(('pesanan dibatalkan (lokal)',
+                        lambda: stream_pages(iterate_local_pages(local_cancelled), 'cancelled_order', 'daftar pesanan dibatalkan'),
+                        True))
+    # Pecah rentang tanggal jadi chunk 15 hari untuk API pesanan, satu paginator per chunk
+    for chunk_start, chunk_end in ([] if local_cancelled is not None else
+                                   get_date_chunks(export_data['date_from'], export_data['date_to'], 15)):
+        order_body = {
+            "time_range_field": "create_time",
+            "time_from": int(chunk_start.timestamp()),
+            "time_to": int(chunk_end.replace(hour=23, minute=59, second=59).timestamp()),
+            "order_status": "CANCELLED"
+        }
+        sources.append((
+            f"pesanan dibatalkan {chunk_start.strftime('%Y-%m-%d')}",
+            lambda body=order_body: stream_pages(
+                iterate_shopee_pages("/api/v2/order/get_order_list", shop_id, access_token, body=body, export_id=export_id),
+                'cancelled_order', 'daftar pesanan dibatalkan'
+            ),
+            True
+        ))
+    if export_data.get('include_failed_delivery'):
+        failed_delivery_body = {
+            "create_time_from": int(date_from.timestamp()),
+            "create_time_to": int(date_to.timestamp())
+        }
+        sources.append((
+            'gagal kirim',
+            lambda: stream_pages(
+                iterate_shopee_pages("/api/v2/logistics/get_failed_delivery_list", shop_id, access_token,
+                                     body=failed_delivery_body, export_id=export_id),
+                'failed_delivery', 'daftar gagal kirim'
+            ),
+            False
+        ))
+
+    def run_source(source_name, fetch_source, required):
+        try:
+            error = fetch_source()
+        except Exception as e:
+            app.logger.error(f"Combined report source '{source_name}' error: {e}")
+            error = str(e)
         if error:
-            export_data['error'] = f"Gagal mengambil daftar retur: {error}"
-            export_data['status'] = 'error'
-            return
-        return_list = response.get('response', {}).get('return', [])
-        if not return_list: break
-        all_raw_returns.extend(return_list)
-        page_no += 1
-        if page_no > 200: break # Safety break
-    update_progress(10.0, f'Selesai mengambil {len(all_raw_returns)} data retur.')
-    for item in all_raw_returns:
-        item['type'] = 'return'
-        combined_raw_data.append(item)
-        if 'order_sn' in item: all_order_sns_for_detail_fetch.add(item['order_sn'])
-
-    # Step 3: Fetch Cancelled Orders (WITH DATE FILTERING AT API LEVEL)
-    update_progress(15.0, 'Mengambil data pesanan dibatalkan dari API...')
-    all_raw_cancelled_orders = []
-    
-    # Break down date range into 15-day chunks for API calls
-    order_date_chunks = get_date_chunks(export_data['date_from'], export_data['date_to'], 15)
-    app.logger.info(f"Created {len(order_date_chunks)} date chunks for cancelled orders.")
-
-    for chunk_index, (chunk_start, chunk_end) in enumerate(order_date_chunks):
-        app.logger.info(f"Processing cancelled orders chunk {chunk_index + 1}/{len(order_date_chunks)}: {chunk_start.strftime('%Y-%m-%d')} to {chunk_end.strftime('%Y-%m-%d')}")
-        page_no = 1
-        cursor = ""
+            if required:
+                pipeline_state['error'] = error
+                stop_event.set() # Hentikan sumber lain, laporan tidak bisa lengkap
+            else:
+                # Sumber opsional (mis. API gagal kirim yang belum aktif) tidak menggagalkan laporan
+                app.logger.warning(f"Optional source '{source_name}' skipped: {error}")
+                export_data.setdefault('source_warnings', []).append(error)
         while True:
-            update_progress(15 + (chunk_index * 5) + (page_no * 0.1), f'Mengambil halaman {page_no} (pesanan dibatalkan chunk {chunk_index + 1})...')
-            order_body = {
-                "page_size": 100, # Max page size
-                "time_range_field": "create_time",
-                "time_from": int(chunk_start.timestamp()),
-                "time_to": int(chunk_end.timestamp()),
-                "order_status": "CANCELLED",
-                "cursor": cursor
-            }
-            response, error = call_shopee_api("/api/v2/order/get_order_list", method='GET', 
-                                            shop_id=shop_id, access_token=access_token, body=order_body, export_id=export_id)
-            if error:
-                export_data['error'] = f"Gagal mengambil daftar pesanan dibatalkan: {error}"
+            try:
+                item_queue.put(end_of_stream, timeout=0.5)
+                break
+            except queue.Full:
+                if stop_event.is_set():
+                    break
+
+    source_executor = concurrent.futures.ThreadPoolExecutor(max_workers=COMBINED_SOURCE_CONCURRENCY, thread_name_prefix='combined-source')
+    for source_name, fetch_source, required in sources:
+        source_executor.submit(run_source, source_name, fetch_source, required)
+    remaining_sources = len(sources)
+    app.logger.info(f"Started {len(sources)} combined report sources in parallel")
+
+    # Step 3: Consumer - batch item ke worker detail/no. resi, tulis hasil ke spool
+    detail_path = "/api/v2/order/get_order_detail"
+    batch_size = get_endpoint_size(detail_path)
+    pending_batches = collections.deque()
+
+    def report_progress():
+        if not pipeline_state['listing_done']:
+            progress = min(50.0, 5.0 + pipeline_state['pages'] * 0.5)
+        else:
+            progress = 50.0 + 45.0 * pipeline_state['enriched'] / max(1, pipeline_state['listed'])
+        update_progress(progress, f"Halaman list: {pipeline_state['pages']}, data: {pipeline_state['listed']}, "
+                                  f"selesai diperkaya: {pipeline_state['enriched']}, baris: {export_data['data_count']}")
+
+    def spool_finished_batches(max_pending):
+        while pending_batches and (pending_batches[0][1].done() or len(pending_batches) > max_pending):
+            batch_len, future = pending_batches.popleft()
+            spool_export_rows(export_data, spool, future.result())
+            pipeline_state['enriched'] += batch_len
+            report_progress()
+
+    with AdaptiveExecutor(detail_path, shop_id, thread_name_prefix='combined-detail') as detail_executor, \
+            AdaptiveExecutor("/api/v2/logistics/get_tracking_number", shop_id, thread_name_prefix='combined-tracking') as tracking_executor, \
+            AdaptiveExecutor(RETURN_DETAIL_PATH, shop_id, thread_name_prefix='combined-return-detail') as return_detail_executor:
+        if not export_data.get('include_return_detail'):
+            return_detail_executor = None
+
+        def submit_batch(batch_items):
+            future = detail_executor.submit(enrich_combined_batch, shop_id, access_token, batch_items, tracking_executor,
+                                            export_id, return_detail_executor)
+            pending_batches.append((len(batch_items), future))
+
+        batch = []
+        batch_deadline = None
+        try:
+            while True:
+                try:
+                    item = item_queue.get(timeout=0.5)
+                except queue.Empty:
+                    item = None
+                if item is end_of_stream:
+                    remaining_sources -= 1
+                    if remaining_sources == 0:
+                        pipeline_state['listing_done'] = True
+                        break
+                    continue
+                if item is not None:
+                    if not batch:
+                        batch_deadline = time.monotonic() + COMBINED_PARTIAL_BATCH_WAIT
+                    batch.append(item)
+                # Batch penuh dikirim langsung; batch sebagian hanya jika sudah menunggu melewati batas
+                if batch and (len(batch) >= batch_size or time.monotonic() >= batch_deadline):
+                    submit_batch(batch)
+                    batch = []
+                # Jumlah batch yang boleh menunggu mengikuti batas concurrency adaptif saat ini
+                spool_finished_batches(detail_executor.current_limit * 2)
+                if pipeline_state['error']:
+                    break
+                if item is None:
+                    report_progress()
+
+            source_executor.shutdown()
+            if pipeline_state['error']:
+                for _, future in pending_batches:
+                    future.cancel()
+                discard_export_results(export_data)
+                export_data['error'] = pipeline_state['error']
                 export_data['status'] = 'error'
                 return
-            order_list = response.get('response', {}).get('order_list', [])
-            if not order_list: break
-            all_raw_cancelled_orders.extend(order_list)
-            cursor = response.get('response', {}).get('next_cursor', '')
-            if not cursor: break
-            page_no += 1
-            if page_no > 200: break # Safety break
-    update_progress(20.0, f'Selesai mengambil {len(all_raw_cancelled_orders)} pesanan dibatalkan.')
-    for item in all_raw_cancelled_orders:
-        item['type'] = 'cancelled_order'
-        item['create_time'] = item.get('create_time') # Use create time for filtering
-        combined_raw_data.append(item)
-        if 'order_sn' in item: all_order_sns_for_detail_fetch.add(item['order_sn'])
-
-    # Step 4: Manual date filtering for returns and failed deliveries
-    update_progress(25.0, f'Menyaring {len(combined_raw_data)} data berdasarkan tanggal...')
-    filtered_data = []
-    for item in combined_raw_data:
-        # Cancelled orders are already filtered by API
-        if item['type'] == 'cancelled_order':
-            filtered_data.append(item)
-        elif item.get('create_time'):
-            item_date = datetime.fromtimestamp(item['create_time'])
-            if date_from <= item_date <= date_to:
-                filtered_data.append(item)
-    
-    app.logger.info(f"After filtering: {len(filtered_data)} records match criteria.")
-    if not filtered_data:
+
+            if batch:
+                submit_batch(batch)
+            spool_finished_batches(0)
+        except BaseException:
+            # Hentikan sumber dan hapus spool yang setengah jadi sebelum error diteruskan
+            stop_event.set()
+            source_executor.shutdown(wait=False)
+            for _, future in pending_batches:
+                future.cancel()
+            discard_export_results(export_data)
+            raise
+
+    if not export_data['data_count']:
         update_progress(100.0, 'Selesai! Tidak ada data yang cocok dalam rentang tanggal yang dipilih.')
         export_data['status'] = 'completed'
-        export_data['data'] = []
         return
 
-    # Step 5: BATCH fetch all required details for all order_sns
-    update_progress(30.0, f'Mempersiapkan pengambilan detail untuk {len(all_order_sns_for_detail_fetch)} order SNs...')
-    order_details_map, tracking_numbers_map = get_batch_order_and_tracking_details(
-        shop_id, access_token, list(all_order_sns_for_detail_fetch), 
-        lambda p, s: update_progress(30 + (p/100*40), s), # Scale batch progress to 30-70% range
-        export_id
-    )
-
-    # Step 6: Identify Failed Deliveries from Cancelled Orders (if not already identified)
-    # This step is crucial if the API doesn't explicitly mark failed deliveries.
-    # We will iterate through the cancelled orders and check their cancellation_reason.
-    update_progress(70.0, 'Mengidentifikasi pesanan gagal kirim dari pesanan dibatalkan...')
-    final_processed_data = []
-    for item in filtered_data:
-        if item['type'] == 'cancelled_order':
-            order_detail = order_details_map.get(item['order_sn'], {})
-            cancellation_reason = order_detail.get('cancel_reason', '')
-            
-            # Check for keywords indicating failed delivery
-            failed_delivery_keywords = [
-                "DISTRIBUTION_FAILED_CREATE_OUT_ORDER",
-                "DISTRIBUTION_UNASSIGNED_WAREHOUSE",
-                "failed delivery", # Common phrase
-                "gagal kirim", # Indonesian phrase
-                "pengiriman gagal", # Indonesian phrase
-                "alamat tidak ditemukan",
-                "penerima tidak dikenal",
-                "kurir tidak dapat menemukan lokasi"
-            ]
-            
-            is_failed_delivery = False
-            if cancellation_reason:
-                for keyword in failed_delivery_keywords:
-                    if keyword.lower() in cancellation_reason.lower():
-                        is_failed_delivery = True
-                        break
-            
-            if is_failed_delivery:
-                item['type'] = 'failed_delivery' # Re-tag as failed_delivery
-                item['failed_delivery_reason'] = cancellation_reason # Store the reason
-                item['create_time'] = order_detail.get('create_time') # Use order create time
-            
-        final_processed_data.append(item)
-
-    # Step 7: Format for Excel
-    update_progress(95.0, 'Menggabungkan data dan menyusun untuk Excel...')
-    processed_data = format_combined_data_for_excel(
-        final_processed_data, 
-        order_details_map, 
-        tracking_numbers_map
-    )
-    
-    export_data['data'] = processed_data
     export_data['status'] = 'completed'
-    update_progress(100.0, f'Selesai! {len(processed_data)} baris data berhasil diproses.')
-    app.logger.info(f"Export completed with {len(processed_data)} rows (Combined Report).")
-
-
-
+    update_progress(100.0, f'Selesai! {export_data["data_count"]} baris data berhasil diproses.')
+    app.logger.info(f"Export completed with {export_data['data_count']} rows (Combined Report).")
 
 
 def process_returns_with_date_filter_global(export_id, access_token):
@@ -1840,7 +3801,6 @@ def process_returns_with_date_filter_global(export_id, access_token):
     # Load checkpoint if exists
     checkpoint = load_checkpoint(export_id)
     start_chunk_index = checkpoint.get('chunk_index', 0)
-    start_page_no = checkpoint.get('page_no', 1)
     
     app.logger.info(f"Shop ID: {export_data['shop_id']}")
     app.logger.info(f"WITH DATE FILTER - excludes RRBOC returns")
@@ -1865,52 +3825,34 @@ def process_returns_with_date_filter_global(export_id, access_token):
         export_data['progress'] = round(chunk_progress, 1)
         export_data['current_step'] = f'Memproses chunk {chunk_index + 1}/{len(date_chunks)} ({chunk_start.strftime("%Y-%m-%d")} to {chunk_end.strftime("%Y-%m-%d")})'
         
-        page_no = start_page_no if chunk_index == start_chunk_index else 1
         chunk_returns = []
-        
-        while True:
-            page_progress = min(page_no / 50, 0.9) * (75.0 / len(date_chunks))
-            current_progress = 5.0 + (chunk_index / len(date_chunks)) * 75.0 + page_progress
-            export_data['progress'] = round(min(85.0, current_progress), 1)
-            export_data['current_step'] = f'Chunk {chunk_index + 1}/{len(date_chunks)} - Halaman {page_no}...'
-            
-            # API call WITH date filter (original logic)
-            return_body = {
-                "page_no": page_no, 
-                "page_size": 20,  # Optimized: 2x increase for better throughput
-                "create_time_from": int(chunk_start.timestamp()),
-                "create_time_to": int(chunk_end.timestamp())
-            }
-            
-            response, error = call_shopee_api("/api/v2/returns/get_return_list", method='GET', 
-                                            shop_id=shop_id, access_token=access_token, body=return_body)
-            
+
+        # API call WITH date filter (original logic), page size dari profil endpoint
+        return_body = {
+            "create_time_from": int(chunk_start.timestamp()),
+            "create_time_to": int(chunk_end.timestamp())
+        }
+        for page_no, return_list, error in iterate_return_pages(shop_id, access_token, body=return_body,
+                                                                export_id=export_id, max_pages=40):
             if error:
                 export_data['error'] = f"Gagal mengambil daftar retur: {error}"
                 export_data['status'] = 'error'
                 return
-                
-            return_list = response.get('response', {}).get('return', [])
-            if not return_list:
-                break
-                
+
+            page_progress = min(page_no / 50, 0.9) * (75.0 / len(date_chunks))
+            current_progress = 5.0 + (chunk_index / len(date_chunks)) * 75.0 + page_progress
+            export_data['progress'] = round(min(85.0, current_progress), 1)
+            export_data['current_step'] = f'Chunk {chunk_index + 1}/{len(date_chunks)} - Halaman {page_no}...'
+
             chunk_returns.extend(return_list)
             total_processed += len(return_list)
-            
-            # Removed time.sleep(0.6) - research shows API self-throttles
-            page_no += 1
-            
-            if page_no > 40:
-                break
-        
+
         # Process chunk data
         if chunk_returns:
-            processed_chunk_data = process_chunk_data(chunk_returns, 'returns', shop_id, access_token)
+            processed_chunk_data = process_chunk_data(chunk_returns, 'returns', shop_id, access_token, export_id)
             all_processed_data.extend(processed_chunk_data)
             del chunk_returns
             del processed_chunk_data
-        
-        start_page_no = 1
     
     # Finalize export
     export_data['current_step'] = 'Menyelesaikan export...'
@@ -1934,141 +3876,1573 @@ def process_returns_with_date_filter_global(export_id, access_token):
     
     del all_processed_data
 
-def process_orders_chunked_global(export_id, access_token):
-    """Process orders data in small chunks using global store."""
-    app.logger.info("=== STARTING process_orders_chunked_global ===")
-    
+def process_returns_with_manual_filter_global(export_id, access_token):
+    """
+    Process returns data WITHOUT date filter at API level, then filter manually by create_time.
+    Includes RRBOC returns that get_return_list omits when create_time filters are used.
+    """
+    app.logger.info("=== STARTING process_returns_with_manual_filter_global (MANUAL FILTER) ===")
+
+    if export_id not in export_progress_store:
+        return
+
+    export_data = export_progress_store[export_id]
+    export_data['status'] = 'processing'
+    export_data['current_step'] = 'Memvalidasi rentang tanggal...'
+    export_data['progress'] = 5.0
+
+    try:
+        date_from = datetime.strptime(export_data['date_from'], '%Y-%m-%d').replace(hour=0, minute=0, second=0)
+        date_to = datetime.strptime(export_data['date_to'], '%Y-%m-%d').replace(hour=23, minute=59, second=59)
+    except (ValueError, TypeError, KeyError):
+        export_data['status'] = 'error'
+        export_data['error'] = 'Error: Rentang tanggal wajib diisi dengan format YYYY-MM-DD.'
+        return
+
+    shop_id = export_data['shop_id']
+    export_data['current_step'] = 'Memeriksa data retur lokal...'
+    # Toko yang sudah disinkronkan cukup mengambil delta, lalu dibaca dari penyimpanan lokal
+    filtered_returns = load_synced_records(shop_id, access_token, 'returns', date_from.timestamp(), date_to.timestamp())
+
+    if filtered_returns is None:
+        filtered_returns = []
+        for page_no, return_list, error in iterate_return_pages(shop_id, access_token, export_id=export_id, max_pages=200):
+            if error:
+                export_data['error'] = f"Gagal mengambil daftar retur: {error}"
+                export_data['status'] = 'error'
+                return
+
+            export_data['progress'] = round(min(60.0, 5.0 + page_no * 0.5), 1)
+            export_data['current_step'] = f'Mengambil halaman {page_no} (data retur)...'
+
+            for item in return_list:
+                if item.get('create_time') and date_from <= datetime.fromtimestamp(item['create_time']) <= date_to:
+                    filtered_returns.append(item)
+
+    app.logger.info(f"After manual filtering: {len(filtered_returns)} returns match date range")
+
+    if not filtered_returns:
+        export_data['status'] = 'completed'
+        export_data['progress'] = 100.0
+        export_data['current_step'] = 'Tidak ada data retur ditemukan dalam rentang tanggal'
+        export_data['data'] = []
+        return
+
+    export_data['progress'] = 65.0
+    export_data['current_step'] = f'Mengambil detail pesanan untuk {len(filtered_returns)} retur...'
+    processed_data = process_chunk_data(filtered_returns, 'returns', shop_id, access_token, export_id,
+                                        include_return_detail=export_data.get('include_return_detail', False))
+    spool_export_rows(export_data, attach_result_spool(export_data), processed_data)
+
+    export_data['status'] = 'completed'
+    export_data['progress'] = 100.0
+    export_data['current_step'] = f'Selesai! {len(processed_data)} baris retur berhasil diproses (FILTER MANUAL + RRBOC)'
+    app.logger.info(f"Export completed with {len(processed_data)} records (MANUAL FILTER)")
+
+def format_order_data_for_excel(orders):
+    """Formats order data (list + detail fields) into a list of dictionaries for Excel export."""
+    processed_orders = []
+    for order in orders:
+        recipient_address = order.get('recipient_address') or {}
+        processed_orders.append({
+            "Nomor Pesanan": order.get('order_sn'),
+            "Status Pesanan": order.get('order_status'),
+            "Tanggal Dibuat": datetime.fromtimestamp(order.get('create_time')).strftime('%Y-%m-%d %H:%M:%S') if order.get('create_time') else None,
+            "Tanggal Update": datetime.fromtimestamp(order.get('update_time')).strftime('%Y-%m-%d %H:%M:%S') if order.get('update_time') else None,
+            "Total Harga": order.get('total_amount'),
+            "Mata Uang": order.get('currency'),
+            "Metode Pembayaran": "COD (Cash on Delivery)" if order.get('cod') else order.get('payment_method'),
+            "Estimasi Pengiriman": order.get('estimated_shipping_fee'),
+            "Resi": order.get('tracking_number'),
+            "Pesan dari Pembeli": order.get('message_to_seller'),
+            "Negara": recipient_address.get('region'),
+            "Kota": recipient_address.get('city')
+        })
+    return processed_orders
+
+def process_orders_chunked_global(export_id, access_token):
+    """
+    Process orders data per date chunk. Setiap halaman get_order_list langsung diperkaya
+    dengan batch get_order_detail di thread pool sementara halaman berikutnya masih dipaging,
+    lalu hasilnya ditulis ke spool.
+    """
+    app.logger.info("=== STARTING process_orders_chunked_global ===")
+    
+    if export_id not in export_progress_store:
+        return
+    
+    export_data = export_progress_store[export_id]
+    export_data['status'] = 'processing'
+    export_data['current_step'] = 'Mempersiapkan chunks tanggal untuk orders...'
+    export_data['progress'] = 5.0
+    
+    app.logger.info(f"Initial progress set to: {export_data['progress']}")
+    app.logger.info(f"Shop ID: {export_data['shop_id']}")
+    app.logger.info(f"Date range: {export_data['date_from']} to {export_data['date_to']}")
+    
+    # Pecah date range jadi chunks 15 hari
+    date_chunks = get_date_chunks(export_data['date_from'], export_data['date_to'], 15)
+    app.logger.info(f"Created {len(date_chunks)} date chunks for orders")
+    
+    shop_id = export_data['shop_id']
+    spool = attach_result_spool(export_data)
+    total_listed = 0
+
+    # Toko yang sudah disinkronkan: ambil delta saja lalu baca pesanan dari penyimpanan lokal
+    export_data['current_step'] = 'Memeriksa data pesanan lokal...'
+    local_orders = load_synced_records(shop_id, access_token, 'orders', date_chunks[0][0].timestamp(),
+                                       date_chunks[-1][1].replace(hour=23, minute=59, second=59).timestamp()) if date_chunks else None
+    if local_orders is not None:
+        for i in range(0, len(local_orders), 1000):
+            spool_export_rows(export_data, spool, format_order_data_for_excel(local_orders[i:i + 1000]))
+        export_data['status'] = 'completed'
+        export_data['progress'] = 100.0
+        export_data['current_step'] = f'Selesai! {export_data["data_count"]} pesanan berhasil diproses (data lokal)'
+        return
+
+    detail_path = "/api/v2/order/get_order_detail"
+    detail_batch_size = get_endpoint_size(detail_path)
+    pending_batches = collections.deque()
+
+    def enrich_order_batch(order_batch):
+        order_sns = [order['order_sn'] for order in order_batch if order.get('order_sn')]
+        details = {detail['order_sn']: detail for detail in fetch_order_details_batch(
+            shop_id, access_token, order_sns, export_id, ORDER_DETAIL_OPTIONAL_FIELDS)}
+        return format_order_data_for_excel([{**order, **details.get(order.get('order_sn'), {})} for order in order_batch])
+
+    def spool_finished_batches(max_pending):
+        # Tulis batch yang sudah selesai (urut), dan tunggu jika antrian terlalu panjang
+        while pending_batches and (pending_batches[0].done() or len(pending_batches) > max_pending):
+            spool_export_rows(export_data, spool, pending_batches.popleft().result())
+
+    with AdaptiveExecutor(detail_path, shop_id, thread_name_prefix='orders-detail') as executor:
+        # Loop untuk setiap chunk tanggal
+        for chunk_index, (chunk_start, chunk_end) in enumerate(date_chunks):
+            app.logger.info(f"Processing orders chunk {chunk_index + 1}/{len(date_chunks)}: {chunk_start.strftime('%Y-%m-%d')} to {chunk_end.strftime('%Y-%m-%d')}")
+
+            max_pages_estimate = 50
+
+            # API call untuk orders dengan date filter (paginasi cursor, page size dari profil endpoint).
+            # time_to sampai akhir hari supaya hari terakhir chunk ikut terambil.
+            order_body = {
+                "time_range_field": "create_time",
+                "time_from": int(chunk_start.timestamp()),
+                "time_to": int(chunk_end.replace(hour=23, minute=59, second=59).timestamp())
+                # Removed order_status parameter as "ALL" is not valid
+            }
+
+            # Loop pagination untuk chunk ini (safety limit 100 halaman per chunk)
+            for page_no, order_list, error in iterate_shopee_pages("/api/v2/order/get_order_list", shop_id, access_token,
+                                                                   body=order_body, export_id=export_id, max_pages=100):
+                if error:
+                    app.logger.error(f"Orders API error: {error}")
+                    export_data['error'] = f"Gagal mengambil daftar pesanan: {error}"
+                    export_data['status'] = 'error'
+                    for future in pending_batches:
+                        future.cancel()
+                    discard_export_results(export_data)
+                    return
+
+                app.logger.info(f"Found {len(order_list)} orders on chunk {chunk_index + 1} page {page_no}")
+                total_listed += len(order_list)
+
+                # Kirim halaman ini ke enrichment tanpa menunggu, lalu lanjut paging
+                for i in range(0, len(order_list), detail_batch_size):
+                    pending_batches.append(executor.submit(enrich_order_batch, order_list[i:i + detail_batch_size]))
+                # Batasi batch yang menunggu (mengikuti batas concurrency adaptif) supaya listing tidak jauh mendahului enrichment
+                spool_finished_batches(executor.current_limit * 2)
+
+                # Update progress dalam chunk (fixed calculation)
+                chunk_base_progress = 5.0 + (chunk_index / len(date_chunks)) * 80.0
+                chunk_size_progress = 80.0 / len(date_chunks)
+                page_progress = min(page_no / max_pages_estimate, 0.9) * chunk_size_progress
+                export_data['progress'] = round(min(85.0, chunk_base_progress + page_progress), 1)
+                export_data['current_step'] = f'Orders Chunk {chunk_index + 1}/{len(date_chunks)} - Halaman {page_no} ({export_data["data_count"]}/{total_listed} pesanan diperkaya)...'
+
+            app.logger.info(f"Orders chunk {chunk_index + 1} completed")
+
+        # Tunggu sisa batch enrichment
+        export_data['current_step'] = 'Menyelesaikan detail pesanan...'
+        export_data['progress'] = 90.0
+        spool_finished_batches(0)
+
+    export_data['status'] = 'completed'
+    export_data['progress'] = 100.0
+    if export_data['data_count']:
+        export_data['current_step'] = f'Selesai! {export_data["data_count"]} pesanan berhasil diproses'
+        app.logger.info(f"Orders export completed with {export_data['data_count']} records")
+    else:
+        export_data['current_step'] = 'Tidak ada data pesanan ditemukan'
+
+def get_batch_product_details(shop_id, access_token, item_ids, export_id=None):
+    """
+    Ambil base info (batch) dan model list (per item) untuk sekumpulan item_id secara paralel.
+    Mengembalikan (item_list, model_map) dengan model_map = {item_id: response get_model_list}.
+    """
+    base_info_path = "/api/v2/product/get_item_base_info"
+    model_list_path = "/api/v2/product/get_model_list"
+
+    def fetch_base_info_chunk(chunk):
+        params = {"item_id_list": ",".join(str(item_id) for item_id in chunk)}
+        response, error = call_shopee_api(base_info_path, method='GET', shop_id=shop_id, access_token=access_token,
+                                          body=params, export_id=export_id)
+        if error:
+            # Batch terlalu besar: pecah dua dan coba lagi (profil endpoint sudah diturunkan)
+            if len(chunk) > 1 and _is_size_error(base_info_path, error):
+                half = len(chunk) // 2
+                return fetch_base_info_chunk(chunk[:half]) + fetch_base_info_chunk(chunk[half:])
+            app.logger.warning(f"Batch item base info error for chunk: {error}")
+            return []
+        return response.get('response', {}).get('item_list', [])
+
+    def fetch_model_list(item_id):
+        response, error = call_shopee_api(model_list_path, method='GET', shop_id=shop_id, access_token=access_token,
+                                          body={"item_id": item_id}, export_id=export_id)
+        if error:
+            app.logger.warning(f"Could not get model list for item {item_id}: {error}")
+            return {}
+        return response.get('response', {})
+
+    chunk_size = get_endpoint_size(base_info_path)
+    chunks = [item_ids[i:i + chunk_size] for i in range(0, len(item_ids), chunk_size)]
+
+    item_list = []
+    with AdaptiveExecutor(base_info_path, shop_id, thread_name_prefix='product-info') as executor:
+        for chunk_items in executor.map(fetch_base_info_chunk, chunks):
+            item_list.extend(chunk_items)
+
+    model_map = {}
+    items_with_models = [item['item_id'] for item in item_list if item.get('has_model')]
+    if items_with_models:
+        with AdaptiveExecutor(model_list_path, shop_id, thread_name_prefix='product-model') as executor:
+            for item_id, model_data in zip(items_with_models, executor.map(fetch_model_list, items_with_models)):
+                model_map[item_id] = model_data
+
+    return item_list, model_map
+
+def format_product_data_for_excel(item_list, model_map):
+    """
+    Formats product base info + model list for Excel export.
+    Creates a SEPARATE ROW for each model (variation) of an item.
+    """
+    processed_rows = []
+
+    for item in item_list:
+        price_info = (item.get('price_info') or [{}])[0]
+        stock_summary = item.get('stock_info_v2', {}).get('summary_info', {})
+
+        parent_info = {
+            "ID Produk": item.get('item_id'),
+            "Nama Produk": item.get('item_name'),
+            "SKU Induk": item.get('item_sku', ''),
+            "Status": item.get('item_status'),
+            "Kategori ID": item.get('category_id'),
+            "Berat (kg)": item.get('weight'),
+            "Tanggal Dibuat": datetime.fromtimestamp(item.get('create_time')).strftime('%Y-%m-%d %H:%M:%S') if item.get('create_time') else None,
+            "Tanggal Update": datetime.fromtimestamp(item.get('update_time')).strftime('%Y-%m-%d %H:%M:%S') if item.get('update_time') else None
+        }
+
+        model_data = model_map.get(item.get('item_id'), {})
+        models = model_data.get('model', [])
+        if not models:
+            # Produk tanpa variasi: satu baris dengan data harga/stok level item
+            row = parent_info.copy()
+            row.update({
+                "ID Variasi": "",
+                "Nama Variasi": "",
+                "SKU Code": item.get('item_sku', ''),
+                "Harga Asli": price_info.get('original_price'),
+                "Harga Saat Ini": price_info.get('current_price'),
+                "Mata Uang": price_info.get('currency'),
+                "Stok": stock_summary.get('total_available_stock')
+            })
+            processed_rows.append(row)
+            continue
+
+        tier_variations = model_data.get('tier_variation', [])
+        for model in models:
+            model_price = (model.get('price_info') or [{}])[0]
+            option_names = []
+            for tier_position, option_index in enumerate(model.get('tier_index', [])):
+                options = tier_variations[tier_position].get('option_list', []) if tier_position < len(tier_variations) else []
+                if option_index < len(options):
+                    option_names.append(options[option_index].get('option', ''))
+
+            model_info = {
+                "ID Variasi": model.get('model_id'),
+                "Nama Variasi": ", ".join(option_names),
+                "SKU Code": model.get('model_sku') or item.get('item_sku', ''),
+                "Harga Asli": model_price.get('original_price'),
+                "Harga Saat Ini": model_price.get('current_price'),
+                "Mata Uang": model_price.get('currency') or price_info.get('currency'),
+                "Stok": model.get('stock_info_v2', {}).get('summary_info', {}).get('total_available_stock')
+            }
+            processed_rows.append({**parent_info, **model_info})
+
+    return processed_rows
+
+def process_products_chunked_global(export_id, access_token):
+    """
+    Process products data page by page: item_id dipaging dari get_item_list, detail diambil
+    per halaman secara paralel, lalu langsung ditulis ke spool supaya memory tetap kecil.
+    """
+    app.logger.info("=== STARTING process_products_chunked_global ===")
+
+    if export_id not in export_progress_store:
+        return
+
+    export_data = export_progress_store[export_id]
+    export_data['status'] = 'processing'
+    export_data['current_step'] = 'Mengambil daftar produk...'
+    export_data['progress'] = 5.0
+
+    shop_id = export_data['shop_id']
+    spool = attach_result_spool(export_data)
+    total_items = 0
+
+    # Daftar produk tidak difilter tanggal; semua produk aktif & diarsipkan ikut diekspor
+    item_list_body = {"item_status": ["NORMAL", "UNLIST"]}
+    for page_no, item_page, error in iterate_shopee_pages("/api/v2/product/get_item_list", shop_id, access_token,
+                                                          body=item_list_body, export_id=export_id, max_pages=1000):
+        if error:
+            export_data['error'] = f"Gagal mengambil daftar produk: {error}"
+            export_data['status'] = 'error'
+            return
+
+        item_ids = [item['item_id'] for item in item_page if item.get('item_id')]
+        export_data['current_step'] = f'Halaman {page_no}: mengambil detail {len(item_ids)} produk...'
+
+        item_list, model_map = get_batch_product_details(shop_id, access_token, item_ids, export_id)
+        spool_export_rows(export_data, spool, format_product_data_for_excel(item_list, model_map))
+        total_items += len(item_ids)
+
+        export_data['progress'] = round(min(95.0, 5.0 + page_no * 2), 1)
+        export_data['current_step'] = f'Halaman {page_no}: {total_items} produk, {export_data["data_count"]} baris diproses...'
+
+    export_data['status'] = 'completed'
+    export_data['progress'] = 100.0
+    if export_data['data_count']:
+        export_data['current_step'] = f'Selesai! {total_items} produk ({export_data["data_count"]} baris variasi) berhasil diproses'
+    else:
+        export_data['current_step'] = 'Tidak ada data produk ditemukan'
+    app.logger.info(f"Products export completed with {total_items} items, {export_data['data_count']} rows")
+
+# Fungsi process_* untuk setiap data_type yang bisa diekspor
+EXPORT_PROCESSORS = {
+    'returns': process_returns_with_manual_filter_global,
+    'orders': process_orders_chunked_global,
+    'products': process_products_chunked_global,
+    'combined_report': process_combined_data_global
+}
+
+def run_export_job(export_id, access_token):
+    """Jalankan fungsi process_* yang sesuai dengan data_type export."""
+    current_export = export_progress_store.get(export_id)
+    if not current_export:
+        return
+
+    processor = EXPORT_PROCESSORS.get(current_export['data_type'])
+    if current_export.get('delta_export'):
+        processor = process_delta_export_global
+    if not processor:
+        current_export['status'] = 'error'
+        current_export['error'] = f"Tipe data tidak dikenal: {current_export['data_type']}"
+        return
+
+    try:
+        processor(export_id, access_token)
+    except Exception as e:
+        app.logger.error(f"Export job {export_id} error: {e}")
+        current_export['error'] = str(e)
+        current_export['status'] = 'error'
+
+def process_all_shops_global(export_id, shop_tokens):
+    """
+    Export satu data_type untuk banyak toko: satu sub-job per toko dijalankan di worker pool
+    (berbagi rate limiter global), lalu hasilnya digabung dengan kolom toko.
+    shop_tokens: {shop_id: {'access_token': ..., 'shop_name': ...}}
+    """
+    app.logger.info(f"=== STARTING process_all_shops_global for {len(shop_tokens)} shops ===")
+
+    if export_id not in export_progress_store:
+        return
+
+    export_data = export_progress_store[export_id]
+    export_data['status'] = 'processing'
+    export_data['current_step'] = f'Memulai export untuk {len(shop_tokens)} toko...'
+
+    sub_jobs = {}
+    for shop_id, shop_info in shop_tokens.items():
+        sub_export_id = f"{export_id}_{shop_id}"
+        export_progress_store[sub_export_id] = {
+            'export_id': sub_export_id,
+            'parent_export_id': export_id,
+            'shop_id': shop_id,
+            'data_type': export_data['data_type'],
+            'date_from': export_data['date_from'],
+            'date_to': export_data['date_to'],
+            'include_failed_delivery': export_data.get('include_failed_delivery', False),
+            'include_return_detail': export_data.get('include_return_detail', False),
+            'delta_export': export_data.get('delta_export', False),
+            'status': 'initializing',
+            'progress': 0,
+            'total_estimated': 0,
+            'current_step': 'Menunggu giliran...',
+            'data': [],
+            'error': None
+        }
+        sub_jobs[shop_id] = export_worker_pool.submit(run_export_job, sub_export_id, shop_info['access_token'])
+
+    # Pantau semua sub-job dan gabungkan progress-nya
+    while True:
+        finished = 0
+        total_progress = 0.0
+        shop_progress = {}
+        for shop_id, future in sub_jobs.items():
+            sub_export = export_progress_store.get(f"{export_id}_{shop_id}", {})
+            if future.done():
+                finished += 1
+                total_progress += 100.0
+            else:
+                total_progress += sub_export.get('progress', 0)
+            shop_progress[shop_id] = {
+                'shop_name': shop_tokens[shop_id]['shop_name'],
+                'status': sub_export.get('status'),
+                'progress': sub_export.get('progress', 0)
+            }
+        export_data['shop_progress'] = shop_progress
+        export_data['progress'] = round(min(95.0, total_progress / len(sub_jobs)), 1)
+        export_data['current_step'] = f'{finished}/{len(sub_jobs)} toko selesai...'
+        if finished == len(sub_jobs):
+            break
+        time.sleep(1)
+
+    # Gabungkan hasil semua toko menjadi satu tabel dengan kolom toko
+    export_data['current_step'] = 'Menggabungkan data semua toko...'
+    spool = attach_result_spool(export_data)
+    shop_errors = {}
+    for shop_id, shop_info in shop_tokens.items():
+        sub_export = export_progress_store.pop(f"{export_id}_{shop_id}", {})
+        if sub_export.get('status') != 'completed':
+            shop_errors[shop_id] = sub_export.get('error') or 'Export tidak selesai'
+            discard_export_results(sub_export)
+            continue
+        export_data.setdefault('delta_watermarks', {}).update(sub_export.get('delta_watermarks') or {})
+        merged_rows = []
+        for row in iter_export_rows(sub_export):
+            merged_rows.append({"ID Toko": shop_id, "Nama Toko": shop_info['shop_name'], **row})
+            if len(merged_rows) >= 1000:
+                spool_export_rows(export_data, spool, merged_rows)
+                merged_rows = []
+        spool_export_rows(export_data, spool, merged_rows)
+        discard_export_results(sub_export)
+
+    export_data['shop_errors'] = shop_errors
+    if len(shop_errors) == len(shop_tokens):
+        discard_export_results(export_data)
+        export_data['status'] = 'error'
+        export_data['error'] = f"Export gagal untuk semua toko: {shop_errors}"
+        return
+
+    export_data['status'] = 'completed'
+    export_data['progress'] = 100.0
+    export_data['current_step'] = f'Selesai! {export_data["data_count"]} baris dari {len(shop_tokens) - len(shop_errors)} toko berhasil diproses'
+    if shop_errors:
+        export_data['current_step'] += f' ({len(shop_errors)} toko gagal: {", ".join(shop_errors)})'
+    app.logger.info(f"Multi-shop export completed with {export_data['data_count']} rows, {len(shop_errors)} shops failed")
+
+# ==============================================================================
+# PENYIMPANAN LOKAL & SINKRONISASI INKREMENTAL
+# ==============================================================================
+LOCAL_STORE_FILE = os.path.join(DATA_DIR, 'local_store.sqlite3')
+# Jendela update_time per request list (batas rentang waktu API Shopee 15 hari)
+SYNC_WINDOW_SECONDS = 15 * 24 * 3600
+# Awal jendela sinkronisasi berikutnya dimundurkan sekian detik agar update yang telat tidak terlewat
+SYNC_OVERLAP_SECONDS = 600
+SYNC_DATA_TYPES = ('orders', 'returns')
+# Batas halaman get_return_list (tanpa filter tanggal) per sinkronisasi retur
+SYNC_RETURNS_MAX_PAGES = 500
+
+# Versi skema penyimpanan lokal; kolom/tabel analitik ditambahkan pada versi 2, agregat KPI pada versi 3,
+# versi 4 mengulang sinkronisasi retur (versi sebelumnya memakai filter tanggal API yang melewatkan RRBOC)
+LOCAL_STORE_SCHEMA_VERSION = 4
+# Filter ad-hoc yang didukung query lokal (semuanya memakai index)
+LOCAL_QUERY_FILTERS = ('status', 'sku', 'reason', 'province', 'payment_method')
+
+def _kpi_day(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d') if timestamp else 'unknown'
+
+def _kpi_amount(value):
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+def kpi_order_contributions(order):
+    """
+    Kontribusi satu pesanan ke agregat KPI: tuple (metric, dimension, key, day, count, amount, quantity).
+    Pesanan batal dihitung sebagai pembatalan, dan sebagai gagal kirim jika cancel_reason-nya cocok.
+    """
+    day = _kpi_day(order.get('create_time'))
+    amount = _kpi_amount(order.get('total_amount'))
+    province = (order.get('recipient_address') or {}).get('state') or ''
+    items = order.get('item_list') or []
+    quantity = sum(item.get('model_quantity_purchased') or 0 for item in items)
+    contributions = [('orders', 'all', '', day, 1, amount, quantity),
+                     ('orders', 'status', order.get('order_status') or '', day, 1, amount, quantity),
+                     ('orders', 'province', province, day, 1, amount, quantity)]
+    for item in items:
+        contributions.append(('orders', 'sku', item.get('model_sku') or item.get('item_sku') or '', day, 1, 0.0,
+                              item.get('model_quantity_purchased') or 0))
+    if order.get('order_status') == 'CANCELLED':
+        reason = order.get('cancel_reason') or ''
+        metrics = ['cancellations']
+        if any(keyword.lower() in reason.lower() for keyword in FAILED_DELIVERY_KEYWORDS):
+            metrics.append('failed_deliveries')
+        for metric in metrics:
+            contributions.extend([(metric, 'all', '', day, 1, amount, quantity),
+                                  (metric, 'reason', reason, day, 1, amount, quantity),
+                                  (metric, 'province', province, day, 1, amount, quantity)])
+    return contributions
+
+def kpi_return_contributions(item):
+    """Kontribusi satu retur ke agregat KPI (jumlah, total refund, qty per alasan/status/SKU/hari)."""
+    day = _kpi_day(item.get('create_time'))
+    refund = _kpi_amount(item.get('refund_amount'))
+    products = item.get('item') or []
+    quantity = sum(product.get('amount') or 0 for product in products)
+    contributions = [('returns', 'all', '', day, 1, refund, quantity),
+                     ('returns', 'reason', item.get('reason') or '', day, 1, refund, quantity),
+                     ('returns', 'status', item.get('status') or '', day, 1, refund, quantity)]
+    for product in products:
+        # Refund per retur tidak bisa dibagi per SKU, jadi SKU hanya menghitung jumlah dan qty
+        contributions.append(('returns', 'sku', product.get('variation_sku') or product.get('item_sku') or '', day, 1, 0.0,
+                              product.get('amount') or 0))
+    return contributions
+
+class LocalStore:
+    """
+    Salinan lokal pesanan, item pesanan, retur, item retur, detail retur final dan no. resi per
+    toko di SQLite, beserta high-water mark update_time setiap (toko, data_type) yang sudah disinkronkan.
+    Kolom yang sering difilter (status, SKU, alasan, provinsi, metode bayar) disimpan terpisah
+    dan di-index; data lengkap tetap disimpan sebagai JSON.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.initialized = False
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        with self.lock:
+            if not self.initialized:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with sqlite_connection(self.path, 30) as conn:
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    self._create_schema(conn)
+                self.initialized = True
+        return sqlite_connection(self.path, 30)
+
+    def _create_schema(self, conn):
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS orders (
+                shop_id TEXT NOT NULL, order_sn TEXT NOT NULL, order_status TEXT,
+                create_time INTEGER, update_time INTEGER, data TEXT NOT NULL,
+                PRIMARY KEY (shop_id, order_sn));
+            CREATE TABLE IF NOT EXISTS returns (
+                shop_id TEXT NOT NULL, return_sn TEXT NOT NULL, order_sn TEXT, status TEXT,
+                create_time INTEGER, update_time INTEGER, data TEXT NOT NULL,
+                PRIMARY KEY (shop_id, return_sn));
+            CREATE TABLE IF NOT EXISTS order_items (
+                shop_id TEXT NOT NULL, order_sn TEXT NOT NULL, sku TEXT, item_name TEXT,
+                quantity INTEGER, price REAL);
+            CREATE TABLE IF NOT EXISTS return_items (
+                shop_id TEXT NOT NULL, return_sn TEXT NOT NULL, sku TEXT, item_name TEXT, quantity INTEGER);
+            CREATE TABLE IF NOT EXISTS tracking (
+                shop_id TEXT NOT NULL, order_sn TEXT NOT NULL, tracking_number TEXT NOT NULL,
+                updated_at INTEGER NOT NULL, PRIMARY KEY (shop_id, order_sn));
+            CREATE TABLE IF NOT EXISTS return_details (
+                shop_id TEXT NOT NULL, return_sn TEXT NOT NULL, data TEXT NOT NULL,
+                updated_at INTEGER NOT NULL, PRIMARY KEY (shop_id, return_sn));
+            CREATE TABLE IF NOT EXISTS sync_state (
+                shop_id TEXT NOT NULL, data_type TEXT NOT NULL, backfill_from INTEGER NOT NULL,
+                high_water INTEGER NOT NULL, synced_at INTEGER NOT NULL,
+                PRIMARY KEY (shop_id, data_type));
+            CREATE TABLE IF NOT EXISTS export_watermarks (
+                shop_id TEXT NOT NULL, data_type TEXT NOT NULL, watermark INTEGER NOT NULL,
+                exported_at INTEGER NOT NULL, PRIMARY KEY (shop_id, data_type));
+            CREATE TABLE IF NOT EXISTS kpi_aggregates (
+                shop_id TEXT NOT NULL, metric TEXT NOT NULL, dimension TEXT NOT NULL, key TEXT NOT NULL,
+                day TEXT NOT NULL, count INTEGER NOT NULL, amount REAL NOT NULL, quantity INTEGER NOT NULL,
+                PRIMARY KEY (shop_id, metric, dimension, day, key));
+        """)
+        # Kolom analitik (ditambahkan ke database versi lama yang belum punya)
+        for table, columns in (('orders', ('payment_method', 'province', 'city', 'cancel_reason')),
+                               ('returns', ('reason', 'refund_amount'))):
+            existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+            for column in columns:
+                if column not in existing:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {'REAL' if column == 'refund_amount' else 'TEXT'}")
+        conn.executescript("""
+            CREATE INDEX IF NOT EXISTS idx_orders_create ON orders (shop_id, create_time);
+            CREATE INDEX IF NOT EXISTS idx_orders_update ON orders (shop_id, update_time);
+            CREATE INDEX IF NOT EXISTS idx_orders_status ON orders (shop_id, order_status, create_time);
+            CREATE INDEX IF NOT EXISTS idx_orders_order_sn ON orders (order_sn);
+            CREATE INDEX IF NOT EXISTS idx_orders_payment ON orders (shop_id, payment_method, create_time);
+            CREATE INDEX IF NOT EXISTS idx_orders_province ON orders (shop_id, province, create_time);
+            CREATE INDEX IF NOT EXISTS idx_returns_create ON returns (shop_id, create_time);
+            CREATE INDEX IF NOT EXISTS idx_returns_update ON returns (shop_id, update_time);
+            CREATE INDEX IF NOT EXISTS idx_returns_status ON returns (shop_id, status, create_time);
+            CREATE INDEX IF NOT EXISTS idx_returns_order ON returns (shop_id, order_sn);
+            CREATE INDEX IF NOT EXISTS idx_returns_reason ON returns (shop_id, reason, create_time);
+            CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items (shop_id, order_sn);
+            CREATE INDEX IF NOT EXISTS idx_order_items_sku ON order_items (shop_id, sku);
+            CREATE INDEX IF NOT EXISTS idx_return_items_return ON return_items (shop_id, return_sn);
+            CREATE INDEX IF NOT EXISTS idx_return_items_sku ON return_items (shop_id, sku);
+        """)
+        schema_version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if schema_version < 2:
+            # Isi kolom/tabel analitik dari JSON yang sudah tersimpan
+            for shop_id, data in conn.execute("SELECT shop_id, data FROM orders").fetchall():
+                self._write_orders(conn, shop_id, [json.loads(data)])
+            for shop_id, data in conn.execute("SELECT shop_id, data FROM returns").fetchall():
+                self._write_returns(conn, shop_id, [json.loads(data)])
+        if schema_version < 3:
+            # Hitung ulang agregat KPI dari semua data yang sudah tersimpan
+            conn.execute("DELETE FROM kpi_aggregates")
+            for shop_id, data in conn.execute("SELECT shop_id, data FROM orders").fetchall():
+                self._apply_aggregates(conn, shop_id, kpi_order_contributions(json.loads(data)), 1)
+            for shop_id, data in conn.execute("SELECT shop_id, data FROM returns").fetchall():
+                self._apply_aggregates(conn, shop_id, kpi_return_contributions(json.loads(data)), 1)
+        if 0 < schema_version < 4:
+            # Retur RRBOC bisa belum tersimpan: export kembali ke API sampai sinkronisasi retur diulang
+            conn.execute("DELETE FROM sync_state WHERE data_type = 'returns'")
+        if schema_version < LOCAL_STORE_SCHEMA_VERSION:
+            conn.execute(f"PRAGMA user_version = {LOCAL_STORE_SCHEMA_VERSION}")
+
+    def _apply_aggregates(self, conn, shop_id, contributions, sign):
+        """Tambahkan (sign=1) atau kurangi (sign=-1) kontribusi data ke tabel agregat KPI."""
+        conn.executemany(
+            "INSERT INTO kpi_aggregates (shop_id, metric, dimension, key, day, count, amount, quantity) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (shop_id, metric, dimension, day, key) DO UPDATE SET "
+            "count = count + excluded.count, amount = amount + excluded.amount, quantity = quantity + excluded.quantity",
+            [(str(shop_id), metric, dimension, key, day, sign * count, sign * amount, sign * quantity)
+             for metric, dimension, key, day, count, amount, quantity in contributions])
+
+    def _update_aggregates(self, conn, shop_id, table, key_column, records, contributions_fn):
+        """Perbarui agregat secara inkremental: kontribusi versi lama dikurangi, versi baru ditambah."""
+        keys = [record[key_column] for record in records]
+        old_records = []
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            old_records.extend(json.loads(row[0]) for row in conn.execute(
+                f"SELECT data FROM {table} WHERE shop_id = ? AND {key_column} IN ({','.join('?' * len(chunk))})",
+                [str(shop_id), *chunk]))
+        for record in old_records:
+            self._apply_aggregates(conn, shop_id, contributions_fn(record), -1)
+        for record in records:
+            self._apply_aggregates(conn, shop_id, contributions_fn(record), 1)
+
+    def _write_orders(self, conn, shop_id, orders):
+        shop_id = str(shop_id)
+        orders = list({order['order_sn']: order for order in orders if order.get('order_sn')}.values())
+        self._update_aggregates(conn, shop_id, 'orders', 'order_sn', orders, kpi_order_contributions)
+        conn.executemany(
+            "INSERT OR REPLACE INTO orders (shop_id, order_sn, order_status, create_time, update_time, payment_method, "
+            "province, city, cancel_reason, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(shop_id, order['order_sn'], order.get('order_status'), order.get('create_time'), order.get('update_time'),
+              "COD (Cash on Delivery)" if order.get('cod') else order.get('payment_method'),
+              (order.get('recipient_address') or {}).get('state'), (order.get('recipient_address') or {}).get('city'),
+              order.get('cancel_reason'), json.dumps(order, ensure_ascii=False, default=str))
+             for order in orders])
+        conn.executemany("DELETE FROM order_items WHERE shop_id = ? AND order_sn = ?",
+                         [(shop_id, order['order_sn']) for order in orders])
+        conn.executemany(
+            "INSERT INTO order_items (shop_id, order_sn, sku, item_name, quantity, price) VALUES (?, ?, ?, ?, ?, ?)",
+            [(shop_id, order['order_sn'], item.get('model_sku') or item.get('item_sku'), item.get('item_name'),
+              item.get('model_quantity_purchased'), item.get('model_discounted_price'))
+             for order in orders for item in order.get('item_list') or []])
+        self._write_tracking(conn, shop_id, {order['order_sn']: order.get('tracking_number') for order in orders})
+        return len(orders)
+
+    def _write_returns(self, conn, shop_id, returns):
+        shop_id = str(shop_id)
+        returns = list({item['return_sn']: item for item in returns if item.get('return_sn')}.values())
+        self._update_aggregates(conn, shop_id, 'returns', 'return_sn', returns, kpi_return_contributions)
+        conn.executemany(
+            "INSERT OR REPLACE INTO returns (shop_id, return_sn, order_sn, status, create_time, update_time, reason, "
+            "refund_amount, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(shop_id, item['return_sn'], item.get('order_sn'), item.get('status'), item.get('create_time'),
+              item.get('update_time'), item.get('reason'), item.get('refund_amount'),
+              json.dumps(item, ensure_ascii=False, default=str))
+             for item in returns])
+        conn.executemany("DELETE FROM return_items WHERE shop_id = ? AND return_sn = ?",
+                         [(shop_id, item['return_sn']) for item in returns])
+        conn.executemany(
+            "INSERT INTO return_items (shop_id, return_sn, sku, item_name, quantity) VALUES (?, ?, ?, ?, ?)",
+            [(shop_id, item['return_sn'], product.get('variation_sku') or product.get('item_sku'), product.get('name'),
+              product.get('amount'))
+             for item in returns for product in item.get('item') or []])
+        return len(returns)
+
+    def _write_tracking(self, conn, shop_id, tracking_numbers):
+        conn.executemany("INSERT OR REPLACE INTO tracking (shop_id, order_sn, tracking_number, updated_at) VALUES (?, ?, ?, ?)",
+                         [(str(shop_id), order_sn, tracking_number, int(time.time()))
+                          for order_sn, tracking_number in tracking_numbers.items() if tracking_number])
+
+    def upsert_orders(self, shop_id, orders):
+        """Simpan pesanan (gabungan data list + detail) beserta item-nya, menimpa versi lama."""
+        with self._connect() as conn:
+            # Kunci tulis diambil sebelum versi lama dibaca, supaya dua penulis (sync, push, export)
+            # tidak mengurangi kontribusi agregat versi lama yang sama dua kali
+            conn.execute("BEGIN IMMEDIATE")
+            return self._write_orders(conn, shop_id, orders)
+
+    def upsert_returns(self, shop_id, returns):
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            return self._write_returns(conn, shop_id, returns)
+
+    def save_tracking(self, shop_id, tracking_numbers):
+        """Simpan no. resi {order_sn: tracking_number} (yang kosong diabaikan)."""
+        with self._connect() as conn:
+            self._write_tracking(conn, shop_id, tracking_numbers)
+
+    def _select_by_order_sn(self, sql, shop_id, order_sns):
+        # Dipecah per 500 order_sn/return_sn supaya tidak melewati batas parameter SQLite
+        order_sns = list(order_sns)
+        rows = []
+        with self._connect() as conn:
+            for i in range(0, len(order_sns), 500):
+                chunk = order_sns[i:i + 500]
+                rows.extend(conn.execute(sql.format(','.join('?' * len(chunk))), [str(shop_id), *chunk]).fetchall())
+        return rows
+
+    def get_tracking(self, shop_id, order_sns):
+        return dict(self._select_by_order_sn(
+            "SELECT order_sn, tracking_number FROM tracking WHERE shop_id = ? AND order_sn IN ({})", shop_id, order_sns))
+
+    def get_return_details(self, shop_id, return_sns):
+        """Detail retur (get_return_detail) yang sudah final dan tersimpan: {return_sn: detail}."""
+        return {return_sn: json.loads(data) for return_sn, data in self._select_by_order_sn(
+            "SELECT return_sn, data FROM return_details WHERE shop_id = ? AND return_sn IN ({})", shop_id, return_sns)}
+
+    def save_return_details(self, shop_id, details):
+        """Simpan detail retur final {return_sn: detail}; hanya baris ini yang ditulis, bukan seluruh cache."""
+        with self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO return_details (shop_id, return_sn, data, updated_at) VALUES (?, ?, ?, ?)",
+                             [(str(shop_id), return_sn, json.dumps(detail, ensure_ascii=False, default=str), int(time.time()))
+                              for return_sn, detail in details.items()])
+
+    def query_returns_by_sn(self, shop_id, return_sns):
+        """Data retur lokal untuk return_sn yang ada."""
+        return [json.loads(row[0]) for row in self._select_by_order_sn(
+            "SELECT data FROM returns WHERE shop_id = ? AND return_sn IN ({})", shop_id, return_sns)]
+
+    def get_orders(self, shop_id, order_sns):
+        """Data pesanan lokal {order_sn: data} untuk order_sn yang ada."""
+        return {order_sn: json.loads(data) for order_sn, data in self._select_by_order_sn(
+            "SELECT order_sn, data FROM orders WHERE shop_id = ? AND order_sn IN ({})", shop_id, order_sns)}
+
+    def query_orders(self, shop_id, create_from, create_to, statuses=None, filters=None, time_field='create_time'):
+        """
+        Pesanan toko dengan create_time (atau update_time) dalam rentang. statuses membatasi status
+        pesanan; filters (lihat LOCAL_QUERY_FILTERS) memakai kolom ber-index, 'reason' = cancel_reason.
+        """
+        filters = dict(filters or {})
+        if filters.get('status'):
+            statuses = [filters.pop('status')]
+        time_field = 'update_time' if time_field == 'update_time' else 'create_time'
+        sql = f"SELECT o.data FROM orders o WHERE o.shop_id = ? AND o.{time_field} BETWEEN ? AND ?"
+        params = [str(shop_id), int(create_from), int(create_to)]
+        if statuses:
+            sql += f" AND o.order_status IN ({','.join('?' * len(statuses))})"
+            params.extend(statuses)
+        for name, clause in (('payment_method', "o.payment_method = ?"), ('province', "o.province = ?"),
+                             ('reason', "o.cancel_reason = ?"),
+                             ('sku', "EXISTS (SELECT 1 FROM order_items i WHERE i.shop_id = o.shop_id AND i.order_sn = o.order_sn AND i.sku = ?)")):
+            if filters.get(name):
+                sql += f" AND {clause}"
+                params.append(filters[name])
+        with self._connect() as conn:
+            rows = conn.execute(sql + f" ORDER BY o.{time_field}", params).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def query_returns(self, shop_id, create_from, create_to, filters=None, time_field='create_time'):
+        """
+        Retur toko dengan create_time (atau update_time) dalam rentang; filter provinsi/metode bayar
+        diambil dari pesanan lokalnya.
+        """
+        filters = filters or {}
+        time_field = 'update_time' if time_field == 'update_time' else 'create_time'
+        sql = f"SELECT r.data FROM returns r WHERE r.shop_id = ? AND r.{time_field} BETWEEN ? AND ?"
+        params = [str(shop_id), int(create_from), int(create_to)]
+        order_match = "EXISTS (SELECT 1 FROM orders o WHERE o.shop_id = r.shop_id AND o.order_sn = r.order_sn AND o.{} = ?)"
+        for name, clause in (('status', "r.status = ?"), ('reason', "r.reason = ?"),
+                             ('payment_method', order_match.format('payment_method')),
+                             ('province', order_match.format('province')),
+                             ('sku', "EXISTS (SELECT 1 FROM return_items i WHERE i.shop_id = r.shop_id AND i.return_sn = r.return_sn AND i.sku = ?)")):
+            if filters.get(name):
+                sql += f" AND {clause}"
+                params.append(filters[name])
+        with self._connect() as conn:
+            rows = conn.execute(sql + f" ORDER BY r.{time_field}", params).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def get_sync_state(self, shop_id, data_type):
+        with self._connect() as conn:
+            row = conn.execute("SELECT backfill_from, high_water, synced_at FROM sync_state WHERE shop_id = ? AND data_type = ?",
+                               (str(shop_id), data_type)).fetchone()
+        return {'backfill_from': row[0], 'high_water': row[1], 'synced_at': row[2]} if row else None
+
+    def set_sync_state(self, shop_id, data_type, backfill_from, high_water):
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO sync_state (shop_id, data_type, backfill_from, high_water, synced_at) VALUES (?, ?, ?, ?, ?)",
+                         (str(shop_id), data_type, int(backfill_from), int(high_water), int(time.time())))
+
+    def query_kpi(self, shop_ids, metric, dimension, day_from, day_to, group_by='key', limit=None):
+        """
+        Jumlahkan agregat KPI untuk beberapa toko dan rentang hari (YYYY-MM-DD), dikelompokkan per
+        key atau per day. Return list dict {group, count, amount, quantity} urut count terbesar.
+        """
+        group_column = 'day' if group_by == 'day' else 'key'
+        sql = (f"SELECT {group_column}, SUM(count), SUM(amount), SUM(quantity) FROM kpi_aggregates "
+               f"WHERE shop_id IN ({','.join('?' * len(shop_ids))}) AND metric = ? AND dimension = ? AND day BETWEEN ? AND ? "
+               f"GROUP BY {group_column} HAVING SUM(count) > 0 ORDER BY {'day' if group_by == 'day' else 'SUM(count) DESC'}")
+        params = [*map(str, shop_ids), metric, dimension, day_from, day_to]
+        if limit:
+            sql += " LIMIT ?"
+            params.append(int(limit))
+        with self._connect() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        return [{'group': group, 'count': count, 'amount': round(amount or 0, 2), 'quantity': quantity}
+                for group, count, amount, quantity in rows]
+
+    def get_export_watermark(self, shop_id, data_type):
+        """update_time terakhir yang sudah ikut export delta (None jika belum pernah)."""
+        with self._connect() as conn:
+            row = conn.execute("SELECT watermark FROM export_watermarks WHERE shop_id = ? AND data_type = ?",
+                               (str(shop_id), data_type)).fetchone()
+        return row[0] if row else None
+
+    def set_export_watermark(self, shop_id, data_type, watermark):
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO export_watermarks (shop_id, data_type, watermark, exported_at) VALUES (?, ?, ?, ?)",
+                         (str(shop_id), data_type, int(watermark), int(time.time())))
+
+    def get_all_sync_state(self):
+        with self._connect() as conn:
+            rows = conn.execute("SELECT shop_id, data_type, backfill_from, high_water, synced_at FROM sync_state").fetchall()
+        return {f"{shop_id} {data_type}": {'backfill_from': backfill_from, 'high_water': high_water, 'synced_at': synced_at}
+                for shop_id, data_type, backfill_from, high_water, synced_at in rows}
+
+local_store = LocalStore(LOCAL_STORE_FILE)
+
+# Satu sinkronisasi per (toko, data_type) pada satu waktu
+sync_locks = collections.defaultdict(threading.Lock)
+sync_locks_lock = threading.Lock()
+sync_thread = None
+
+def _sync_orders_window(shop_id, access_token, time_from, time_to):
+    """Ambil pesanan yang berubah dalam satu jendela update_time beserta detailnya."""
+    body = {"time_range_field": "update_time", "time_from": time_from, "time_to": time_to}
+    detail_batch_size = get_endpoint_size("/api/v2/order/get_order_detail")
+    synced = 0
+    for page_no, order_list, error in iterate_shopee_pages("/api/v2/order/get_order_list", shop_id, access_token,
+                                                           body=body, max_pages=100):
+        if error:
+            return synced, error
+        for i in range(0, len(order_list), detail_batch_size):
+            order_batch = order_list[i:i + detail_batch_size]
+            details = {detail['order_sn']: detail for detail in fetch_order_details_batch(
+                shop_id, access_token, [order['order_sn'] for order in order_batch if order.get('order_sn')],
+                optional_fields=ORDER_DETAIL_OPTIONAL_FIELDS)}
+            synced += local_store.upsert_orders(shop_id, [{**order, **details.get(order.get('order_sn'), {})} for order in order_batch])
+    return synced, None
+
+def _sync_returns_window(shop_id, access_token, time_from, time_to):
+    """
+    Ambil retur yang berubah sejak time_from. get_return_list dipaging tanpa filter tanggal karena
+    filter tanggal di API menghilangkan retur RRBOC; update_time disaring manual. Daftar retur
+    terurut dari yang terbaru, jadi paging berhenti di halaman pertama yang seluruhnya lebih lama
+    dari time_from. Jika paging terpotong di SYNC_RETURNS_MAX_PAGES, error dikembalikan supaya
+    high-water mark tidak maju melewati retur yang belum terbaca.
+    """
+    synced = 0
+    for page_no, return_list, error in iterate_return_pages(shop_id, access_token, max_pages=SYNC_RETURNS_MAX_PAGES):
+        if error:
+            return synced, error
+        changed = [item for item in return_list if (item.get('update_time') or time_from) >= time_from]
+        if changed:
+            synced += local_store.upsert_returns(shop_id, changed)
+        elif return_list:
+            return synced, None # Satu halaman penuh sudah lebih lama dari time_from
+        if page_no >= SYNC_RETURNS_MAX_PAGES:
+            return synced, f"Daftar retur terpotong di {SYNC_RETURNS_MAX_PAGES} halaman sebelum mencapai data lama"
+    return synced, None
+
+# data_type -> (fungsi sinkronisasi, lebar jendela update_time; None = satu jendela sampai sekarang)
+SYNC_WINDOW_FUNCTIONS = {
+    'orders': (_sync_orders_window, SYNC_WINDOW_SECONDS),
+    'returns': (_sync_returns_window, None)
+}
+
+def sync_shop_data(shop_id, access_token, data_type, since=None):
+    """
+    Sinkronkan satu data_type toko ke penyimpanan lokal: hanya data yang berubah sejak
+    high-water mark terakhir (atau SYNC_INITIAL_DAYS hari terakhir untuk sinkronisasi pertama).
+    Jika since lebih awal dari data lokal yang ada, sinkronisasi diulang mulai dari since.
+    High-water mark maju per jendela yang berhasil. Return (jumlah data, error).
+    """
+    with sync_locks_lock:
+        lock = sync_locks[(str(shop_id), data_type)]
+    with lock:
+        now = int(time.time())
+        state = local_store.get_sync_state(shop_id, data_type)
+        if state and (since is None or state['backfill_from'] <= since):
+            backfill_from = state['backfill_from']
+            window_from = max(backfill_from, state['high_water'] - SYNC_OVERLAP_SECONDS)
+        else:
+            backfill_from = window_from = int(since) if since is not None else now - SYNC_INITIAL_DAYS * 24 * 3600
+        sync_window, window_seconds = SYNC_WINDOW_FUNCTIONS[data_type]
+        synced = 0
+        while window_from < now:
+            window_to = min(window_from + window_seconds, now) if window_seconds else now
+            count, error = sync_window(shop_id, access_token, window_from, window_to)
+            synced += count
+            if error:
+                app.logger.warning(f"Sync {data_type} for shop {shop_id} stopped at {window_from}: {error}")
+                return synced, error
+            local_store.set_sync_state(shop_id, data_type, backfill_from, window_to)
+            window_from = window_to
+        return synced, None
+
+def sync_all_shops(shop_ids=None):
+    """Sinkronkan semua data_type untuk semua toko yang tokennya tersimpan. Return ringkasan per toko."""
+    summary = {}
+    for shop_id in shop_ids or list(shop_token_manager.get_all_tokens().keys()):
+        access_token, error = shop_token_manager.get_access_token(shop_id)
+        if error:
+            summary[shop_id] = {'error': error}
+            continue
+        summary[shop_id] = {}
+        for data_type in SYNC_DATA_TYPES:
+            started = time.time()
+            synced, error = sync_shop_data(shop_id, access_token, data_type)
+            summary[shop_id][data_type] = {'synced': synced, 'error': error, 'seconds': round(time.time() - started, 1)}
+            app.logger.info(f"Synced {synced} {data_type} for shop {shop_id} in {summary[shop_id][data_type]['seconds']}s")
+    return summary
+
+def run_sync_loop(interval, shop_ids=None):
+    """Sinkronisasi berkala tanpa henti (dipakai thread background dan `python app.py sync`)."""
+    while True:
+        try:
+            sync_all_shops(shop_ids)
+        except Exception as e:
+            app.logger.error(f"Background sync error: {e}")
+        time.sleep(interval)
+
+def start_background_sync():
+    """Jalankan thread sinkronisasi otomatis jika SYNC_INTERVAL diset (sekali per proses)."""
+    global sync_thread
+    if SYNC_INTERVAL <= 0:
+        return
+    with sync_locks_lock:
+        if sync_thread and sync_thread.is_alive():
+            return
+        sync_thread = threading.Thread(target=run_sync_loop, args=(SYNC_INTERVAL,), name='local-sync', daemon=True)
+        sync_thread.start()
+
+def load_synced_records(shop_id, access_token, data_type, time_from, time_to, statuses=None, filters=None):
+    """
+    Data dari penyimpanan lokal untuk export (query ber-index, opsional dengan filters), setelah
+    mengambil delta sejak sinkronisasi terakhir. Return None jika toko belum pernah disinkronkan
+    sejauh time_from atau delta gagal diambil (pemanggil kembali ke paging API biasa).
+    """
+    state = local_store.get_sync_state(shop_id, data_type)
+    if not state or state['backfill_from'] > time_from:
+        return None
+    synced, error = sync_shop_data(shop_id, access_token, data_type)
+    if error:
+        app.logger.warning(f"Local {data_type} for shop {shop_id} not used, delta sync failed: {error}")
+        return None
+    records = (local_store.query_orders(shop_id, time_from, time_to, statuses, filters) if data_type == 'orders'
+               else local_store.query_returns(shop_id, time_from, time_to, filters))
+    app.logger.info(f"Using {len(records)} local {data_type} for shop {shop_id} (delta: {synced})")
+    return records
+
+def build_kpi_summary(shop_ids, day_from, day_to, top=10):
+    """
+    Ringkasan KPI retur/pembatalan/gagal kirim dari agregat yang dipelihara saat data disinkronkan
+    (tanpa membaca data mentah). day_from/day_to format YYYY-MM-DD.
+    """
+    started = time.time()
+
+    def total(metric):
+        rows = local_store.query_kpi(shop_ids, metric, 'all', day_from, day_to)
+        return {key: rows[0][key] if rows else 0 for key in ('count', 'amount', 'quantity')}
+
+    def top_rows(metric, dimension):
+        return [{'key': row['group'], 'count': row['count'], 'amount': row['amount'], 'quantity': row['quantity']}
+                for row in local_store.query_kpi(shop_ids, metric, dimension, day_from, day_to, limit=top)]
+
+    ordered_by_sku = {row['group']: row['quantity'] for row in local_store.query_kpi(shop_ids, 'orders', 'sku', day_from, day_to)}
+    returns_by_sku = top_rows('returns', 'sku')
+    for row in returns_by_sku:
+        ordered = ordered_by_sku.get(row['key'], 0)
+        row['ordered_quantity'] = ordered
+        row['return_rate'] = round(row['quantity'] / ordered * 100, 2) if ordered else None
+
+    by_day = collections.defaultdict(lambda: {'returns': 0, 'refund_amount': 0.0, 'cancellations': 0, 'failed_deliveries': 0})
+    for metric in ('returns', 'cancellations', 'failed_deliveries'):
+        for row in local_store.query_kpi(shop_ids, metric, 'all', day_from, day_to, group_by='day'):
+            by_day[row['group']][metric] = row['count']
+            if metric == 'returns':
+                by_day[row['group']]['refund_amount'] = row['amount']
+
+    return {
+        'shop_ids': list(shop_ids),
+        'date_from': day_from,
+        'date_to': day_to,
+        'orders': total('orders'),
+        'returns': {**total('returns'), 'by_reason': top_rows('returns', 'reason'),
+                    'by_status': top_rows('returns', 'status'), 'by_sku': returns_by_sku},
+        'cancellations': {**total('cancellations'), 'by_reason': top_rows('cancellations', 'reason')},
+        'failed_deliveries': {**total('failed_deliveries'), 'by_province': top_rows('failed_deliveries', 'province')},
+        'by_day': [{'day': day, **values} for day, values in sorted(by_day.items())],
+        'query_ms': round((time.time() - started) * 1000, 1)
+    }
+
+def iterate_local_pages(records, page_size=100):
+    """Bungkus data lokal dalam bentuk tuple (page_no, item_list, error) seperti iterate_shopee_pages."""
+    for i in range(0, len(records), page_size):
+        yield i // page_size + 1, records[i:i + page_size], None
+
+# ==============================================================================
+# EXPORT DELTA (HANYA DATA YANG BERUBAH SEJAK EXPORT DELTA TERAKHIR)
+# ==============================================================================
+DELTA_EXPORT_TYPES = ('orders', 'returns')
+
+def process_delta_export_global(export_id, access_token):
+    """
+    Export delta per (toko, data_type): hanya pesanan/retur yang update_time-nya setelah watermark
+    export delta terakhir, dengan kolom penanda perubahan (Baru/Diperbarui). Perubahan diambil lewat
+    sinkronisasi update_time ke penyimpanan lokal. Export delta pertama berisi semua data dalam
+    rentang tanggal sebagai baseline. Watermark baru baru disimpan setelah hasilnya diunduh/ditulis.
+    """
+    app.logger.info("=== STARTING process_delta_export_global ===")
+
     if export_id not in export_progress_store:
         return
-    
+
     export_data = export_progress_store[export_id]
     export_data['status'] = 'processing'
-    export_data['current_step'] = 'Mempersiapkan chunks tanggal untuk orders...'
     export_data['progress'] = 5.0
-    
-    app.logger.info(f"Initial progress set to: {export_data['progress']}")
-    app.logger.info(f"Shop ID: {export_data['shop_id']}")
-    app.logger.info(f"Date range: {export_data['date_from']} to {export_data['date_to']}")
-    
-    # Pecah date range jadi chunks 15 hari
-    date_chunks = get_date_chunks(export_data['date_from'], export_data['date_to'], 15)
-    app.logger.info(f"Created {len(date_chunks)} date chunks for orders")
-    
     shop_id = export_data['shop_id']
-    all_orders = []
-    total_processed = 0
-    
-    # Loop untuk setiap chunk tanggal
-    for chunk_index, (chunk_start, chunk_end) in enumerate(date_chunks):
-        app.logger.info(f"Processing orders chunk {chunk_index + 1}/{len(date_chunks)}: {chunk_start.strftime('%Y-%m-%d')} to {chunk_end.strftime('%Y-%m-%d')}")
-        
-        # Update progress untuk chunk
-        chunk_progress = 5.0 + (chunk_index / len(date_chunks)) * 75.0
-        export_data['progress'] = round(chunk_progress, 1)
-        export_data['current_step'] = f'Memproses orders chunk {chunk_index + 1}/{len(date_chunks)} ({chunk_start.strftime("%Y-%m-%d")} to {chunk_end.strftime("%Y-%m-%d")})'
-        
-        # Reset pagination untuk chunk ini
-        page_no = 1
-        max_pages_estimate = 50
-        
-        # Loop pagination untuk chunk ini
-        while True:
-            app.logger.info(f"=== ORDERS CHUNK {chunk_index + 1} PAGE {page_no} ===")
-            
-            # Update progress dalam chunk (fixed calculation)
-            chunk_base_progress = 5.0 + (chunk_index / len(date_chunks)) * 75.0
-            chunk_size_progress = 75.0 / len(date_chunks)
-            page_progress = min(page_no / max_pages_estimate, 0.9) * chunk_size_progress
-            current_progress = chunk_base_progress + page_progress
-            export_data['progress'] = round(min(85.0, current_progress), 1)
-            export_data['current_step'] = f'Orders Chunk {chunk_index + 1}/{len(date_chunks)} - Halaman {page_no}...'
-            
-            # API call untuk orders dengan date filter
-            order_body = {
-                "page_no": page_no,
-                "page_size": 100,  # Increased page size for orders
-                "time_range_field": "create_time",
-                "time_from": int(chunk_start.timestamp()),
-                "time_to": int(chunk_end.timestamp())
-                # Removed order_status parameter as "ALL" is not valid
-            }
-            
-            response, error = call_shopee_api("/api/v2/order/get_order_list", method='GET', 
-                                            shop_id=shop_id, access_token=access_token, body=order_body, export_id=export_id)
-            
-            if error:
-                app.logger.error(f"Orders API error: {error}")
-                export_data['error'] = f"Gagal mengambil daftar pesanan: {error}"
-                export_data['status'] = 'error'
-                return
-            
-            # Process response
-            order_list = response.get('response', {}).get('order_list', [])
-            app.logger.info(f"Found {len(order_list)} orders on chunk {chunk_index + 1} page {page_no}")
-            
-            if not order_list:
-                app.logger.info(f"No more orders found in chunk {chunk_index + 1}, breaking pagination loop")
+    data_type = export_data['data_type']
+    if data_type not in DELTA_EXPORT_TYPES:
+        export_data['status'] = 'error'
+        export_data['error'] = f"Export delta hanya tersedia untuk: {', '.join(DELTA_EXPORT_TYPES)}"
+        return
+
+    watermark = local_store.get_export_watermark(shop_id, data_type)
+    if watermark is None:
+        try:
+            time_from = int(datetime.strptime(export_data['date_from'], '%Y-%m-%d').timestamp())
+            time_to = int(datetime.strptime(export_data['date_to'], '%Y-%m-%d').replace(hour=23, minute=59, second=59).timestamp())
+        except (ValueError, TypeError, KeyError):
+            export_data['status'] = 'error'
+            export_data['error'] = 'Error: Export delta pertama membutuhkan rentang tanggal dengan format YYYY-MM-DD.'
+            return
+        time_field = 'create_time'
+        export_data['current_step'] = 'Export delta pertama: mengambil semua data dalam rentang tanggal...'
+    else:
+        time_from = watermark + 1
+        time_field = 'update_time'
+        export_data['current_step'] = f"Mengambil perubahan sejak {datetime.fromtimestamp(watermark).strftime('%Y-%m-%d %H:%M:%S')}..."
+
+    # Data yang dibuat dalam rentang pasti punya update_time >= time_from, jadi cukup sinkron mulai time_from
+    synced, error = sync_shop_data(shop_id, access_token, data_type, since=time_from)
+    if error:
+        export_data['status'] = 'error'
+        export_data['error'] = f"Gagal mengambil perubahan {data_type}: {error}"
+        return
+    high_water = local_store.get_sync_state(shop_id, data_type)['high_water']
+    if time_field == 'update_time':
+        time_to = high_water
+    records = (local_store.query_orders(shop_id, time_from, time_to, time_field=time_field) if data_type == 'orders'
+               else local_store.query_returns(shop_id, time_from, time_to, time_field=time_field))
+    app.logger.info(f"Delta export {data_type} for shop {shop_id}: {len(records)} changed records (fetched {synced})")
+
+    def change_marker(record):
+        return "Baru" if watermark is None or (record.get('create_time') or 0) > watermark else "Diperbarui"
+
+    export_data['progress'] = 50.0
+    export_data['current_step'] = f'Memformat {len(records)} data yang berubah...'
+    spool = attach_result_spool(export_data)
+    for i in range(0, len(records), 500):
+        batch = records[i:i + 500]
+        if data_type == 'orders':
+            rows = [{"Jenis Perubahan": change_marker(order), **row}
+                    for order, row in zip(batch, format_order_data_for_excel(batch))]
+        else:
+            markers = {item.get('return_sn'): change_marker(item) for item in batch}
+            rows = [{"Jenis Perubahan": markers.get(row.get("Nomor Retur")), **row}
+                    for row in process_chunk_data(batch, 'returns', shop_id, access_token, export_id,
+                                                  include_return_detail=export_data.get('include_return_detail', False))]
+        spool_export_rows(export_data, spool, rows)
+        export_data['progress'] = round(50.0 + 45.0 * min(1.0, (i + len(batch)) / len(records)), 1)
+
+    export_data['delta_watermarks'] = {f"{shop_id}:{data_type}": high_water}
+    export_data['status'] = 'completed'
+    export_data['progress'] = 100.0
+    export_data['current_step'] = f'Selesai! {export_data["data_count"]} baris berubah sejak export delta terakhir'
+
+def commit_delta_watermarks(export_data):
+    """Simpan watermark export delta setelah hasilnya benar-benar diunduh/ditulis ke file."""
+    for key, watermark in (export_data.get('delta_watermarks') or {}).items():
+        shop_id, data_type = key.rsplit(':', 1)
+        local_store.set_export_watermark(shop_id, data_type, watermark)
+        app.logger.info(f"Delta watermark for shop {shop_id} {data_type} advanced to {watermark}")
+
+# ==============================================================================
+# PUSH NOTIFICATION SHOPEE (MENJAGA DATA LOKAL TETAP SEGAR TANPA POLLING)
+# ==============================================================================
+PUSH_EVENTS_FILE = os.path.join(DATA_DIR, 'push_events.jsonl')
+# Antrean event push dibatasi; jika penuh, Shopee diberi 503 dan akan mengirim ulang nanti
+PUSH_QUEUE_SIZE = 1000
+# Event diproses per batch: maksimal sekian event, atau yang terkumpul dalam sekian detik
+PUSH_BATCH_SIZE = 100
+PUSH_BATCH_WAIT = 1.0
+# Field event update retur yang disalin ke data retur lokal
+RETURN_PUSH_FIELDS = ('status', 'negotiation_status', 'seller_proof_status', 'seller_compensation_status',
+                      'refund_amount', 'update_time', 'due_date')
+
+push_queue = queue.Queue(maxsize=PUSH_QUEUE_SIZE)
+push_stats = collections.Counter()
+push_thread = None
+push_thread_lock = threading.Lock()
+push_log_lock = threading.Lock()
+
+def _latest_push_data(existing, data):
+    """Pilih data event terbaru (berdasarkan update_time) jika satu batch berisi beberapa event untuk data yang sama."""
+    if existing and (existing.get('update_time') or 0) > (data.get('update_time') or 0):
+        return existing
+    return data
+
+def apply_push_events(events):
+    """
+    Terapkan satu batch event push ke penyimpanan lokal: status pesanan, no. resi, dan update
+    retur. Pesanan/retur yang belum ada di penyimpanan lokal dilewati (diambil saat sinkronisasi).
+    """
+    order_updates = collections.defaultdict(dict)
+    return_updates = collections.defaultdict(dict)
+    tracking_updates = collections.defaultdict(dict)
+    for event in events:
+        data = event.get('data') or {}
+        shop_id = str(event.get('shop_id') or data.get('shop_id') or '')
+        data = {**data, 'update_time': data.get('update_time') or event.get('timestamp')}
+        order_sn = data.get('ordersn') or data.get('order_sn')
+        if not shop_id:
+            push_stats['ignored'] += 1
+        elif data.get('return_sn'):
+            return_updates[shop_id][data['return_sn']] = _latest_push_data(return_updates[shop_id].get(data['return_sn']), data)
+        elif order_sn and (data.get('tracking_no') or data.get('tracking_number')):
+            tracking_updates[shop_id][order_sn] = data.get('tracking_no') or data.get('tracking_number')
+        elif order_sn and data.get('status'):
+            order_updates[shop_id][order_sn] = _latest_push_data(order_updates[shop_id].get(order_sn), data)
+        else:
+            push_stats['ignored'] += 1
+
+    for shop_id, updates in order_updates.items():
+        stored = local_store.get_orders(shop_id, list(updates))
+        changed = []
+        for order_sn, data in updates.items():
+            order = stored.get(order_sn)
+            if not order:
+                push_stats['orders_not_stored'] += 1
+                continue
+            if (order.get('update_time') or 0) > (data.get('update_time') or 0):
+                push_stats['stale'] += 1 # Data lokal sudah lebih baru dari event ini
+                continue
+            order['order_status'] = data['status']
+            order['update_time'] = data.get('update_time') or order.get('update_time')
+            changed.append(order)
+        push_stats['orders_updated'] += local_store.upsert_orders(shop_id, changed) if changed else 0
+
+    for shop_id, updates in return_updates.items():
+        stored = {item['return_sn']: item for item in local_store.query_returns_by_sn(shop_id, list(updates))}
+        changed = []
+        for return_sn, data in updates.items():
+            item = stored.get(return_sn)
+            if not item:
+                push_stats['returns_not_stored'] += 1
+                continue
+            if (item.get('update_time') or 0) > (data.get('update_time') or 0):
+                push_stats['stale'] += 1
+                continue
+            item.update({field: data[field] for field in RETURN_PUSH_FIELDS if data.get(field) is not None})
+            changed.append(item)
+        push_stats['returns_updated'] += local_store.upsert_returns(shop_id, changed) if changed else 0
+
+    for shop_id, tracking_numbers in tracking_updates.items():
+        local_store.save_tracking(shop_id, tracking_numbers)
+        push_stats['tracking_updated'] += len(tracking_numbers)
+
+def _push_processor_loop():
+    while True:
+        events = [push_queue.get()]
+        deadline = time.time() + PUSH_BATCH_WAIT
+        while len(events) < PUSH_BATCH_SIZE:
+            remaining = deadline - time.time()
+            if remaining <= 0:
                 break
-            
-            all_orders.extend(order_list)
-            total_processed += len(order_list)
-            
-            # Removed artificial delay - API research shows natural throttling at ~5s
-            page_no += 1
-            
-            # Safety limit per chunk
-            if page_no > 100:
-                app.logger.info(f"Reached safety limit of 100 pages in orders chunk {chunk_index + 1}")
+            try:
+                events.append(push_queue.get(timeout=remaining))
+            except queue.Empty:
                 break
-        
-        app.logger.info(f"Orders chunk {chunk_index + 1} completed")
-    
-    # Process the collected data
-    export_data['current_step'] = 'Memproses data orders untuk Excel...'
-    export_data['progress'] = 95.0
-    
-    if all_orders:
-        processed_orders = []
-        app.logger.info(f"Processing {len(all_orders)} total orders")
-        
-        for order in all_orders:
-            processed_item = {
-                "Nomor Pesanan": order.get('order_sn'),
-                "Status Pesanan": order.get('order_status'),
-                "Tanggal Dibuat": datetime.fromtimestamp(order.get('create_time')).strftime('%Y-%m-%d %H:%M:%S') if order.get('create_time') else None,
-                "Tanggal Update": datetime.fromtimestamp(order.get('update_time')).strftime('%Y-%m-%d %H:%M:%S') if order.get('update_time') else None,
-                "Total Harga": order.get('total_amount'),
-                "Mata Uang": order.get('currency'),
-                "Metode Pembayaran": order.get('payment_method'),
-                "Estimasi Pengiriman": order.get('estimated_shipping_fee'),
-                "Resi": order.get('tracking_number'),
-                "Pesan dari Pembeli": order.get('message_to_seller'),
-                "Negara": order.get('recipient_address', {}).get('country') if order.get('recipient_address') else None,
-                "Kota": order.get('recipient_address', {}).get('city') if order.get('recipient_address') else None
-            }
-            processed_orders.append(processed_item)
-        
-        export_data['data'] = processed_orders
-        export_data['status'] = 'completed'
-        export_data['progress'] = 100.0
-        export_data['current_step'] = f'Selesai! {len(processed_orders)} pesanan berhasil diproses'
-        
-        app.logger.info(f"Orders export completed with {len(processed_orders)} records")
+        try:
+            apply_push_events(events)
+            push_stats['batches'] += 1
+            push_stats['processed'] += len(events)
+        except Exception as e:
+            push_stats['failed'] += len(events)
+            app.logger.error(f"Failed to apply {len(events)} push events: {e}")
+
+def start_push_processor():
+    """Jalankan thread pemroses antrean push (sekali per proses)."""
+    global push_thread
+    with push_thread_lock:
+        if push_thread and push_thread.is_alive():
+            return
+        push_thread = threading.Thread(target=_push_processor_loop, name='push-processor', daemon=True)
+        push_thread.start()
+
+@app.route('/push', methods=['POST'])
+def shopee_push():
+    """Menerima push notification Shopee (status pesanan, no. resi, update retur)."""
+    body = request.get_data(as_text=True)
+    authorization = request.headers.get('Authorization', '')
+    # URL yang ditandatangani Shopee adalah URL push yang didaftarkan (domain publik aplikasi)
+    candidate_urls = {f"{REDIRECT_URL_DOMAIN}{url_for('shopee_push')}", request.url}
+    if not authorization or not any(hmac.compare_digest(generate_push_signature(url, body), authorization)
+                                    for url in candidate_urls):
+        push_stats['rejected'] += 1
+        app.logger.warning("Rejected push notification with invalid signature")
+        return {"error": "Invalid signature"}, 401
+    try:
+        event = json.loads(body)
+    except ValueError:
+        return {"error": "Invalid JSON"}, 400
+
+    start_push_processor()
+    try:
+        push_queue.put_nowait(event)
+    except queue.Full:
+        push_stats['dropped'] += 1
+        return {"error": "Push queue full"}, 503
+    push_stats['received'] += 1
+    if PUSH_LOG_EVENTS:
+        with push_log_lock:
+            with open(PUSH_EVENTS_FILE, 'a', encoding='utf-8') as f:
+                f.write(body.replace('\n', ' ') + '\n')
+    return {}
+
+def replay_push_events(path, url=None, delay=0):
+    """
+    Putar ulang event push dari file JSON lines. Dengan url, setiap event dikirim ke endpoint
+    /push dengan signature yang benar; tanpa url, event langsung diterapkan di proses ini.
+    """
+    stats = collections.Counter()
+    batch = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            body = line.strip()
+            if not body:
+                continue
+            stats['events'] += 1
+            if url:
+                response = requests.post(url, data=body.encode('utf-8'), timeout=10, headers={
+                    'Content-Type': 'application/json', 'Authorization': generate_push_signature(url, body)})
+                stats[f"http_{response.status_code}"] += 1
+            else:
+                batch.append(json.loads(body))
+                if len(batch) >= PUSH_BATCH_SIZE:
+                    apply_push_events(batch)
+                    batch = []
+            if delay:
+                time.sleep(delay)
+    if batch:
+        apply_push_events(batch)
+    if not url:
+        stats.update(push_stats)
+    return dict(stats)
+
+# ==============================================================================
+# ANTREAN JOB EXPORT (PROSES WORKER TERPISAH)
+# ==============================================================================
+JOB_STORE_FILE = os.path.join(DATA_DIR, 'jobs.sqlite3')
+# Interval (detik) worker mencari job baru dan mengirim progress ke antrean
+EXPORT_WORKER_POLL_INTERVAL = 2
+EXPORT_JOB_HEARTBEAT_INTERVAL = 2
+
+class ExportJobStore:
+    """
+    Antrean job export di SQLite yang dipakai bersama oleh proses web dan proses worker.
+    Kolom record menyimpan export_data (tanpa 'data'), jadi progress bisa dibaca proses web.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.initialized = False
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        with self.lock:
+            if not self.initialized:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with sqlite_connection(self.path, 10) as conn:
+                    conn.execute("""CREATE TABLE IF NOT EXISTS export_jobs (
+                        export_id TEXT PRIMARY KEY, status TEXT NOT NULL, record TEXT NOT NULL,
+                        worker TEXT, created INTEGER NOT NULL, heartbeat INTEGER)""")
+                    conn.execute("CREATE INDEX IF NOT EXISTS idx_export_jobs_status ON export_jobs (status, created)")
+                self.initialized = True
+        return sqlite3.connect(self.path, timeout=10, isolation_level=None)
+
+    @staticmethod
+    def _dump(export_data):
+        record = {key: value for key, value in export_data.items() if key != 'data'}
+        return json.dumps(record, default=str)
+
+    def enqueue(self, export_data):
+        conn = self._connect()
+        try:
+            conn.execute("INSERT OR REPLACE INTO export_jobs (export_id, status, record, worker, created, heartbeat) VALUES (?, 'queued', ?, NULL, ?, NULL)",
+                         (export_data['export_id'], self._dump(export_data), int(time.time())))
+        finally:
+            conn.close()
+
+    def claim(self, worker_id):
+        """
+        Ambil satu job secara atomik: job antre tertua, atau job 'running' yang worker-nya
+        tidak memberi heartbeat lagi. Return record atau None.
+        """
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            now = int(time.time())
+            row = conn.execute("""SELECT export_id, record FROM export_jobs
+                WHERE status = 'queued' OR (status = 'running' AND heartbeat < ?)
+                ORDER BY created LIMIT 1""", (now - EXPORT_JOB_STALE_SECONDS,)).fetchone()
+            if not row:
+                conn.execute("COMMIT")
+                return None
+            conn.execute("UPDATE export_jobs SET status = 'running', worker = ?, heartbeat = ? WHERE export_id = ?",
+                         (worker_id, now, row[0]))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return json.loads(row[1])
+
+    def update(self, export_data, worker_id):
+        """Simpan progress job. Hanya worker pemilik job yang boleh menulis."""
+        status = export_data.get('status')
+        job_status = status if status in ('completed', 'error') else 'running'
+        conn = self._connect()
+        try:
+            cursor = conn.execute("UPDATE export_jobs SET status = ?, record = ?, heartbeat = ? WHERE export_id = ? AND worker = ?",
+                                  (job_status, self._dump(export_data), int(time.time()), export_data['export_id'], worker_id))
+            return cursor.rowcount > 0
+        finally:
+            conn.close()
+
+    def get(self, export_id):
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT record FROM export_jobs WHERE export_id = ?", (export_id,)).fetchone()
+        finally:
+            conn.close()
+        return json.loads(row[0]) if row else None
+
+    def delete(self, export_id):
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM export_jobs WHERE export_id = ?", (export_id,))
+        finally:
+            conn.close()
+
+export_job_store = ExportJobStore(JOB_STORE_FILE)
+
+def get_export_record(export_id):
+    """Data export terbaru: dari memory proses ini, atau dari antrean job jika dikerjakan worker."""
+    if export_id in export_progress_store:
+        return export_progress_store[export_id]
+    if EXPORT_EXECUTION_MODE == 'worker':
+        return export_job_store.get(export_id)
+    return None
+
+def execute_export(export_id, access_token=None, shop_tokens=None):
+    """Jalankan export yang sudah ada di export_progress_store (satu toko atau semua toko)."""
+    if export_progress_store[export_id]['shop_id'] == ALL_SHOPS_ID:
+        process_all_shops_global(export_id, shop_tokens)
     else:
-        export_data['status'] = 'completed'
-        export_data['progress'] = 100.0
-        export_data['current_step'] = 'Tidak ada data pesanan ditemukan'
-        export_data['data'] = []
+        run_export_job(export_id, access_token)
 
-def process_products_chunked_global(export_id, access_token):
-    """Process products data in small chunks using global store."""
-    if export_id not in export_progress_store:
+def _stored_access_token(shop_id):
+    """(access_token, error) dari token toko yang tersimpan di server; error jika toko belum diotorisasi."""
+    if not shop_token_manager.get_token(shop_id):
+        return None, f"Toko {shop_id} belum diotorisasi di server, silakan login ulang toko tersebut"
+    return shop_token_manager.get_access_token(shop_id)
+
+def resolve_export_tokens(export_data):
+    """Ambil (access_token, shop_tokens, error) untuk export dari token toko yang tersimpan di server."""
+    if export_data['shop_id'] != ALL_SHOPS_ID:
+        access_token, error = _stored_access_token(export_data['shop_id'])
+        return access_token, None, error
+
+    shop_tokens = {}
+    for shop_id in export_data.get('shop_ids', []):
+        access_token, error = _stored_access_token(shop_id)
+        if error:
+            app.logger.warning(f"Worker skipping shop {shop_id}: {error}")
+            continue
+        token = shop_token_manager.get_token(shop_id) or {}
+        shop_tokens[shop_id] = {'access_token': access_token, 'shop_name': token.get('shop_name') or shop_id}
+    if not shop_tokens:
+        return None, None, "Token toko tidak ditemukan di server, silakan login ulang toko"
+    return None, shop_tokens, None
+
+def run_claimed_export_job(record, worker_id):
+    """Kerjakan satu job dari antrean dan kirim progress-nya ke antrean secara berkala."""
+    export_id = record['export_id']
+    if record.get('spool_path'):
+        # Sisa spool dari worker sebelumnya yang mati di tengah jalan
+        discard_export_results(record)
+        record.pop('spool_path', None)
+    record.update({'status': 'processing', 'progress': 1.0, 'current_step': 'Memulai proses export...',
+                   'error': None, 'data': [], 'data_count': 0})
+    export_progress_store[export_id] = record
+    app.logger.info(f"Worker {worker_id} claimed export {export_id} ({record['data_type']})")
+
+    finished = threading.Event()
+    def publish_progress():
+        while not finished.wait(EXPORT_JOB_HEARTBEAT_INTERVAL):
+            if not export_job_store.update(export_progress_store.get(export_id, record), worker_id):
+                app.logger.warning(f"Export {export_id} is no longer owned by worker {worker_id}")
+                return
+    threading.Thread(target=publish_progress, name=f'job-progress-{export_id}', daemon=True).start()
+
+    try:
+        access_token, shop_tokens, error = resolve_export_tokens(record)
+        if error:
+            record['status'] = 'error'
+            record['error'] = error
+        else:
+            execute_export(export_id, access_token, shop_tokens)
+    except Exception as e:
+        app.logger.error(f"Worker export {export_id} failed: {e}")
+        record['status'] = 'error'
+        record['error'] = str(e)
+    finally:
+        finished.set()
+        export_data = export_progress_store.pop(export_id, record)
+        # Hasil yang masih di memory dipindah ke spool agar bisa diunduh oleh proses web
+        if export_data.get('status') == 'completed' and not export_data.get('spool_path'):
+            spool_export_rows(export_data, attach_result_spool(export_data), export_data.get('data', []))
+        elif export_data.get('status') not in ('completed', 'error'):
+            export_data['status'] = 'error'
+            export_data['error'] = export_data.get('error') or 'Export berhenti sebelum selesai'
+        export_job_store.update(export_data, worker_id)
+        app.logger.info(f"Worker {worker_id} finished export {export_id}: {export_data['status']}")
+
+def run_export_worker(worker_id=None):
+    """Loop proses worker: ambil job dari antrean dan kerjakan hingga EXPORT_WORKER_JOBS sekaligus."""
+    worker_id = worker_id or f"worker-{os.getpid()}"
+    app.logger.info(f"Export worker {worker_id} started (jobs={EXPORT_WORKER_JOBS}, store={JOB_STORE_FILE})")
+    shop_token_manager.start_background_refresh()
+    running = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=EXPORT_WORKER_JOBS, thread_name_prefix='export-job') as executor:
+        try:
+            while True:
+                running = {future for future in running if not future.done()}
+                record = export_job_store.claim(worker_id) if len(running) < EXPORT_WORKER_JOBS else None
+                if record:
+                    running.add(executor.submit(run_claimed_export_job, record, worker_id))
+                    continue
+                time.sleep(EXPORT_WORKER_POLL_INTERVAL)
+        except KeyboardInterrupt:
+            app.logger.info(f"Export worker {worker_id} stopping, waiting for {len(running)} running jobs")
+
+def write_export_file(export_data, target, file_format='xlsx'):
+    """
+    Tulis hasil export ke file/buffer target dalam format 'xlsx' atau 'csv'. Baris dibaca ke
+    tabel kolom (kategori ber-kamus + array bertipe) supaya tidak ada list dict besar di memory.
+    """
+    import pandas as pd
+    df = load_export_table(export_data).to_dataframe()
+    if file_format == 'csv':
+        df.to_csv(target, index=False, encoding='utf-8-sig')
         return
-    export_data = export_progress_store[export_id]
-    export_data['status'] = 'completed'  # Placeholder
-    export_data['progress'] = 100
-    export_data['current_step'] = 'Products processing not implemented yet'
-    export_data['data'] = []
+    with pd.ExcelWriter(target, engine='openpyxl') as writer:
+        df.to_excel(writer, index=False, sheet_name=export_data['data_type'])
+
+# ==============================================================================
+# STARTUP: IMPORT MODUL BERAT SECARA MALAS, PRELOAD UNTUK WORKER, DAN PROFIL STARTUP
+# ==============================================================================
+HEAVY_MODULES = ('numpy', 'pandas', 'openpyxl')
+
+def preload_heavy_modules():
+    """
+    Impor modul berat sekarang (bukan saat export pertama). Dipanggil di proses master sebelum
+    fork; gc.freeze() memindahkan objek yang sudah ada ke generasi permanen supaya garbage
+    collector di worker tidak menyentuh (dan menyalin) halaman memory bersama itu.
+    """
+    started = time.perf_counter()
+    for module_name in HEAVY_MODULES:
+        __import__(module_name)
+    gc.freeze()
+    app.logger.info(f"Preloaded {', '.join(HEAVY_MODULES)} in {time.perf_counter() - started:.2f}s")
+
+def profile_startup(runs=5, top=15):
+    """
+    Ukur cold start di proses Python baru: waktu `import app` (median dari beberapa run), waktu
+    tambahan preload modul berat, dan modul dengan import paling lama menurut `-X importtime`.
+    """
+    module_name = os.path.splitext(os.path.basename(os.path.abspath(__file__)))[0]
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    timer = ("import time, json; t = time.perf_counter(); import {module}; t1 = time.perf_counter(); "
+             "{module}.preload_heavy_modules(); "
+             "print(json.dumps([t1 - t, time.perf_counter() - t1]))").format(module=module_name)
+    env = {**os.environ, 'PRELOAD_HEAVY_MODULES': '0'}
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', timer], cwd=app_dir, env=env, capture_output=True,
+                                text=True, check=True).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+
+    # Baris `-X importtime`: "import time: self [us] | cumulative | nama modul"
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {module_name}"], cwd=app_dir,
+                            env=env, capture_output=True, text=True, check=True).stderr
+    modules = []
+    for line in stderr.splitlines():
+        parts = line.split('|')
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            modules.append((parts[2].strip(), int(parts[1]) / 1e6))
+    top_modules = sorted(modules, key=lambda item: item[1], reverse=True)[:top]
+
+    import_times = sorted(sample[0] for sample in samples)
+    preload_times = sorted(sample[1] for sample in samples)
+    return {
+        "runs": runs,
+        "import_seconds_median": round(import_times[len(import_times) // 2], 4),
+        "import_seconds_min": round(import_times[0], 4),
+        "preload_heavy_seconds_median": round(preload_times[len(preload_times) // 2], 4),
+        "top_imports": [{"module": name, "cumulative_seconds": round(seconds, 4)}
+                        for name, seconds in top_modules],
+    }
 
 @app.route('/download_export')
 def download_export():
@@ -2080,8 +5454,9 @@ def download_export():
     
     # Get the latest data from global store
     export_id = export_data.get('export_id')
-    if export_id and export_id in export_progress_store:
-        export_data = export_progress_store[export_id]
+    latest_export = get_export_record(export_id) if export_id else None
+    if latest_export:
+        export_data = latest_export
         # Update session with latest data (WITHOUT the data field to reduce cookie size)
         session_data = export_data.copy()
         session_data.pop('data', None)  # Remove data from session to fix cookie size
@@ -2092,17 +5467,18 @@ def download_export():
         flash("Ekspor belum selesai. Status: " + export_data.get('status', 'unknown'), 'warning')
         return redirect(url_for('dashboard'))
     
-    if not export_data.get('data'):
+    if not get_export_row_count(export_data):
+        commit_delta_watermarks(export_data)  # Tidak ada perubahan: export delta berikutnya mulai dari sini
         flash("Tidak ada data untuk diekspor.", 'warning')
         return redirect(url_for('dashboard'))
     
-    df = pd.DataFrame(export_data['data'])
     output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name=export_data['data_type'])
+    write_export_file(export_data, output, 'xlsx')
     output.seek(0)
+    commit_delta_watermarks(export_data)
     
-    filename = f"laporan_{export_data['data_type']}_{export_data['shop_id']}_{datetime.now().strftime('%Y%m%d')}.xlsx"
+    shop_label = 'semua_toko' if export_data['shop_id'] == ALL_SHOPS_ID else export_data['shop_id']
+    filename = f"laporan_{export_data['data_type']}_{shop_label}_{datetime.now().strftime('%Y%m%d')}.xlsx"
     
     response = make_response(output.read())
     response.headers["Content-Disposition"] = f"attachment; filename={filename}"
@@ -2115,9 +5491,13 @@ def download_export():
     # Auto-cleanup: Remove data from memory store after successful download
     export_id = export_data.get('export_id')
     if export_id and export_id in export_progress_store:
-        del export_progress_store[export_id]
+        discard_export_results(export_progress_store.pop(export_id))
         print(f"Auto-cleanup: Removed export data {export_id} from memory after download")
         app.logger.info(f"Auto-cleanup: Removed export data {export_id} from memory after download")
+    elif export_id and EXPORT_EXECUTION_MODE == 'worker':
+        discard_export_results(export_data)
+        export_job_store.delete(export_id)
+        app.logger.info(f"Auto-cleanup: Removed worker export {export_id} after download")
     
     return response
 
@@ -2170,6 +5550,7 @@ def test_api_limits():
     except Exception as e:
         results["failed_delivery_test"] = {"error": f"Failed delivery API test error: {str(e)}", "skipped": True}
     
+    results["endpoint_profiles"] = get_endpoint_profiles_snapshot()
     results["test_end"] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     
     return results
@@ -2268,7 +5649,7 @@ def test_failed_delivery_limits(shop_id, access_token):
     
     # Test 1: Maximum page size
     app.logger.info("Testing maximum page size for failed delivery API")
-    page_sizes = [10, 20, 50]  # Test realistic page sizes (API docs say max is 50)
+    page_sizes = [10, 20, 50, 100]  # API docs say max is 50; 100 probes whether the limit was raised
     
     for page_size in page_sizes:
         start_time = time.time()
@@ -2397,15 +5778,16 @@ def test_unlimited_return_list(shop_id, access_token):
     page_no = 1
     max_pages = 100  # Batasan untuk mencegah infinite loop
     
-    app.logger.info(f"Starting unlimited return list fetch - no delays, max page size")
+    page_size = get_endpoint_size("/api/v2/returns/get_return_list")
+    app.logger.info(f"Starting unlimited return list fetch - no delays, page size {page_size}")
     
     while page_no <= max_pages:
         start_time = time.time()
         
-        # Use maximum page size possible (testing up to 2000)
+        # Use maximum page size known to be accepted (from endpoint profile)
         body = {
             "page_no": page_no,
-            "page_size": 200  # Test higher page size
+            "page_size": page_size
         }
         
         response, error = call_shopee_api("/api/v2/returns/get_return_list", method='GET', 
@@ -2455,7 +5837,8 @@ def test_unlimited_failed_delivery(shop_id, access_token):
     request_count = 0
     max_requests = 50  # Batasan untuk mencegah infinite loop
     
-    app.logger.info(f"Starting unlimited failed delivery fetch - no delays, max page size")
+    page_size = get_endpoint_size("/api/v2/logistics/get_failed_delivery_list")
+    app.logger.info(f"Starting unlimited failed delivery fetch - no delays, page size {page_size}")
     
     cursor = ''
     
@@ -2463,9 +5846,9 @@ def test_unlimited_failed_delivery(shop_id, access_token):
         start_time = time.time()
         request_count += 1
         
-        # Test maximum page size (API doc says 50 max, but let's test higher)
+        # Use maximum page size known to be accepted (from endpoint profile)
         body = {
-            "page_size": 500,  # Test lebih dari dokumentasi
+            "page_size": page_size,
             "cursor": cursor,
             "create_time_from": int((datetime.now() - timedelta(days=30)).timestamp()),
             "create_time_to": int(datetime.now().timestamp())
@@ -2531,8 +5914,164 @@ def debug_shops():
         "session_has_token": bool(session.get('access_token'))
     }
 
+# ==============================================================================
+# EXPORT LEWAT COMMAND LINE (UNTUK CRON)
+# ==============================================================================
+def run_cli_export(data_type, shop_ids, date_from, date_to, output_path, file_format=None,
+                   include_failed_delivery=False, include_return_detail=False, delta_export=False):
+    """
+    Jalankan export tanpa browser: token diambil dari penyimpanan token, progress ditulis ke
+    stderr, hasil langsung ke file. Return dict statistik export.
+    """
+    file_format = file_format or ('csv' if output_path.lower().endswith('.csv') else 'xlsx')
+    if shop_ids == [ALL_SHOPS_ID]:
+        shop_ids = list(shop_token_manager.get_all_tokens().keys())
+    shop_id = shop_ids[0] if len(shop_ids) == 1 else ALL_SHOPS_ID
+
+    export_id = f"{shop_id}_{data_type}_cli_{int(time.time())}"
+    export_data = {
+        'export_id': export_id,
+        'shop_id': shop_id,
+        'data_type': data_type,
+        'date_from': date_from,
+        'date_to': date_to,
+        'include_failed_delivery': include_failed_delivery,
+        'include_return_detail': include_return_detail,
+        'delta_export': delta_export,
+        'status': 'initializing',
+        'progress': 0,
+        'total_estimated': 0,
+        'current_step': 'Memulai ekspor...',
+        'data': [],
+        'error': None
+    }
+    if shop_id == ALL_SHOPS_ID:
+        export_data['shop_ids'] = shop_ids
+    export_progress_store[export_id] = export_data
+
+    finished = threading.Event()
+    def report_progress():
+        last_line = None
+        while not finished.wait(2):
+            line = f"[{export_data.get('progress', 0):5.1f}%] {export_data.get('current_step', '')}"
+            if line != last_line:
+                print(line, file=sys.stderr, flush=True)
+                last_line = line
+    threading.Thread(target=report_progress, name='cli-progress', daemon=True).start()
+
+    started = time.time()
+    try:
+        access_token, shop_tokens, error = resolve_export_tokens(export_data)
+        if error:
+            export_data['status'] = 'error'
+            export_data['error'] = error
+        else:
+            # print() di dalam proses export diarahkan ke stderr agar stdout hanya berisi statistik JSON
+            with contextlib.redirect_stdout(sys.stderr):
+                execute_export(export_id, access_token, shop_tokens)
+    except Exception as e:
+        export_data['status'] = 'error'
+        export_data['error'] = str(e)
+    finally:
+        finished.set()
+        export_progress_store.pop(export_id, None)
+
+    row_count = get_export_row_count(export_data)
+    if export_data.get('status') == 'completed':
+        if row_count:
+            write_export_file(export_data, output_path, file_format)
+        commit_delta_watermarks(export_data)
+    discard_export_results(export_data)
+    print(f"[{export_data.get('progress', 0):5.1f}%] {export_data.get('current_step', '')}", file=sys.stderr, flush=True)
+
+    return {
+        'export_id': export_id,
+        'data_type': data_type,
+        'shop_ids': shop_ids,
+        'date_from': date_from,
+        'date_to': date_to,
+        'status': export_data.get('status'),
+        'error': export_data.get('error'),
+        'rows': row_count,
+        'output': output_path if export_data.get('status') == 'completed' and row_count else None,
+        'format': file_format,
+        'elapsed_seconds': round(time.time() - started, 1),
+        'shop_errors': export_data.get('shop_errors', {}),
+        'source_warnings': export_data.get('source_warnings', [])
+    }
+
+def main(argv=None):
+    """Entry point command line: web server (default), worker export, atau export sekali jalan."""
+    parser = argparse.ArgumentParser(description="Aplikasi laporan Shopee")
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('serve', help="Jalankan web server (default)")
+    profile_parser = commands.add_parser('startup-profile', help="Ukur waktu cold start dan import paling lambat")
+    profile_parser.add_argument('--runs', type=int, default=5)
+    profile_parser.add_argument('--top', type=int, default=15, help="Jumlah modul paling lambat yang ditampilkan")
+    worker_parser = commands.add_parser('worker', help="Jalankan worker yang mengerjakan antrean export")
+    worker_parser.add_argument('worker_id', nargs='?', help="ID worker (default: worker-<pid>)")
+
+    yesterday = (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d')
+    export_parser = commands.add_parser('export', help="Export data langsung ke file, tanpa browser")
+    export_parser.add_argument('--type', dest='data_type', required=True, choices=sorted(EXPORT_PROCESSORS))
+    export_parser.add_argument('--shop', dest='shop_ids', action='append', required=True,
+                               help="ID toko (boleh diulang), atau 'all' untuk semua toko di penyimpanan token")
+    export_parser.add_argument('--from', dest='date_from', default=yesterday, help="Tanggal awal YYYY-MM-DD (default: kemarin)")
+    export_parser.add_argument('--to', dest='date_to', default=yesterday, help="Tanggal akhir YYYY-MM-DD (default: kemarin)")
+    export_parser.add_argument('--format', dest='file_format', choices=['xlsx', 'csv'], help="Default mengikuti ekstensi file output")
+    export_parser.add_argument('--output', required=True, help="Path file hasil export")
+    export_parser.add_argument('--include-failed-delivery', action='store_true')
+    export_parser.add_argument('--include-return-detail', action='store_true')
+    export_parser.add_argument('--delta', action='store_true',
+                               help="Hanya data yang berubah sejak export delta terakhir (orders/returns)")
+
+    sync_parser = commands.add_parser('sync', help="Sinkronkan data toko ke penyimpanan lokal")
+    sync_parser.add_argument('--shop', dest='shop_ids', action='append', help="ID toko (boleh diulang, default: semua toko)")
+    sync_parser.add_argument('--once', action='store_true', help="Sinkron sekali lalu keluar")
+    sync_parser.add_argument('--interval', type=int, default=SYNC_INTERVAL or 900, help="Jeda antar sinkronisasi (detik)")
+
+    replay_parser = commands.add_parser('replay-push', help="Putar ulang event push Shopee dari file JSON lines")
+    replay_parser.add_argument('events_file')
+    replay_parser.add_argument('--url', help="Kirim ke endpoint /push ini (mis. http://127.0.0.1:5001/push); "
+                                             "tanpa --url event langsung diterapkan ke penyimpanan lokal")
+    replay_parser.add_argument('--delay', type=float, default=0, help="Jeda antar event (detik)")
+    args = parser.parse_args(argv)
+
+    if args.command in ('worker', 'export', 'sync', 'replay-push'):
+        logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+        app.logger.setLevel(logging.INFO)
+
+    if args.command == 'worker':
+        start_background_sync()
+        run_export_worker(args.worker_id)
+    elif args.command == 'startup-profile':
+        print(json.dumps(profile_startup(args.runs, args.top), ensure_ascii=False, indent=2))
+    elif args.command == 'replay-push':
+        print(json.dumps(replay_push_events(args.events_file, args.url, args.delay), ensure_ascii=False))
+    elif args.command == 'sync':
+        if args.once:
+            print(json.dumps(sync_all_shops(args.shop_ids), ensure_ascii=False))
+        else:
+            run_sync_loop(args.interval, args.shop_ids)
+    elif args.command == 'export':
+        for value in (args.date_from, args.date_to):
+            try:
+                datetime.strptime(value, '%Y-%m-%d')
+            except ValueError:
+                export_parser.error(f"Format tanggal tidak valid: {value} (harus YYYY-MM-DD)")
+        stats = run_cli_export(args.data_type, args.shop_ids, args.date_from, args.date_to, args.output, args.file_format,
+                               args.include_failed_delivery, args.include_return_detail, args.delta)
+        print(json.dumps(stats, ensure_ascii=False, default=str))
+        sys.exit(0 if stats['status'] == 'completed' else 1)
+    else:
+        app.run(host='0.0.0.0', port=5001, debug=True)
+
+# Dijalankan paling akhir supaya gc.freeze() juga mencakup semua objek modul ini
+if PRELOAD_HEAVY_MODULES:
+    preload_heavy_modules()
+
 # ==============================================================================
 # ENTRY POINT UNTUK MENJALANKAN APLIKASI
 # ==============================================================================
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5001, debug=True)
+    main()
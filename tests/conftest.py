@@ -0,0 +1,67 @@
+import os
+import sys
+import tempfile
+
+# Data aplikasi (token, session, penyimpanan lokal) selama test ditulis ke direktori sementara
+os.environ.setdefault('SHOPEE_APP_DATA_DIR', tempfile.mkdtemp(prefix='shopee-app-tests-'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import app as shopee_app
+
+
+class FakeResponse:
+    """Respons HTTP palsu untuk menggantikan requests.get/post di test."""
+
+    def __init__(self, status_code=200, payload=None, headers=None):
+        self.status_code = status_code
+        self.payload = payload if payload is not None else {}
+        self.headers = headers or {}
+
+    def json(self):
+        return self.payload
+
+
+@pytest.fixture
+def app_module():
+    return shopee_app
+
+
+@pytest.fixture
+def local_store(tmp_path, monkeypatch):
+    """LocalStore baru per test (menggantikan penyimpanan lokal global)."""
+    store = shopee_app.LocalStore(str(tmp_path / 'local_store.sqlite3'))
+    monkeypatch.setattr(shopee_app, 'local_store', store)
+    return store
+
+
+@pytest.fixture
+def fake_shopee(monkeypatch):
+    """
+    Ganti HTTP ke Shopee dengan daftar respons berurutan. Mengembalikan list pemanggilan
+    (url, params) dan fungsi untuk menambah respons. Backoff retry dibuat nol dan state
+    limiter/breaker/jatah retry di-reset supaya test tidak saling memengaruhi.
+    """
+    responses = []
+    calls = []
+
+    def send(url, params=None, json=None, headers=None, timeout=None):
+        calls.append((url, params))
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    monkeypatch.setattr(shopee_app.requests, 'get', send)
+    monkeypatch.setattr(shopee_app.requests, 'post', send)
+    monkeypatch.setattr(shopee_app, 'retry_backoff_delay', lambda attempt, retry_after=None: 0)
+    monkeypatch.setattr(shopee_app, 'shopee_retry_budget', shopee_app.RetryBudget(shopee_app.RETRY_BUDGET_PER_MINUTE))
+    monkeypatch.setattr(shopee_app, 'shopee_circuit_breakers', shopee_app.CircuitBreakerRegistry(
+        shopee_app.CIRCUIT_BREAKER_FAILURE_THRESHOLD, shopee_app.CIRCUIT_BREAKER_COOLDOWN))
+    monkeypatch.setattr(shopee_app, 'concurrency_limiters', {})
+
+    def add(*new_responses):
+        responses.extend(new_responses)
+
+    return add, calls
@@ -0,0 +1,64 @@
+import pytest
+
+from conftest import FakeResponse
+
+TRACKING_PATH = "/api/v2/logistics/get_tracking_number"
+
+
+@pytest.mark.parametrize('error, counts', [
+    ("Shopee API Error: tracking number not exist (Req ID: 1)", False),
+    ("Shopee API Error: return not found (Req ID: 2)", False),
+    ("Kesalahan Jaringan: HTTP 404 untuk /x", False),
+    ("Shopee API Error: System busy, try again later (Req ID: 3)", True),
+    ("Shopee API Error: No permission to access this api (Req ID: 4)", True),
+    ("Kesalahan Jaringan: HTTP 502 untuk /x", True),
+    ("Kesalahan Jaringan: HTTP 429 untuk /x", True),
+    ("Kesalahan Jaringan: Read timed out", True),
+])
+def test_endpoint_failure_classification(app_module, error, counts):
+    assert app_module._is_endpoint_failure(error) is counts
+
+
+def test_per_record_errors_do_not_open_breaker(app_module, fake_shopee):
+    add_responses, calls = fake_shopee
+    threshold = app_module.CIRCUIT_BREAKER_FAILURE_THRESHOLD
+    add_responses(*[FakeResponse(200, {'error': 'logistics.tracking_number_not_exist',
+                                       'message': 'tracking number not exist'}) for _ in range(threshold + 1)])
+
+    for i in range(threshold + 1):
+        _, error = app_module.call_shopee_api(TRACKING_PATH, method='GET', shop_id=1, access_token='token',
+                                              body={'order_sn': f'O{i}'}, max_retries=1)
+        assert 'tracking number not exist' in error
+
+    assert not app_module.shopee_circuit_breakers.is_open(1, TRACKING_PATH)
+    assert len(calls) == threshold + 1
+
+
+def test_server_errors_open_breaker_and_fail_fast(app_module, fake_shopee):
+    add_responses, calls = fake_shopee
+    threshold = app_module.CIRCUIT_BREAKER_FAILURE_THRESHOLD
+    add_responses(*[FakeResponse(502) for _ in range(threshold)])
+
+    for i in range(threshold):
+        app_module.call_shopee_api(TRACKING_PATH, method='GET', shop_id=1, access_token='token',
+                                   body={'order_sn': f'O{i}'}, max_retries=1)
+    assert app_module.shopee_circuit_breakers.is_open(1, TRACKING_PATH)
+
+    # Breaker terbuka: panggilan berikutnya gagal tanpa request HTTP
+    _, error = app_module.call_shopee_api(TRACKING_PATH, method='GET', shop_id=1, access_token='token',
+                                          body={'order_sn': 'O-next'}, max_retries=1)
+    assert 'Circuit breaker' in error
+    assert len(calls) == threshold
+    # Toko lain tidak ikut terblok
+    assert not app_module.shopee_circuit_breakers.is_open(2, TRACKING_PATH)
+
+
+def test_half_open_probe_success_closes_breaker(app_module):
+    breakers = app_module.CircuitBreakerRegistry(failure_threshold=2, cooldown=0)
+    for _ in range(2):
+        breakers.record('1', '/p', "Kesalahan Jaringan: HTTP 500 untuk /p")
+
+    assert breakers.allow('1', '/p') == (True, None) # Probe setelah cooldown
+    assert breakers.allow('1', '/p')[0] is False # Hanya satu probe sekaligus
+    breakers.record('1', '/p')
+    assert breakers.allow('1', '/p') == (True, None)
@@ -0,0 +1,99 @@
+import itertools
+import threading
+import time
+
+import pytest
+
+
+@pytest.fixture
+def job_store(app_module, tmp_path):
+    return app_module.ExportJobStore(str(tmp_path / 'jobs' / 'jobs.sqlite3'))
+
+
+@pytest.fixture
+def token_manager(app_module, tmp_path, monkeypatch):
+    manager = app_module.ShopTokenManager(str(tmp_path / 'tokens.json'))
+    monkeypatch.setattr(manager, 'start_background_refresh', lambda: None)
+    monkeypatch.setattr(app_module, 'shop_token_manager', manager)
+    return manager
+
+
+def make_job(export_id, **fields):
+    return {'export_id': export_id, 'shop_id': '1', 'data_type': 'orders', 'status': 'processing',
+            'data': [{'order_sn': 'not stored'}], **fields}
+
+
+def test_jobs_are_claimed_oldest_first_and_only_once(job_store, monkeypatch, app_module):
+    clock = itertools.count(1000) # Tiap job antre di detik yang berbeda
+    monkeypatch.setattr(app_module.time, 'time', lambda: next(clock))
+    for export_id in ('A', 'B', 'C'):
+        job_store.enqueue(make_job(export_id))
+
+    claimed = [job_store.claim(f'worker-{i}') for i in range(4)]
+
+    assert [record and record['export_id'] for record in claimed] == ['A', 'B', 'C', None]
+    assert 'data' not in claimed[0] # Hasil export tidak ikut disimpan di antrean
+
+
+def test_concurrent_workers_never_claim_same_job(job_store):
+    for i in range(20):
+        job_store.enqueue(make_job(f'E{i}'))
+    claimed = []
+
+    def worker(worker_id):
+        while (record := job_store.claim(worker_id)) is not None:
+            claimed.append(record['export_id'])
+
+    threads = [threading.Thread(target=worker, args=(f'worker-{i}',)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(claimed) == sorted(f'E{i}' for i in range(20))
+
+
+def test_stale_running_job_is_reclaimed(job_store, monkeypatch, app_module):
+    job_store.enqueue(make_job('A'))
+    assert job_store.claim('worker-1')['export_id'] == 'A'
+    assert job_store.claim('worker-2') is None # Masih dipegang worker-1
+
+    # worker-1 tidak memberi heartbeat lagi
+    now = time.time()
+    monkeypatch.setattr(app_module.time, 'time', lambda: now + app_module.EXPORT_JOB_STALE_SECONDS + 1)
+
+    assert job_store.claim('worker-2')['export_id'] == 'A'
+    # Worker lama tidak boleh menimpa progress pemilik baru
+    assert not job_store.update(make_job('A', progress=50.0), 'worker-1')
+    assert job_store.update(make_job('A', progress=60.0), 'worker-2')
+    assert job_store.get('A')['progress'] == 60.0
+
+
+def test_update_sets_final_status(job_store):
+    job_store.enqueue(make_job('A'))
+    job_store.claim('worker-1')
+
+    assert job_store.update(make_job('A', status='completed'), 'worker-1')
+
+    assert job_store.get('A')['status'] == 'completed'
+    assert job_store.claim('worker-2') is None
+
+
+def test_resolve_export_tokens_requires_stored_token(app_module, token_manager):
+    access_token, shop_tokens, error = app_module.resolve_export_tokens(make_job('A', shop_id='404'))
+
+    assert access_token is None and shop_tokens is None
+    assert 'belum diotorisasi' in error
+
+
+def test_resolve_export_tokens_for_all_shops_skips_unknown_shops(app_module, token_manager):
+    token_manager.register('1', 'token-1', 'refresh-1', time.time() + 3600, shop_name='Toko Satu')
+
+    _, shop_tokens, error = app_module.resolve_export_tokens(
+        make_job('A', shop_id=app_module.ALL_SHOPS_ID, shop_ids=['1', '404']))
+    assert error is None
+    assert shop_tokens == {'1': {'access_token': 'token-1', 'shop_name': 'Toko Satu'}}
+
+    _, shop_tokens, error = app_module.resolve_export_tokens(
+        make_job('B', shop_id=app_module.ALL_SHOPS_ID, shop_ids=['404']))
+    assert shop_tokens is None and error
@@ -0,0 +1,81 @@
+import os
+import time
+
+import pytest
+
+from conftest import FakeResponse
+
+DETAIL_PATH = "/api/v2/order/get_order_detail"
+
+
+@pytest.fixture
+def latency_tracker(app_module, monkeypatch):
+    tracker = app_module.LatencyTracker(min_samples=5)
+    monkeypatch.setattr(app_module, 'endpoint_latency_tracker', tracker)
+    monkeypatch.setattr(app_module, 'hedge_budget', app_module.RateLimiter(1.0))
+    monkeypatch.setattr(app_module, 'hedge_stats', app_module.collections.Counter())
+    return tracker
+
+
+@pytest.mark.skipif('HEDGE_ORDER_DETAIL_REQUESTS' in os.environ, reason="diatur lewat environment")
+def test_hedging_is_off_by_default(app_module):
+    assert app_module.HEDGE_ORDER_DETAIL_REQUESTS is False
+
+
+def test_no_hedge_without_enough_latency_samples(app_module, latency_tracker):
+    sent = []
+
+    def send(coalesce):
+        sent.append(coalesce)
+        return 'primary', None
+
+    assert app_module.hedged_call(DETAIL_PATH, send) == ('primary', None)
+    assert sent == [True]
+
+
+def test_slow_primary_is_hedged_and_faster_hedge_wins(app_module, latency_tracker):
+    for _ in range(5):
+        latency_tracker.record(DETAIL_PATH, 0.02)
+
+    def send(coalesce):
+        if coalesce: # Request utama (digabung) lambat, duplikat hedge cepat
+            time.sleep(0.5)
+            return 'primary', None
+        return 'hedge', None
+
+    assert app_module.hedged_call(DETAIL_PATH, send) == ('hedge', None)
+    assert app_module.hedge_stats['hedged'] == 1
+    assert app_module.hedge_stats['hedge_wins'] == 1
+
+
+def test_no_hedge_when_hedge_budget_is_empty(app_module, latency_tracker):
+    for _ in range(5):
+        latency_tracker.record(DETAIL_PATH, 0.01)
+    assert app_module.hedge_budget.try_acquire()
+    sent = []
+
+    def send(coalesce):
+        sent.append(coalesce)
+        time.sleep(0.1)
+        return 'primary', None
+
+    assert app_module.hedged_call(DETAIL_PATH, send) == ('primary', None)
+    assert sent == [True]
+
+
+def test_recorded_latency_excludes_rate_limiter_wait(app_module, fake_shopee, latency_tracker, monkeypatch):
+    add_responses, _ = fake_shopee
+
+    class SlowRateLimiter:
+        def acquire(self):
+            time.sleep(0.3) # Antre di limiter tidak boleh terhitung sebagai latensi endpoint
+
+    monkeypatch.setattr(app_module, 'shopee_rate_limiter', SlowRateLimiter())
+    add_responses(FakeResponse(200, {'response': {'order_list': []}}))
+
+    _, error = app_module.call_shopee_api(DETAIL_PATH, method='GET', shop_id=1, access_token='token',
+                                          body={'order_sn_list': 'A', 'response_optional_fields': ''})
+
+    assert error is None
+    samples = list(latency_tracker.samples[DETAIL_PATH])
+    assert len(samples) == 1 and samples[0] < 0.2
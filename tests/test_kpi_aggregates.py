@@ -0,0 +1,66 @@
+import threading
+import time
+
+NOW = int(time.time())
+TODAY = time.strftime('%Y-%m-%d', time.localtime(NOW))
+
+
+def make_order(order_sn, status, **fields):
+    return {'order_sn': order_sn, 'order_status': status, 'create_time': NOW, 'update_time': NOW,
+            'total_amount': 100, 'recipient_address': {'state': 'Bali'},
+            'item_list': [{'model_sku': 'SKU-A', 'model_quantity_purchased': 2}], **fields}
+
+
+def kpi_total(store, metric, dimension='all'):
+    return {row['group']: row['count'] for row in store.query_kpi(['1'], metric, dimension, TODAY, TODAY)}
+
+
+def test_status_change_moves_order_between_aggregates(local_store):
+    local_store.upsert_orders('1', [make_order('O1', 'READY_TO_SHIP')])
+    assert kpi_total(local_store, 'orders', 'status') == {'READY_TO_SHIP': 1}
+    assert kpi_total(local_store, 'cancellations') == {}
+
+    local_store.upsert_orders('1', [make_order('O1', 'CANCELLED', cancel_reason='Gagal kirim ke alamat')])
+
+    assert kpi_total(local_store, 'orders') == {'': 1}
+    assert kpi_total(local_store, 'orders', 'status') == {'CANCELLED': 1}
+    assert kpi_total(local_store, 'cancellations') == {'': 1}
+
+
+def test_reupserting_same_order_does_not_double_count(local_store):
+    for _ in range(3):
+        local_store.upsert_orders('1', [make_order('O1', 'COMPLETED'), make_order('O1', 'COMPLETED')])
+
+    assert kpi_total(local_store, 'orders') == {'': 1}
+    assert {row['group']: row['quantity'] for row in
+            local_store.query_kpi(['1'], 'orders', 'sku', TODAY, TODAY)} == {'SKU-A': 2}
+
+
+def test_return_update_replaces_previous_contribution(local_store):
+    base = {'return_sn': 'R1', 'order_sn': 'O1', 'reason': 'DAMAGED', 'create_time': NOW, 'update_time': NOW,
+            'item': [{'variation_sku': 'SKU-A', 'amount': 1}]}
+    local_store.upsert_returns('1', [{**base, 'status': 'REQUESTED', 'refund_amount': 25}])
+    local_store.upsert_returns('1', [{**base, 'status': 'CLOSED', 'refund_amount': 30}])
+
+    rows = local_store.query_kpi(['1'], 'returns', 'all', TODAY, TODAY)
+    assert [(row['count'], row['amount']) for row in rows] == [(1, 30)]
+    assert kpi_total(local_store, 'returns', 'status') == {'CLOSED': 1}
+
+
+def test_concurrent_writers_keep_aggregates_consistent(local_store):
+    local_store.upsert_orders('1', [make_order('O1', 'CANCELLED')])
+
+    def writer(offset):
+        for i in range(20):
+            local_store.upsert_orders('1', [make_order('O1', 'CANCELLED' if (offset + i) % 2 else 'COMPLETED')])
+
+    threads = [threading.Thread(target=writer, args=(offset,)) for offset in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    local_store.upsert_orders('1', [make_order('O1', 'CANCELLED')])
+
+    assert kpi_total(local_store, 'orders') == {'': 1}
+    assert kpi_total(local_store, 'orders', 'status') == {'CANCELLED': 1}
+    assert kpi_total(local_store, 'cancellations') == {'': 1}
@@ -0,0 +1,128 @@
+import time
+
+import pytest
+
+DAY = 24 * 3600
+
+
+@pytest.fixture
+def fake_pages(app_module, monkeypatch):
+    """
+    Ganti iterate_shopee_pages dengan halaman yang sudah disiapkan per path. Mengembalikan
+    (pages, requests): pages[path] = list halaman, requests = list (path, body, page_no) yang dibaca.
+    """
+    pages = {}
+    requests = []
+
+    def iterate(path, shop_id, access_token, body=None, export_id=None, max_pages=200):
+        for page_no, item_list in enumerate(pages.get(path, []), start=1):
+            if page_no > max_pages:
+                return
+            requests.append((path, body, page_no))
+            yield page_no, item_list, None
+
+    monkeypatch.setattr(app_module, 'iterate_shopee_pages', iterate)
+    monkeypatch.setattr(app_module, 'fetch_order_details_batch', lambda *args, **kwargs: [])
+    return pages, requests
+
+
+def make_return(return_sn, update_time, **fields):
+    return {'return_sn': return_sn, 'order_sn': f'O-{return_sn}', 'status': 'REQUESTED',
+            'create_time': update_time, 'update_time': update_time, **fields}
+
+
+RETURN_LIST = "/api/v2/returns/get_return_list"
+ORDER_LIST = "/api/v2/order/get_order_list"
+
+
+def test_first_returns_sync_backfills_without_date_filter(app_module, local_store, fake_pages):
+    pages, requests = fake_pages
+    now = int(time.time())
+    old = now - (app_module.SYNC_INITIAL_DAYS + 1) * DAY
+    pages[RETURN_LIST] = [
+        [make_return('R1', now - 60), make_return('R2', now - 5 * DAY, return_solution=2)],
+        [make_return('R3', old), make_return('R4', old)],
+        [make_return('R5', old)],
+    ]
+
+    synced, error = app_module.sync_shop_data(1, 'token', 'returns')
+
+    assert (synced, error) == (2, None)
+    # Halaman 2 seluruhnya lebih lama dari awal backfill, halaman 3 tidak perlu dibaca
+    assert [page_no for _, _, page_no in requests] == [1, 2]
+    # Tanpa filter tanggal, supaya retur RRBOC ikut terbaca
+    assert all(body is None for _, body, _ in requests)
+    assert {item['return_sn'] for item in local_store.query_returns_by_sn(1, ['R1', 'R2', 'R3'])} == {'R1', 'R2'}
+    state = local_store.get_sync_state(1, 'returns')
+    assert state['high_water'] >= now
+    assert state['backfill_from'] <= now - app_module.SYNC_INITIAL_DAYS * DAY
+
+
+def test_incremental_returns_sync_stops_at_first_old_page(app_module, local_store, fake_pages):
+    pages, requests = fake_pages
+    now = int(time.time())
+    high_water = now - 3600
+    local_store.set_sync_state(1, 'returns', now - 30 * DAY, high_water)
+    pages[RETURN_LIST] = [
+        [make_return('R1', now - 60), make_return('R2', high_water - 2 * DAY)],
+        [make_return('R3', high_water - 3 * DAY)],
+        [make_return('R4', high_water - 4 * DAY)],
+    ]
+
+    synced, error = app_module.sync_shop_data(1, 'token', 'returns')
+
+    assert (synced, error) == (1, None)
+    assert [page_no for _, _, page_no in requests] == [1, 2]
+    assert local_store.get_sync_state(1, 'returns')['high_water'] >= now
+
+
+def test_truncated_returns_sync_keeps_high_water(app_module, local_store, fake_pages, monkeypatch):
+    pages, _ = fake_pages
+    now = int(time.time())
+    high_water = now - 3600
+    local_store.set_sync_state(1, 'returns', now - 30 * DAY, high_water)
+    monkeypatch.setattr(app_module, 'SYNC_RETURNS_MAX_PAGES', 2)
+    pages[RETURN_LIST] = [[make_return(f'R{page}', now - page)] for page in range(4)]
+
+    synced, error = app_module.sync_shop_data(1, 'token', 'returns')
+
+    assert synced == 2
+    assert 'terpotong' in error
+    # Retur di halaman 3+ belum terbaca: high-water mark tidak boleh maju
+    assert local_store.get_sync_state(1, 'returns')['high_water'] == high_water
+
+
+def test_orders_sync_walks_update_time_windows(app_module, local_store, fake_pages):
+    pages, requests = fake_pages
+    now = int(time.time())
+    since = now - 40 * DAY
+    pages[ORDER_LIST] = [[{'order_sn': 'O1', 'order_status': 'COMPLETED', 'create_time': now, 'update_time': now}]]
+
+    synced, error = app_module.sync_shop_data(1, 'token', 'orders', since=since)
+
+    assert error is None
+    windows = [(body['time_from'], body['time_to']) for _, body, _ in requests]
+    assert len(windows) == 3 # 40 hari dalam jendela 15 hari
+    assert windows[0][0] == since
+    assert all(time_to - time_from <= app_module.SYNC_WINDOW_SECONDS for time_from, time_to in windows)
+    assert all(windows[i][1] == windows[i + 1][0] for i in range(len(windows) - 1))
+    assert synced == 3 # Pesanan yang sama muncul di tiap jendela, tapi tersimpan sebagai satu baris
+    assert len(local_store.get_orders(1, ['O1'])) == 1
+    assert local_store.get_sync_state(1, 'orders')['high_water'] == windows[-1][1]
+
+
+def test_orders_sync_error_keeps_last_completed_window(app_module, local_store, fake_pages, monkeypatch):
+    now = int(time.time())
+    since = now - 40 * DAY
+    calls = []
+
+    def sync_window(shop_id, access_token, time_from, time_to):
+        calls.append(time_from)
+        return (0, "Shopee API Error: System busy") if len(calls) == 2 else (0, None)
+
+    monkeypatch.setitem(app_module.SYNC_WINDOW_FUNCTIONS, 'orders', (sync_window, app_module.SYNC_WINDOW_SECONDS))
+
+    _, error = app_module.sync_shop_data(1, 'token', 'orders', since=since)
+
+    assert 'System busy' in error
+    assert local_store.get_sync_state(1, 'orders')['high_water'] == since + app_module.SYNC_WINDOW_SECONDS
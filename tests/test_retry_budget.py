@@ -0,0 +1,51 @@
+from conftest import FakeResponse
+
+
+def test_endpoint_budget_is_capped_at_half_of_shop_budget(app_module):
+    budget = app_module.RetryBudget(4)
+
+    assert [budget.try_spend('1', '/a') for _ in range(3)] == [True, True, False]
+    assert budget.exhausted[('1', '/a')] == 1
+
+
+def test_refused_shop_budget_does_not_consume_endpoint_budget(app_module):
+    budget = app_module.RetryBudget(4)
+    for path in ('/a', '/a', '/b', '/b'):
+        assert budget.try_spend('1', path)
+
+    # Jatah toko habis: retry /c ditolak, tapi jatah endpoint /c tetap utuh
+    assert not budget.try_spend('1', '/c')
+    assert budget.buckets[('1', '/c')].tokens >= 1.99
+
+
+def test_budgets_are_per_shop(app_module):
+    budget = app_module.RetryBudget(2)
+    assert budget.try_spend('1', '/a')
+    assert not budget.try_spend('1', '/a')
+    assert budget.try_spend('2', '/a')
+
+
+def test_retryable_errors_stop_when_budget_is_exhausted(app_module, fake_shopee, monkeypatch):
+    add_responses, calls = fake_shopee
+    monkeypatch.setattr(app_module, 'shopee_retry_budget', app_module.RetryBudget(2))
+    add_responses(*[FakeResponse(503) for _ in range(5)])
+
+    response, error = app_module.call_shopee_api('/api/v2/shop/get_shop_info', method='GET', shop_id=1,
+                                                 access_token='token', max_retries=5)
+
+    assert response is None
+    assert 'HTTP 503' in error
+    # Satu request awal + satu retry (jatah endpoint = separuh dari 2 per menit)
+    assert len(calls) == 2
+
+
+def test_fatal_errors_are_not_retried(app_module, fake_shopee):
+    add_responses, calls = fake_shopee
+    add_responses(FakeResponse(200, {'error': 'error_param', 'message': 'order_sn invalid'}))
+
+    response, error = app_module.call_shopee_api('/api/v2/shop/get_shop_info', method='GET', shop_id=1,
+                                                 access_token='token', max_retries=3)
+
+    assert response is None
+    assert 'order_sn invalid' in error
+    assert len(calls) == 1
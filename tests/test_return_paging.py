@@ -0,0 +1,54 @@
+import pytest
+
+
+@pytest.fixture
+def shifting_return_list(app_module, monkeypatch):
+    """
+    get_return_list palsu dengan 2 retur per halaman (terbaru di depan). inserts[n] = retur yang
+    masuk di depan daftar sesaat sebelum halaman ke-n dibaca, sehingga halaman berikutnya bergeser.
+    """
+    returns = [{'return_sn': f'R{i}'} for i in range(6, 0, -1)]
+    inserts = {}
+    fetched = []
+
+    def iterate(path, shop_id, access_token, body=None, export_id=None, max_pages=200):
+        page_no = 0
+        while page_no < max_pages:
+            page_no += 1
+            fetched.append(page_no)
+            returns[:0] = inserts.pop(len(fetched), [])
+            page = returns[(page_no - 1) * 2:page_no * 2]
+            yield page_no, page, None
+            if page_no * 2 >= len(returns):
+                return
+
+    monkeypatch.setattr(app_module, 'iterate_shopee_pages', iterate)
+    return inserts, fetched
+
+
+def collect(app_module):
+    items = []
+    for _, item_list, error in app_module.iterate_return_pages(1, 'token'):
+        assert error is None
+        items.extend(item['return_sn'] for item in item_list)
+    return items
+
+
+def test_stable_list_is_read_once(app_module, shifting_return_list):
+    _, fetched = shifting_return_list
+
+    assert collect(app_module) == ['R6', 'R5', 'R4', 'R3', 'R2', 'R1']
+    assert fetched == [1, 2, 3]
+
+
+def test_returns_inserted_while_paging_are_yielded_exactly_once(app_module, shifting_return_list):
+    inserts, fetched = shifting_return_list
+    # Dua retur baru masuk sebelum halaman 2 dibaca: halaman 2 mengulang R6 & R5
+    inserts[2] = [{'return_sn': 'N2'}, {'return_sn': 'N1'}]
+
+    items = collect(app_module)
+
+    assert sorted(items) == sorted(['N1', 'N2', 'R1', 'R2', 'R3', 'R4', 'R5', 'R6'])
+    assert len(items) == len(set(items))
+    # Paging ulang dari halaman awal berhenti di halaman yang isinya sudah terlihat semua
+    assert fetched == [1, 2, 3, 4, 1, 2]
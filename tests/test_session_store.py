@@ -0,0 +1,82 @@
+import os
+import time
+
+import pytest
+from flask import Flask, session
+
+
+@pytest.fixture(params=['sqlite', 'file'])
+def session_store(request, app_module, tmp_path):
+    if request.param == 'sqlite':
+        return app_module.SqliteSessionStore(str(tmp_path / 'sessions' / 'sessions.sqlite3'))
+    return app_module.FileSessionStore(str(tmp_path / 'sessions'))
+
+
+def test_store_round_trip_expiry_and_delete(session_store):
+    session_store.save('a' * 43, {'shops': ['1']}, time.time() + 60)
+    session_store.save('b' * 43, {'shops': ['2']}, time.time() - 1)
+
+    assert session_store.load('a' * 43) == {'shops': ['1']}
+    assert session_store.load('b' * 43) is None # Sudah kedaluwarsa
+    assert session_store.load('c' * 43) is None
+
+    session_store.delete('a' * 43)
+    assert session_store.load('a' * 43) is None
+
+
+def test_store_creates_nothing_until_first_use(session_store, tmp_path):
+    assert not os.path.exists(tmp_path / 'sessions')
+
+    session_store.save('a' * 43, {'x': 1}, time.time() + 60)
+
+    assert os.path.exists(tmp_path / 'sessions')
+
+
+@pytest.fixture
+def session_client(app_module, session_store):
+    test_app = Flask(__name__)
+    test_app.config['SECRET_KEY'] = 'test'
+    test_app.session_interface = app_module.ServerSideSessionInterface(session_store)
+
+    @test_app.route('/set/<value>')
+    def set_value(value):
+        session['shops'] = [value]
+        return 'ok'
+
+    @test_app.route('/get')
+    def get_value():
+        return ','.join(session.get('shops', []))
+
+    @test_app.route('/clear')
+    def clear():
+        session.clear()
+        return 'ok'
+
+    return test_app.test_client()
+
+
+def test_cookie_only_carries_session_id(session_client, session_store):
+    session_client.get('/set/12345')
+
+    sid = session_client.get_cookie('session').value
+    assert len(sid) == 43 and '12345' not in sid
+    assert session_store.load(sid) == {'shops': ['12345']}
+    assert session_client.get('/get').text == '12345'
+
+
+def test_clear_deletes_stored_session(session_client, session_store):
+    session_client.get('/set/12345')
+    sid = session_client.get_cookie('session').value
+
+    session_client.get('/clear')
+
+    assert session_store.load(sid) is None
+    assert session_client.get_cookie('session') is None
+
+
+def test_malformed_session_id_starts_new_session(session_client):
+    session_client.set_cookie('session', '../' * 14 + 'x')
+
+    assert session_client.get('/get').text == ''
+    session_client.get('/set/1')
+    assert len(session_client.get_cookie('session').value) == 43